@@ -0,0 +1,186 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from typing import Callable, Dict, Iterable, List, Union
+
+import smtptester
+import smtptester.dns as dns
+import smtptester.fake as fake
+import smtptester.load as load
+import smtptester.smtp as smtp
+import smtptester.util as util
+
+
+BENCH_DEFAULT_ITERATIONS = 200
+BENCH_DEFAULT_TOLERANCE = 0.25
+BENCH_DEFAULT_DNS_DELAY = 0.001
+BENCH_DEFAULT_SMTP_DELAY = 0.0
+BENCH_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+BENCH_DOMAIN = "example.test"
+BENCH_RECIPIENT = f"recipient@{BENCH_DOMAIN}"
+BENCH_SMTP_EXTENSIONS = ["PIPELINING"]
+BENCH_RECORDS = {
+    (BENCH_DOMAIN, "mx"): ["10 mx1.example.test.", "20 mx2.example.test."],
+    ("mx1.example.test", "a"): ["127.0.0.1"],
+    ("mx2.example.test", "a"): ["127.0.0.1"],
+}
+
+
+def benchmarks(
+    dns_server: fake.FakeDNSServer, smtp_server: fake.FakeSMTPServer
+) -> Dict[str, Callable]:
+    resolver = dns.DNSResolver(
+        host=dns_server.address, port=dns_server.port, cache_size=0
+    )
+    host = smtp.SMTPHost(name="", address=smtp_server.address, port=smtp_server.port)
+    options = dict(
+        sender=smtp.default_sender(),
+        message=smtp.SMTP_DEFAULT_MESSAGE,
+        dns_host=dns_server.address,
+        dns_port=dns_server.port,
+        dns_timeout=dns.DNS_DEFAULT_TIMEOUT,
+        dns_proto=dns.DNS_DEFAULT_PROTOCOL,
+        smtp_host="",
+        smtp_port=smtp_server.port,
+        smtp_timeout=smtp.SMTP_DEFAULT_TIMEOUT,
+        smtp_helo=smtp.default_helo(),
+        smtp_tls="no",
+        smtp_auth_user="",
+        smtp_auth_pass="",
+    )
+    return {
+        "dns_a": lambda: resolver.a("mx1.example.test"),
+        "dns_mx": lambda: resolver.mx(BENCH_DOMAIN),
+        "hosts_discover": lambda: smtp.hosts_discover(
+            resolver, BENCH_DOMAIN, port=smtp_server.port
+        ),
+        "smtp_send": lambda: smtp.send(host, BENCH_RECIPIENT, tls="no"),
+        "smtptester_run": lambda: smtptester.SMTPTester(
+            recipient=BENCH_RECIPIENT, **options
+        ).run(),
+    }
+
+
+def measure(fn: Callable, iterations: int) -> Dict[str, float]:
+    latency = load.Histogram()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        t = time.perf_counter()
+        fn()
+        latency.record(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+    return {
+        "iterations": iterations,
+        "ops_per_sec": iterations / elapsed,
+        "mean_ms": latency.mean * 1000,
+        "p50_ms": latency.percentile(50) * 1000,
+        "p99_ms": latency.percentile(99) * 1000,
+    }
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    failed = []
+    for name, result in results["benchmarks"].items():
+        expected = baseline["benchmarks"].get(name)
+        if expected is None:
+            continue
+        limit = expected["p50_ms"] * (1 + tolerance)
+        if result["p50_ms"] > limit:
+            failed.append(
+                f"{name}: p50 {result['p50_ms']:.3f}ms exceeds"
+                f" {limit:.3f}ms (baseline {expected['p50_ms']:.3f}ms)"
+            )
+    return failed
+
+
+def parse(args: Union[Iterable[str], None] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run offline benchmarks")
+    parser.add_argument(
+        "-n", "--iterations", type=int, default=BENCH_DEFAULT_ITERATIONS
+    )
+    parser.add_argument("-k", "--filter", default="", help="only run matching names")
+    parser.add_argument("-o", "--output", help="write results to this JSON file")
+    parser.add_argument("--baseline", default=BENCH_BASELINE)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=BENCH_DEFAULT_TOLERANCE,
+        help="allowed slowdown relative to the baseline",
+    )
+    parser.add_argument(
+        "--update-baseline", action="store_true", help="save results as the baseline"
+    )
+    parser.add_argument(
+        "--dns-delay",
+        type=float,
+        default=BENCH_DEFAULT_DNS_DELAY,
+        help="seconds the fake DNS server waits before answering",
+    )
+    parser.add_argument(
+        "--smtp-delay",
+        type=float,
+        default=BENCH_DEFAULT_SMTP_DELAY,
+        help="seconds the fake SMTP server waits before each reply",
+    )
+    return parser.parse_args(args)
+
+
+def main(args: Union[Iterable[str], None] = None) -> int:
+    o = parse(args)
+    dns_server = fake.FakeDNSServer(BENCH_RECORDS, delay=o.dns_delay)
+    smtp_server = fake.FakeSMTPServer(
+        extensions=BENCH_SMTP_EXTENSIONS, delay=o.smtp_delay
+    )
+    util.run_sync(dns_server.start())
+    util.run_sync(smtp_server.start())
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "dns_delay": o.dns_delay,
+        "smtp_delay": o.smtp_delay,
+        "benchmarks": {},
+    }
+    try:
+        for name, fn in benchmarks(dns_server, smtp_server).items():
+            if o.filter not in name:
+                continue
+            result = measure(fn, o.iterations)
+            results["benchmarks"][name] = result
+            print(
+                f"{name}: {result['ops_per_sec']:.1f} ops/s"
+                f" mean={result['mean_ms']:.3f}ms"
+                f" p50={result['p50_ms']:.3f}ms p99={result['p99_ms']:.3f}ms"
+            )
+    finally:
+        util.run_sync(smtp_server.stop())
+        util.run_sync(dns_server.stop())
+
+    if o.output:
+        with open(o.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if o.update_baseline:
+        with open(o.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        return 0
+
+    try:
+        with open(o.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"No baseline found: {o.baseline}", file=sys.stderr)
+        return 0
+    if (baseline["dns_delay"], baseline["smtp_delay"]) != (o.dns_delay, o.smtp_delay):
+        print("Baseline was recorded with different delays", file=sys.stderr)
+        return 0
+    failed = regressions(results, baseline, o.tolerance)
+    for line in failed:
+        print(f"Regression: {line}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
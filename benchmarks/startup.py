@@ -0,0 +1,93 @@
+import argparse
+import subprocess
+import sys
+import time
+from typing import Dict, Iterable, List, Union
+
+import smtptester.fake as fake
+import smtptester.util as util
+
+
+STARTUP_DEFAULT_RUNS = 5
+STARTUP_HELP_BUDGET = 0.5
+STARTUP_PROBE_BUDGET = 1.0
+STARTUP_RECIPIENT = "recipient@example.test"
+STARTUP_CLI = "import sys, smtptester.cli as cli; sys.exit(cli.main(sys.argv[1:]))"
+
+
+def run_cli(args: Iterable[str]) -> float:
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", STARTUP_CLI, *args],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - started
+
+
+def parse(args: Union[Iterable[str], None] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Check CLI startup time against a fixed budget"
+    )
+    parser.add_argument("-n", "--runs", type=int, default=STARTUP_DEFAULT_RUNS)
+    parser.add_argument(
+        "--help-budget",
+        type=float,
+        default=STARTUP_HELP_BUDGET,
+        help="seconds allowed for 'smtptester --help'",
+    )
+    parser.add_argument(
+        "--probe-budget",
+        type=float,
+        default=STARTUP_PROBE_BUDGET,
+        help="seconds allowed for a single probe of a local server",
+    )
+    return parser.parse_args(args)
+
+
+def main(args: Union[Iterable[str], None] = None) -> int:
+    o = parse(args)
+    smtp_server = fake.FakeSMTPServer()
+    util.run_sync(smtp_server.start())
+
+    # The sender and HELO name are given explicitly, so the probe shouldn't
+    # need any DNS lookups at all.
+    probe = [
+        STARTUP_RECIPIENT,
+        "-h",
+        smtp_server.address,
+        "--smtp-port",
+        str(smtp_server.port),
+        "--smtp-tls",
+        "no",
+        "-s",
+        "sender@example.test",
+        "--smtp-helo",
+        "localhost",
+        "-l",
+        "error",
+    ]
+    commands: Dict[str, List[str]] = {"help": ["--help"], "probe": probe}
+    budgets = {"help": o.help_budget, "probe": o.probe_budget}
+    failed = []
+    try:
+        for name, command in commands.items():
+            times = sorted(run_cli(command) for _ in range(max(o.runs, 1)))
+            median = times[len(times) // 2]
+            print(
+                f"{name}: median={median * 1000:.1f}ms min={times[0] * 1000:.1f}ms"
+                f" budget={budgets[name] * 1000:.0f}ms"
+            )
+            if median > budgets[name]:
+                failed.append(name)
+    finally:
+        util.run_sync(smtp_server.stop())
+
+    for name in failed:
+        print(f"Over budget: {name}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
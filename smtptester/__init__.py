@@ -1,26 +1,57 @@
-import importlib.metadata
+import asyncio
+import functools
 import logging
-import sys
 import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 
+import smtptester.body as body
 import smtptester.dns as dns
+import smtptester.replay as replay
+import smtptester.rto as rto
 import smtptester.smtp as smtp
+import smtptester.sink as sink
 import smtptester.cli as cli
 import smtptester.util as util
 
 
-META = importlib.metadata.metadata(__package__)
+RESULT_ACCEPTED = "accepted"
+RESULT_TEMPORARY = "temporary"
+RESULT_PERMANENT = "permanent"
+RESULT_ERROR = "error"
+RESULT_CATCH_ALL = "catch-all"
 
 log = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def metadata():
+    import importlib.metadata
+
+    return importlib.metadata.metadata(__package__)
+
+
+def __getattr__(name: str):
+    # Reading package metadata scans sys.path, so it's deferred until needed.
+    if name == "META":
+        return metadata()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class Result(NamedTuple):
+    recipient: str
+    outcome: str
+    host: Optional[smtp.SMTPHost] = None
+    message: str = ""
+    delivery: Optional[smtp.SMTPResult] = None
+
+
 class SMTPTester:
     def __init__(
         self,
-        recipient: str,
+        recipient: Union[str, Iterable[str]],
         sender: str,
-        message: str,
-        dns_host: str,
+        message: Union[str, body.MessageBody],
+        dns_host: Union[str, Iterable[str]],
         dns_port: int,
         dns_timeout: int,
         dns_proto: str,
@@ -31,74 +62,340 @@ class SMTPTester:
         smtp_tls: str,
         smtp_auth_user: str,
         smtp_auth_pass: str,
+        smtp_strategy: str = smtp.SMTP_DEFAULT_STRATEGY,
+        smtp_stagger: float = smtp.SMTP_DEFAULT_STAGGER,
+        dns_cache: str = "",
+        smtp_tls_ca_file: str = "",
+        smtp_tls_min_version: str = "",
+        smtp_tls_ciphers: str = "",
+        smtp_pipelining: bool = True,
+        smtp_max_recipients: int = smtp.SMTP_DEFAULT_MAX_RECIPIENTS,
+        resolver: Optional[dns.DNSResolver] = None,
+        hosts: Optional[Iterable[smtp.SMTPHost]] = None,
+        results_sink: Optional[sink.ResultsSink] = None,
+        dns_race: bool = False,
+        adaptive_timeouts: bool = False,
+        timeouts_file: str = "",
+        timeout_min: float = rto.RTO_DEFAULT_MIN,
+        timeout_max: float = rto.RTO_DEFAULT_MAX,
+        timeouts: Optional[rto.AdaptiveTimeouts] = None,
+        recorder: Optional[replay.Capture] = None,
     ):
         log.info(f"Session started: {time.strftime('%Y-%m-%d %H:%M:%S %Z')}")
         options_list = cli.options_list(
             locals().items(),
             redacted_keys=["smtp_auth_user", "smtp_auth_pass"],
-            no_log_keys=["self"],
+            no_log_keys=[
+                "self",
+                "resolver",
+                "hosts",
+                "results_sink",
+                "timeouts",
+                "recorder",
+            ],
         )
         log.debug(f"Options: {options_list}")
 
-        self.recipient = recipient
-        self.sender = sender
-        self.message = message
+        if isinstance(recipient, str):
+            recipient = [recipient]
+        self.recipients = list(recipient)
+        self.sender = sender or smtp.default_sender()
+        self.message = body.message_body(message)
 
         log.info(f"Sender: {self.sender}")
-        log.info(f"Recipient: {self.recipient}")
-        log.info(f"Message size: {sys.getsizeof(self.message)} bytes")
+        if len(self.recipients) == 1:
+            log.info(f"Recipient: {self.recipients[0]}")
+        else:
+            log.info(f"Recipients: {len(self.recipients)}")
+        log.info(f"Message size: {self.message.size} bytes")
 
-        self.resolver = dns.DNSResolver(
-            host=dns_host, port=dns_port, timeout=dns_timeout, protocol=dns_proto
-        )
+        self.recorder = recorder
+        if recorder is not None:
+            recorder.recipients.extend(self.recipients)
+            recorder.sender = self.sender
+            recorder.smtp_host = smtp_host or ""
+            recorder.auth = bool(smtp_auth_user or smtp_auth_pass)
+            recorder.pipelining = smtp_pipelining
+
+        self.save_timeouts = timeouts is None
+        if timeouts is None and (adaptive_timeouts or timeouts_file):
+            timeouts = rto.AdaptiveTimeouts(
+                minimum=timeout_min, maximum=timeout_max, path=timeouts_file
+            )
+        self.timeouts = timeouts
+
+        self.save_dns_cache = resolver is None
+        if resolver is None:
+            resolver = dns.DNSResolver(
+                host=dns_host,
+                port=dns_port,
+                timeout=dns_timeout,
+                protocol=dns_proto,
+                cache_path=dns_cache,
+                race=dns_race,
+                timeouts=timeouts,
+                recorder=recorder,
+            )
+        self.resolver = resolver
+        self.hosts = hosts
         self.smtp_host = smtp_host
         self.smtp_port = smtp_port
         self.smtp_timeout = smtp_timeout
         self.smtp_helo = smtp_helo
         self.smtp_tls = smtp_tls
+        self.tls_context = smtp.make_tls_context(
+            ca_file=smtp_tls_ca_file or "",
+            min_version=smtp_tls_min_version or "",
+            ciphers=smtp_tls_ciphers or "",
+        )
         self.smtp_auth_user = smtp_auth_user
         self.smtp_auth_pass = smtp_auth_pass
+        self.smtp_pipelining = smtp_pipelining
+        self.smtp_max_recipients = smtp_max_recipients
+        self.smtp_strategy = smtp_strategy
+        self.smtp_stagger = smtp_stagger
+        self.results_sink = results_sink
 
-    def run(self):
-        hosts = []
+    def run(
+        self, cancel: Optional[util.CancelToken] = None, deadline: float = 0.0
+    ) -> Result:
+        return self.run_all(cancel=cancel, deadline=deadline)[0]
+
+    def run_all(
+        self, cancel: Optional[util.CancelToken] = None, deadline: float = 0.0
+    ) -> List[Result]:
+        # Ctrl+C cancels the session through the token, so it still returns
+        # a result for every recipient.
+        cancel = cancel or util.CancelToken()
+        return util.run_sync(
+            self.run_all_async(cancel=cancel, deadline=deadline), cancel=cancel
+        )
+
+    async def run_async(
+        self, cancel: Optional[util.CancelToken] = None, deadline: float = 0.0
+    ) -> Result:
+        return (await self.run_all_async(cancel=cancel, deadline=deadline))[0]
+
+    async def run_all_async(
+        self, cancel: Optional[util.CancelToken] = None, deadline: float = 0.0
+    ) -> List[Result]:
+        # The session runs as its own task, so cancelling it or reaching the
+        # deadline (a time.monotonic() value) interrupts whatever DNS or SMTP
+        # phase is in progress, and every connection is closed on the way out.
+        results: Dict[str, Result] = {}
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(self._run(results))
+
+        def cancel_task():
+            loop.call_soon_threadsafe(task.cancel)
+
+        if cancel is not None:
+            cancel.add_callback(cancel_task)
+        timeout = max(deadline - time.monotonic(), 0) if deadline else None
         try:
-            if self.smtp_host:
-                hosts = smtp.hosts_set(
-                    self.resolver, self.smtp_host, port=self.smtp_port
-                )
+            await asyncio.wait({task}, timeout=timeout)
+        finally:
+            # Tokens outlive the session (batch runs share one), so the task
+            # isn't kept around once it's done.
+            if cancel is not None:
+                cancel.remove_callback(cancel_task)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        if task.cancelled():
+            if cancel is not None and cancel.cancelled:
+                message = "Session cancelled"
+                log.info(f"{message}: {time.strftime('%Y-%m-%d %H:%M:%S %Z')}")
             else:
-                domain = util.parse_email_address(self.recipient).domain
-                hosts = smtp.hosts_discover(self.resolver, domain, port=self.smtp_port)
-            log_hosts = [f"{h.name}({h.address}):{h.port}" for h in hosts]
+                message = "Deadline exceeded"
+                log.error(message)
+            for r in self.recipients:
+                if r not in results:
+                    results[r] = await self._emit(
+                        Result(r, RESULT_ERROR, message=message)
+                    )
+        else:
+            task.result()
+
+        cache = self.resolver.cache
+        log.debug(f"DNS cache: {cache.hits} hits, {cache.misses} misses")
+        if self.save_dns_cache:
+            cache.save()
+            await self.resolver.close_async()
+        if self.save_timeouts and self.timeouts is not None:
+            self.timeouts.save()
+        log.info(f"Session finished: {time.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+        return [results[r] for r in self.recipients]
+
+    async def _run(self, results: Dict[str, Result]):
+        for hosts, recipients in await self._groups(results):
+            log_hosts = [smtp.log_host(h) for h in hosts]
             log.info(f"Using SMTP hosts: {', '.join(log_hosts)}")
-        except dns.DNSException as e:
-            log.error(e)
+            size = max(self.smtp_max_recipients, 1)
+            for i in range(0, len(recipients), size):
+                chunk = recipients[i : i + size]
+                if self.smtp_strategy == "race" and len(hosts) > 1:
+                    results.update(await self._race(hosts, chunk))
+                else:
+                    results.update(await self._serial(hosts, chunk))
+
+    async def _groups(
+        self, results: Dict[str, Result]
+    ) -> List[Tuple[Tuple[smtp.SMTPHost, ...], List[str]]]:
+        # Recipients are grouped by their set of MX hosts, so domains hosted
+        # by the same provider share transactions.
+        async def discover(domain: str) -> Iterable[smtp.SMTPHost]:
+            try:
+                if self.hosts is not None:
+                    return self.hosts
+                if self.smtp_host:
+                    return await smtp.hosts_set_async(
+                        self.resolver, self.smtp_host, port=self.smtp_port
+                    )
+                return await smtp.hosts_discover_async(
+                    self.resolver, domain, port=self.smtp_port
+                )
+            except dns.DNSException as e:
+                log.error(e)
+                return e
 
+        domains: Dict[str, List[str]] = {}
+        for recipient in self.recipients:
+            domain = ""
+            if self.hosts is None and not self.smtp_host:
+                domain = util.parse_email_address(recipient).domain.lower()
+            domains.setdefault(domain, []).append(recipient)
+
+        groups: Dict[Tuple[smtp.SMTPHost, ...], List[str]] = {}
+        discovered = await util.gather(*(discover(d) for d in domains))
+        for recipients, hosts in zip(domains.values(), discovered):
+            if isinstance(hosts, dns.DNSException):
+                for r in recipients:
+                    results[r] = await self._emit(
+                        Result(r, RESULT_ERROR, message=str(hosts))
+                    )
+            elif not hosts:
+                log.error("No SMTP hosts available")
+                for r in recipients:
+                    message = "No SMTP hosts available"
+                    results[r] = await self._emit(
+                        Result(r, RESULT_ERROR, message=message)
+                    )
+            else:
+                groups.setdefault(tuple(hosts), []).extend(recipients)
+        return list(groups.items())
+
+    def _send_options(self) -> dict:
+        log_level = log.getEffectiveLevel()
+        debuglevel = 1 if log_level == logging.DEBUG else 0
+        return dict(
+            sender=self.sender,
+            message=self.message,
+            timeout=self.smtp_timeout,
+            helo=self.smtp_helo,
+            tls=self.smtp_tls,
+            auth_user=self.smtp_auth_user,
+            auth_pass=self.smtp_auth_pass,
+            debuglevel=debuglevel,
+            tls_context=self.tls_context,
+            pipelining=self.smtp_pipelining,
+            timeouts=self.timeouts,
+            recorder=self.recorder,
+        )
+
+    async def _serial(
+        self, hosts: Iterable[smtp.SMTPHost], recipients: List[str]
+    ) -> Dict[str, Result]:
+        results: Dict[str, Result] = {}
         for host in hosts:
             try:
-                log_level = log.getEffectiveLevel()
-                debuglevel = 1 if log_level == logging.DEBUG else 0
-                smtp.send(
-                    host,
-                    self.recipient,
-                    sender=self.sender,
-                    message=self.message,
-                    timeout=self.smtp_timeout,
-                    helo=self.smtp_helo,
-                    tls=self.smtp_tls,
-                    auth_user=self.smtp_auth_user,
-                    auth_pass=self.smtp_auth_pass,
-                    debuglevel=debuglevel,
+                delivery = await smtp.send_async(
+                    host, recipients, **self._send_options()
                 )
-                break
+                self._log_delivery(delivery)
+                return await self._results(recipients, host, delivery)
             except smtp.SMTPTemporaryError as e:
                 log.warning(e)
+                self._log_delivery(e.result)
+                results = await self._results(recipients, host, e.result, e)
                 continue
             except smtp.SMTPPermanentError as e:
                 log.error(e)
-                break
-            except KeyboardInterrupt:
-                break
-        else:
+                self._log_delivery(e.result)
+                return await self._results(recipients, host, e.result, e)
+        log.error("No SMTP hosts available")
+        return results
+
+    async def _race(
+        self, hosts: Iterable[smtp.SMTPHost], recipients: List[str]
+    ) -> Dict[str, Result]:
+        log.info(f"Racing SMTP hosts with a {self.smtp_stagger}s stagger")
+        try:
+            delivery = await smtp.race_async(
+                hosts, recipients, stagger=self.smtp_stagger, **self._send_options()
+            )
+            self._log_delivery(delivery)
+            return await self._results(recipients, delivery.host, delivery)
+        except smtp.SMTPTemporaryError as e:
             log.error("No SMTP hosts available")
-        log.info(f"Session finished: {time.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+            error = e
+        except smtp.SMTPPermanentError as e:
+            log.error(e)
+            error = e
+        self._log_delivery(error.result)
+        host = error.result.host if error.result else None
+        return await self._results(recipients, host, error.result, error)
+
+    async def _results(
+        self,
+        recipients: List[str],
+        host: Optional[smtp.SMTPHost],
+        delivery: Optional[smtp.SMTPResult],
+        error: Optional[smtp.SMTPException] = None,
+    ) -> Dict[str, Result]:
+        results = {}
+        replies = delivery.recipients if delivery else {}
+        for r in recipients:
+            reply = replies.get(r)
+            if reply is not None and reply.code not in (250, 251):
+                outcome = RESULT_PERMANENT if reply.code >= 500 else RESULT_TEMPORARY
+                message = f"{reply.code} {reply.message}".replace("\n", " ")
+                if error is None:
+                    log.warning(f"Recipient refused: {r}: {message}")
+            elif error is not None:
+                outcome = RESULT_PERMANENT
+                if isinstance(error, smtp.SMTPTemporaryError):
+                    outcome = RESULT_TEMPORARY
+                message = str(error)
+            else:
+                outcome, message = RESULT_ACCEPTED, ""
+            results[r] = await self._emit(Result(r, outcome, host, message, delivery))
+        return results
+
+    async def _emit(self, result: Result) -> Result:
+        if self.results_sink is not None:
+            await self.results_sink.write_result_async(result)
+        return result
+
+    def _log_delivery(self, delivery: Optional[smtp.SMTPResult]):
+        if delivery is None or not delivery.phases:
+            return
+        if delivery.tls_version:
+            resumed = "yes" if delivery.tls_resumed else "no"
+            log.info(
+                f"TLS: {delivery.tls_version} {delivery.tls_cipher}"
+                f" handshake={delivery.tls_handshake * 1000:.1f}ms resumed={resumed}"
+            )
+        log.info(
+            f"Timings: {smtp.format_phases(delivery.phases)}"
+            f" total={delivery.duration * 1000:.1f}ms"
+        )
+        if self.timeouts is not None:
+            log.info(f"Timeouts: {smtp.format_timeouts(delivery.phases)}")
+        if delivery.round_trips_saved:
+            log.info(f"Pipelining saved {delivery.round_trips_saved} round trips")
+        if delivery.message_bytes:
+            log.info(f"Message wire size: {delivery.message_bytes} bytes")
+        log.debug(
+            f"Bytes sent: {delivery.bytes_sent}, received: {delivery.bytes_received}"
+        )
@@ -0,0 +1,170 @@
+import concurrent.futures
+import logging
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    TextIO,
+    Tuple,
+    Union,
+)
+
+import smtptester
+import smtptester.dns as dns
+import smtptester.rto as rto
+import smtptester.smtp as smtp
+import smtptester.util as util
+
+
+BATCH_DEFAULT_WORKERS = 8
+BATCH_PENDING_PER_WORKER = 4
+
+log = logging.getLogger(__name__)
+
+
+def read_recipients(f: TextIO) -> Iterator[str]:
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            yield line
+
+
+def group_by_domain(recipients: Iterable[str]) -> Dict[str, List[str]]:
+    groups: Dict[str, List[str]] = {}
+    for recipient in recipients:
+        domain = util.parse_email_address(recipient).domain.lower()
+        groups.setdefault(domain, []).append(recipient)
+    return groups
+
+
+def run(
+    recipients: Iterable[str],
+    workers: int = BATCH_DEFAULT_WORKERS,
+    cancel: Optional[util.CancelToken] = None,
+    deadline: float = 0.0,
+    **options,
+) -> Iterator["smtptester.Result"]:
+    timeouts = None
+    if options.get("adaptive_timeouts") or options.get("timeouts_file"):
+        timeouts = rto.AdaptiveTimeouts(
+            minimum=options.get("timeout_min", rto.RTO_DEFAULT_MIN),
+            maximum=options.get("timeout_max", rto.RTO_DEFAULT_MAX),
+            path=options.get("timeouts_file", ""),
+        )
+    resolver = dns.DNSResolver(
+        host=options["dns_host"],
+        port=options["dns_port"],
+        timeout=options["dns_timeout"],
+        protocol=options["dns_proto"],
+        cache_path=options.get("dns_cache", ""),
+        race=options.get("dns_race", False),
+        timeouts=timeouts,
+        recorder=options.get("recorder"),
+    )
+    groups = group_by_domain(recipients)
+    log.info(f"Recipients: {sum(len(g) for g in groups.values())}")
+    log.info(f"Domains: {len(groups)}")
+
+    def discover(domain: str) -> Union[Iterable[smtp.SMTPHost], dns.DNSException]:
+        try:
+            if options["smtp_host"]:
+                return smtp.hosts_set(
+                    resolver, options["smtp_host"], port=options["smtp_port"]
+                )
+            return smtp.hosts_discover(resolver, domain, port=options["smtp_port"])
+        except dns.DNSException as e:
+            log.error(f"{domain}: {e}")
+            return e
+
+    def deliver(
+        recipients: List[str], hosts: Iterable[smtp.SMTPHost]
+    ) -> List[smtptester.Result]:
+        tester = smtptester.SMTPTester(
+            recipient=recipients,
+            resolver=resolver,
+            hosts=hosts,
+            timeouts=timeouts,
+            **options,
+        )
+        return tester.run_all(cancel=cancel, deadline=deadline)
+
+    def error(recipients: List[str], e: dns.DNSException) -> List[smtptester.Result]:
+        results = [
+            smtptester.Result(r, smtptester.RESULT_ERROR, message=str(e))
+            for r in recipients
+        ]
+        if options.get("results_sink") is not None:
+            for result in results:
+                options["results_sink"].write_result(result)
+        return results
+
+    size = max(options.get("smtp_max_recipients", smtp.SMTP_DEFAULT_MAX_RECIPIENTS), 1)
+    limit = workers * BATCH_PENDING_PER_WORKER
+    domains = iter(groups)
+    exhausted = False
+    fixed_hosts: Union[Iterable[smtp.SMTPHost], dns.DNSException, None] = None
+    lookups: Dict[concurrent.futures.Future, str] = {}
+    deliveries: Set[concurrent.futures.Future] = set()
+    by_hosts: Dict[Tuple[smtp.SMTPHost, ...], List[str]] = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        # Domains that share the same MX hosts are delivered together, in
+        # transactions of up to smtp_max_recipients recipients. Each
+        # transaction starts as soon as it's full, so deliveries don't wait
+        # for every domain to be looked up.
+        def add(domain: str, hosts: Union[Iterable[smtp.SMTPHost], dns.DNSException]):
+            if isinstance(hosts, dns.DNSException):
+                deliveries.add(pool.submit(error, groups[domain], hosts))
+                return
+            key = tuple(hosts)
+            pending = by_hosts.setdefault(key, [])
+            pending.extend(groups[domain])
+            while len(pending) >= size:
+                deliveries.add(pool.submit(deliver, pending[:size], key))
+                del pending[:size]
+
+        if options["smtp_host"]:
+            fixed_hosts = discover("")
+        try:
+            while True:
+                # Only limit jobs are in flight, so lookups don't swamp the pool.
+                while not exhausted and len(lookups) + len(deliveries) < limit:
+                    domain = next(domains, None)
+                    if domain is None:
+                        exhausted = True
+                    elif fixed_hosts is not None:
+                        add(domain, fixed_hosts)
+                    else:
+                        lookups[pool.submit(discover, domain)] = domain
+                if exhausted and not lookups:
+                    for key, recipients in by_hosts.items():
+                        if recipients:
+                            deliveries.add(pool.submit(deliver, recipients, key))
+                    by_hosts.clear()
+                    if not deliveries:
+                        break
+                done, _ = concurrent.futures.wait(
+                    set(lookups) | deliveries,
+                    return_when=concurrent.futures.FIRST_COMPLETED,
+                )
+                for f in done:
+                    if f in lookups:
+                        add(lookups.pop(f), f.result())
+                    else:
+                        deliveries.discard(f)
+                        yield from f.result()
+        except (KeyboardInterrupt, GeneratorExit):
+            # Runs in progress are cancelled before the pool waits for them.
+            if cancel is not None:
+                cancel.cancel()
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    log.info(f"DNS cache: {resolver.cache.hits} hits, {resolver.cache.misses} misses")
+    resolver.cache.save()
+    resolver.close()
+    if timeouts is not None:
+        timeouts.save()
@@ -0,0 +1,119 @@
+import abc
+import mmap
+import os
+import re
+from typing import Iterable, Iterator, Union
+
+
+BODY_CHUNK_SIZE = 64 * 1024
+
+NEWLINE = re.compile(rb"\r\n|\r|\n")
+
+
+class MessageBody(abc.ABC):
+    @property
+    @abc.abstractmethod
+    def size(self) -> int:
+        pass
+
+    @abc.abstractmethod
+    def chunks(self, size: int = BODY_CHUNK_SIZE) -> Iterator[bytes]:
+        pass
+
+
+class BytesBody(MessageBody):
+    def __init__(self, data: bytes):
+        self.data = data
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    def chunks(self, size: int = BODY_CHUNK_SIZE) -> Iterator[bytes]:
+        view = memoryview(self.data)
+        for i in range(0, len(view), size):
+            yield bytes(view[i : i + size])
+
+
+class FileBody(MessageBody):
+    def __init__(self, path: str, use_mmap: bool = False):
+        self.path = path
+        self.use_mmap = use_mmap
+
+    def __repr__(self) -> str:
+        return f"FileBody({self.path!r}, use_mmap={self.use_mmap!r})"
+
+    @property
+    def size(self) -> int:
+        return os.path.getsize(self.path)
+
+    def chunks(self, size: int = BODY_CHUNK_SIZE) -> Iterator[bytes]:
+        with open(self.path, "rb") as f:
+            if self.use_mmap and self.size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    for i in range(0, len(m), size):
+                        yield m[i : i + size]
+            else:
+                for chunk in iter(lambda: f.read(size), b""):
+                    yield chunk
+
+
+class PrefixedBody(MessageBody):
+    def __init__(self, prefix: str, message: MessageBody):
+        self.prefix = prefix.encode("utf-8")
+        self.message = message
+
+    @property
+    def size(self) -> int:
+        return len(self.prefix) + self.message.size
+
+    def chunks(self, size: int = BODY_CHUNK_SIZE) -> Iterator[bytes]:
+        yield self.prefix
+        yield from self.message.chunks(size)
+
+
+class DotStuffer:
+    def __init__(self, stuff: bool = True):
+        self.stuff = stuff
+        self.line_start = True
+        self.cr = False
+
+    def feed(self, chunk: bytes) -> bytes:
+        # A CRLF split across two chunks was already written out as a line
+        # ending when the CR was seen.
+        if self.cr and chunk.startswith(b"\n"):
+            chunk = chunk[1:]
+            self.cr = False
+        if not chunk:
+            return b""
+        self.cr = chunk.endswith(b"\r")
+        data = NEWLINE.sub(b"\r\n", chunk)
+        if self.stuff:
+            data = data.replace(b"\r\n.", b"\r\n..")
+            if self.line_start and data.startswith(b"."):
+                data = b"." + data
+        self.line_start = data.endswith(b"\r\n")
+        return data
+
+    def finish(self) -> bytes:
+        end = b"" if self.line_start else b"\r\n"
+        return end + b".\r\n" if self.stuff else end
+
+
+def encode(chunks: Iterable[bytes], stuff: bool = True) -> Iterator[bytes]:
+    stuffer = DotStuffer(stuff=stuff)
+    for chunk in chunks:
+        data = stuffer.feed(chunk)
+        if data:
+            yield data
+    data = stuffer.finish()
+    if data:
+        yield data
+
+
+def message_body(message: Union[str, bytes, MessageBody]) -> MessageBody:
+    if isinstance(message, MessageBody):
+        return message
+    if isinstance(message, str):
+        message = message.encode("utf-8")
+    return BytesBody(message)
@@ -1,10 +1,20 @@
 import argparse
+import contextlib
+import itertools
 import logging
-from typing import Iterable, Union
+import os
+import sys
+import time
+from typing import Iterable, List, TextIO, Union
 
 import smtptester
+import smtptester.batch as batch
+import smtptester.body as body
 import smtptester.dns as dns
+import smtptester.rto as rto
+import smtptester.sink as sink
 import smtptester.smtp as smtp
+import smtptester.util as util
 
 
 class Options(argparse.Namespace):
@@ -12,7 +22,11 @@ class Options(argparse.Namespace):
 
 
 def parse(args: Union[Iterable[str], None] = None, interface: str = "") -> Options:
+    prog = os.path.basename(sys.argv[0])
+    if interface in COMMANDS:
+        prog = f"{prog} {interface}"
     parser = argparse.ArgumentParser(
+        prog=prog,
         add_help=False,
         epilog=f"{smtptester.META['Author']} <{smtptester.META['Author-email']}>",
     )
@@ -36,33 +50,321 @@ def parse(args: Union[Iterable[str], None] = None, interface: str = "") -> Optio
     )
 
     if interface == "cli":
+        parser.add_argument("recipients", nargs="*", help="recipient email addresses")
+        parser.add_argument(
+            "-f",
+            "--recipients-file",
+            type=argparse.FileType("r"),
+            help="file with one recipient per line ('-' for stdin)",
+        )
+        parser.add_argument(
+            "-w", "--workers", type=int, default=batch.BATCH_DEFAULT_WORKERS
+        )
+        parser.add_argument(
+            "--deadline",
+            type=float,
+            default=0.0,
+            help="seconds allowed for the whole run, however many hosts are tried",
+        )
+        parser.add_argument(
+            "--record",
+            metavar="FILE",
+            help="save DNS answers and SMTP transcripts to FILE for 'replay'",
+        )
+        _add_message_arguments(parser)
+        _add_output_arguments(parser)
+        _add_dns_arguments(parser)
+        _add_smtp_arguments(parser)
+        _add_strategy_arguments(parser)
+        _add_timeout_arguments(parser)
+        parser.add_argument(
+            "--smtp-max-recipients",
+            type=int,
+            default=smtp.SMTP_DEFAULT_MAX_RECIPIENTS,
+            help="maximum recipients per SMTP transaction",
+        )
+
+    elif interface == "load":
+        import smtptester.load as load
+
         parser.add_argument("recipient", help="recipient email address")
-        parser.add_argument("-s", "--sender", default=smtp.SMTP_DEFAULT_SENDER)
-        parser.add_argument("-m", "--message", default=smtp.SMTP_DEFAULT_MESSAGE)
+        parser.add_argument(
+            "-r",
+            "--rate",
+            type=float,
+            default=load.LOAD_DEFAULT_RATE,
+            help="messages per second",
+        )
+        parser.add_argument(
+            "-t",
+            "--duration",
+            type=float,
+            default=load.LOAD_DEFAULT_DURATION,
+            help="seconds",
+        )
+        parser.add_argument(
+            "-c",
+            "--concurrency",
+            type=int,
+            default=load.LOAD_DEFAULT_CONCURRENCY,
+            help="maximum messages in flight",
+        )
+        parser.add_argument(
+            "--reuse",
+            action="store_true",
+            help="reuse SMTP connections between messages",
+        )
+        _add_message_arguments(parser)
+        _add_output_arguments(parser)
+        _add_dns_arguments(parser)
+        _add_smtp_arguments(parser)
 
-        parser.add_argument("-d", "--dns-host")
-        parser.add_argument("--dns-port", type=int, default=dns.DNS_DEFAULT_PORT)
-        parser.add_argument("--dns-timeout", type=int, default=dns.DNS_DEFAULT_TIMEOUT)
-        parser.add_argument("--dns-proto", choices=dns.DNS_PROTOCOL_CHOICES)
+    elif interface == "verify":
+        import smtptester.verify as verify
 
-        parser.add_argument("-h", "--smtp-host")
-        parser.add_argument("--smtp-port", type=int, default=smtp.SMTP_DEFAULT_PORT)
+        parser.add_argument("recipients", nargs="*", help="recipient email addresses")
         parser.add_argument(
-            "--smtp-timeout", type=int, default=smtp.SMTP_DEFAULT_TIMEOUT
+            "-f",
+            "--recipients-file",
+            type=argparse.FileType("r"),
+            help="file with one recipient per line ('-' for stdin)",
+        )
+        parser.add_argument(
+            "-c",
+            "--concurrency",
+            type=int,
+            default=verify.VERIFY_DEFAULT_CONCURRENCY,
+            help="maximum recipients checked at once",
+        )
+        parser.add_argument(
+            "--connections-per-host",
+            type=int,
+            default=verify.VERIFY_DEFAULT_CONNECTIONS_PER_HOST,
+            help="maximum connections to each SMTP host",
+        )
+        parser.add_argument(
+            "-s", "--sender", default="", help="defaults to user@this host's FQDN"
+        )
+        _add_output_arguments(parser)
+        _add_dns_arguments(parser)
+        _add_smtp_arguments(parser)
+
+    elif interface == "monitor":
+        import smtptester.monitor as monitor
+
+        parser.add_argument(
+            "targets", nargs="+", help="recipient email addresses to probe"
+        )
+        parser.add_argument(
+            "-i",
+            "--interval",
+            type=float,
+            default=monitor.MONITOR_DEFAULT_INTERVAL,
+            help="seconds between probes of each target",
+        )
+        parser.add_argument(
+            "--jitter",
+            type=float,
+            default=monitor.MONITOR_DEFAULT_JITTER,
+            help="random variation of the interval, as a fraction",
+        )
+        parser.add_argument(
+            "--metrics-address",
+            default=monitor.MONITOR_DEFAULT_ADDRESS,
+            help="address to serve /metrics on",
         )
-        parser.add_argument("--smtp-helo", default=smtp.SMTP_DEFAULT_HELO)
         parser.add_argument(
-            "--smtp-tls", choices=smtp.SMTP_TLS_CHOICES, default=smtp.SMTP_DEFAULT_TLS
+            "--metrics-port",
+            type=int,
+            default=monitor.MONITOR_DEFAULT_PORT,
+            help="port to serve /metrics on",
         )
-        parser.add_argument("-u", "--smtp-auth-user")
-        parser.add_argument("-p", "--smtp-auth-pass")
+        _add_message_arguments(parser)
+        _add_output_arguments(parser)
+        _add_dns_arguments(parser)
+        _add_smtp_arguments(parser)
+        _add_strategy_arguments(parser)
+        _add_timeout_arguments(parser)
+
+    elif interface == "history":
+        import smtptester.history as history
+
+        parser.add_argument(
+            "history_file", metavar="FILE", help="database written by --history-file"
+        )
+        parser.add_argument(
+            "--since",
+            type=history.parse_duration,
+            default=history.HISTORY_DEFAULT_SINCE,
+            help="how far back to look, e.g. 12h, 7d or 4w (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--window",
+            type=history.parse_duration,
+            default=history.HISTORY_DEFAULT_WINDOW,
+            help="time covered by each row, in multiples of 5m (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--phase",
+            default=history.HISTORY_DEFAULT_PHASE,
+            help="SMTP phase to report latency for (default: the whole attempt)",
+        )
+        parser.add_argument("--host", default="", help="SMTP host name or address")
+
+    elif interface == "replay":
+        import smtptester.replay as replay
+
+        parser.add_argument("capture", metavar="FILE", help="file written by --record")
+        parser.add_argument(
+            "--time-scale",
+            type=float,
+            default=replay.REPLAY_DEFAULT_TIME_SCALE,
+            help="multiply recorded delays by this, e.g. 0.5 to replay twice as fast",
+        )
+        parser.add_argument(
+            "--serve",
+            action="store_true",
+            help="only run the stand-in DNS and SMTP servers until interrupted",
+        )
+        parser.add_argument("--dns-timeout", type=int, default=dns.DNS_DEFAULT_TIMEOUT)
+        parser.add_argument(
+            "--smtp-timeout", type=int, default=smtp.SMTP_DEFAULT_TIMEOUT
+        )
+        _add_output_arguments(parser)
+        _add_strategy_arguments(parser)
+        _add_timeout_arguments(parser)
 
     elif interface == "gui":
         parser.add_argument(
             "--defaults", action="store_true", help="reset to default settings"
         )
+        parser.add_argument(
+            "--log-max-lines",
+            type=int,
+            help="lines kept in the results pane (default: 10000)",
+        )
+
+    options = parser.parse_args(args, namespace=Options())
+    if interface in ("cli", "verify") and not (
+        options.recipients or options.recipients_file
+    ):
+        parser.error("a recipient or --recipients-file is required")
+    return options
+
+
+def _add_message_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-s", "--sender", default="", help="defaults to user@this host's FQDN"
+    )
+    message_group = parser.add_mutually_exclusive_group()
+    message_group.add_argument("-m", "--message", default=smtp.SMTP_DEFAULT_MESSAGE)
+    message_group.add_argument(
+        "--message-file", metavar="FILE", help="read the message from an .eml file"
+    )
+    parser.add_argument(
+        "--message-mmap",
+        action="store_true",
+        help="memory-map --message-file instead of reading it in chunks",
+    )
+
+
+def _add_output_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-o",
+        "--results-file",
+        metavar="FILE",
+        help="append one JSON record per attempt to FILE ('-' for stdout)",
+    )
+    parser.add_argument(
+        "--history-file",
+        metavar="FILE",
+        help="record every attempt in a SQLite database (see 'history')",
+    )
+
+
+def _add_dns_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "-d",
+        "--dns-host",
+        action="append",
+        help="nameserver to query (may be given more than once)",
+    )
+    parser.add_argument("--dns-port", type=int, default=dns.DNS_DEFAULT_PORT)
+    parser.add_argument("--dns-timeout", type=int, default=dns.DNS_DEFAULT_TIMEOUT)
+    parser.add_argument(
+        "--dns-proto",
+        choices=dns.DNS_PROTOCOL_CHOICES,
+        help="tcp and tls keep one connection open per nameserver",
+    )
+    parser.add_argument(
+        "--dns-cache", default="", help="file used to persist the DNS cache"
+    )
+    parser.add_argument(
+        "--dns-race",
+        action="store_true",
+        help="query the two fastest nameservers at once",
+    )
+
+
+def _add_smtp_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("-h", "--smtp-host")
+    parser.add_argument("--smtp-port", type=int, default=smtp.SMTP_DEFAULT_PORT)
+    parser.add_argument("--smtp-timeout", type=int, default=smtp.SMTP_DEFAULT_TIMEOUT)
+    parser.add_argument("--smtp-helo", default="", help="defaults to this host's FQDN")
+    parser.add_argument(
+        "--smtp-tls", choices=smtp.SMTP_TLS_CHOICES, default=smtp.SMTP_DEFAULT_TLS
+    )
+    parser.add_argument(
+        "--smtp-tls-ca-file", help="verify certificates against this CA bundle"
+    )
+    parser.add_argument("--smtp-tls-min-version", choices=smtp.SMTP_TLS_VERSION_CHOICES)
+    parser.add_argument("--smtp-tls-ciphers", help="OpenSSL cipher list")
+    parser.add_argument(
+        "--smtp-no-pipelining",
+        dest="smtp_pipelining",
+        action="store_false",
+        help="wait for each reply even if the server supports PIPELINING",
+    )
+    parser.add_argument("-u", "--smtp-auth-user")
+    parser.add_argument("-p", "--smtp-auth-pass")
+
+
+def _add_strategy_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--smtp-strategy",
+        choices=smtp.SMTP_STRATEGY_CHOICES,
+        default=smtp.SMTP_DEFAULT_STRATEGY,
+        help="try MX hosts one at a time or race them",
+    )
+    parser.add_argument(
+        "--smtp-stagger",
+        type=float,
+        default=smtp.SMTP_DEFAULT_STAGGER,
+        help="seconds to wait before racing the next MX host",
+    )
+
 
-    return parser.parse_args(args, namespace=Options())
+def _add_timeout_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--adaptive-timeouts",
+        action="store_true",
+        help="derive timeouts from measured round trip times",
+    )
+    parser.add_argument(
+        "--timeouts-file", default="", help="file used to persist round trip times"
+    )
+    parser.add_argument(
+        "--timeout-min",
+        type=float,
+        default=rto.RTO_DEFAULT_MIN,
+        help="lower bound for adaptive timeouts in seconds",
+    )
+    parser.add_argument(
+        "--timeout-max",
+        type=float,
+        default=rto.RTO_DEFAULT_MAX,
+        help="upper bound for adaptive timeouts in seconds",
+    )
 
 
 def options_list(
@@ -77,26 +379,304 @@ def options_list(
     return ", ".join(options_list)
 
 
-def main():
-    o = parse(interface="cli")
+def main(args: Union[Iterable[str], None] = None) -> int:
+    args = sys.argv[1:] if args is None else list(args)
+    interface = "cli"
+    if args and args[0] in COMMANDS:
+        interface, args = args[0], args[1:]
+    o = parse(args, interface=interface)
 
     log_format = "[%(levelname)s] %(message)s"
     log_level = getattr(logging, o.log_level.upper())
     logging.basicConfig(format=log_format, level=log_level)
 
-    smtptester.SMTPTester(
-        recipient=o.recipient,
+    return COMMANDS.get(interface, _main_cli)(o)
+
+
+def _main_cli(o: Options) -> int:
+    options = _tester_options(o)
+    options["smtp_max_recipients"] = o.smtp_max_recipients
+    deadline = time.monotonic() + o.deadline if o.deadline else 0.0
+    # Ctrl+C cancels runs in progress through the token, rather than waiting
+    # for them to finish.
+    cancel = util.CancelToken()
+    with _results_sink(o) as results_sink, _recording(o) as recorder:
+        options["results_sink"] = results_sink
+        options["recorder"] = recorder
+        if o.recipients_file:
+            recipients = batch.read_recipients(o.recipients_file)
+            recipients = itertools.chain(o.recipients, recipients)
+            results = batch.run(
+                recipients,
+                workers=o.workers,
+                cancel=cancel,
+                deadline=deadline,
+                **options,
+            )
+            try:
+                for r in results:
+                    _print_result(o, r)
+            except KeyboardInterrupt:
+                cancel.cancel()
+                results.close()
+                logging.info("Run cancelled")
+                return 130
+        elif len(o.recipients) > 1:
+            tester = smtptester.SMTPTester(recipient=o.recipients, **options)
+            for r in tester.run_all(cancel=cancel, deadline=deadline):
+                _print_result(o, r)
+        else:
+            tester = smtptester.SMTPTester(recipient=o.recipients[0], **options)
+            tester.run(cancel=cancel, deadline=deadline)
+    return 0
+
+
+def _main_monitor(o: Options) -> int:
+    import smtptester.monitor as monitor
+
+    with _results_sink(o) as results_sink:
+        monitor.run(
+            o.targets,
+            interval=o.interval,
+            jitter=o.jitter,
+            address=o.metrics_address,
+            port=o.metrics_port,
+            results_sink=results_sink,
+            **_tester_options(o),
+        )
+    return 0
+
+
+def _tester_options(o: Options) -> dict:
+    return dict(
         sender=o.sender,
-        message=o.message,
+        message=_message(o),
         dns_host=o.dns_host,
         dns_port=o.dns_port,
         dns_timeout=o.dns_timeout,
         dns_proto=o.dns_proto,
+        dns_cache=o.dns_cache,
+        dns_race=o.dns_race,
         smtp_host=o.smtp_host,
         smtp_port=o.smtp_port,
         smtp_timeout=o.smtp_timeout,
         smtp_helo=o.smtp_helo,
         smtp_tls=o.smtp_tls,
+        smtp_tls_ca_file=o.smtp_tls_ca_file,
+        smtp_tls_min_version=o.smtp_tls_min_version,
+        smtp_tls_ciphers=o.smtp_tls_ciphers,
+        smtp_pipelining=o.smtp_pipelining,
         smtp_auth_user=o.smtp_auth_user,
         smtp_auth_pass=o.smtp_auth_pass,
-    ).run()
+        smtp_strategy=o.smtp_strategy,
+        smtp_stagger=o.smtp_stagger,
+        adaptive_timeouts=o.adaptive_timeouts,
+        timeouts_file=o.timeouts_file,
+        timeout_min=o.timeout_min,
+        timeout_max=o.timeout_max,
+    )
+
+
+def _print_result(o: Options, r: "smtptester.Result"):
+    host = smtp.log_host(r.host) if r.host else ""
+    line = "\t".join([r.recipient, r.outcome, host, r.message])
+    print(line, file=_report_file(o), flush=True)
+
+
+def _report_file(o: Options) -> TextIO:
+    # With --results-file -, stdout is kept for JSON Lines alone.
+    return sys.stderr if o.results_file == "-" else sys.stdout
+
+
+def _message(o: Options) -> Union[str, body.MessageBody]:
+    if o.message_file:
+        return body.FileBody(o.message_file, use_mmap=o.message_mmap)
+    return o.message
+
+
+def _results_sink(o: Options):
+    sinks: List[sink.ResultsSink] = []
+    if o.results_file:
+        sinks.append(sink.JSONLinesSink(o.results_file))
+    if o.history_file:
+        import smtptester.history as history
+
+        sinks.append(history.HistoryStore(o.history_file))
+    if len(sinks) > 1:
+        return sink.MultiSink(*sinks)
+    return sinks[0] if sinks else contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def _recording(o: Options):
+    if not o.record:
+        yield None
+        return
+    import smtptester.replay as replay
+
+    recorder = replay.Capture()
+    try:
+        yield recorder
+    finally:
+        recorder.save(o.record)
+
+
+def _resolver(o: Options) -> dns.DNSResolver:
+    return dns.DNSResolver(
+        host=o.dns_host,
+        port=o.dns_port,
+        timeout=o.dns_timeout,
+        protocol=o.dns_proto,
+        cache_path=o.dns_cache,
+        race=o.dns_race,
+    )
+
+
+def _tls_context(o: Options) -> smtp.TLSContext:
+    return smtp.make_tls_context(
+        ca_file=o.smtp_tls_ca_file or "",
+        min_version=o.smtp_tls_min_version or "",
+        ciphers=o.smtp_tls_ciphers or "",
+    )
+
+
+def _hosts(o: Options, resolver: dns.DNSResolver) -> Iterable[smtp.SMTPHost]:
+    if o.smtp_host:
+        return smtp.hosts_set(resolver, o.smtp_host, port=o.smtp_port)
+    domain = util.parse_email_address(o.recipient).domain
+    return smtp.hosts_discover(resolver, domain, port=o.smtp_port)
+
+
+def _main_load(o: Options) -> int:
+    import smtptester.load as load
+
+    resolver = _resolver(o)
+    try:
+        host = _hosts(o, resolver)[0]
+    except dns.DNSException as e:
+        logging.error(e)
+        return 1
+    finally:
+        resolver.cache.save()
+        resolver.close()
+
+    with _results_sink(o) as results_sink:
+        report = load.run(
+            host,
+            o.recipient,
+            rate=o.rate,
+            duration=o.duration,
+            concurrency=o.concurrency,
+            reuse=o.reuse,
+            sender=o.sender,
+            message=_message(o),
+            timeout=o.smtp_timeout,
+            helo=o.smtp_helo,
+            tls=o.smtp_tls,
+            auth_user=o.smtp_auth_user,
+            auth_pass=o.smtp_auth_pass,
+            tls_context=_tls_context(o),
+            pipelining=o.smtp_pipelining,
+            results_sink=results_sink,
+        )
+    for line in load.report_lines(report):
+        print(line, file=_report_file(o))
+    return 0 if report.accepted == report.sent else 1
+
+
+def _main_verify(o: Options) -> int:
+    import smtptester.verify as verify
+
+    recipients = iter(o.recipients)
+    if o.recipients_file:
+        recipients = itertools.chain(
+            recipients, batch.read_recipients(o.recipients_file)
+        )
+    resolver = _resolver(o)
+    results = verify.run(
+        recipients,
+        resolver,
+        concurrency=o.concurrency,
+        sender=o.sender,
+        smtp_host=o.smtp_host,
+        smtp_port=o.smtp_port,
+        timeout=o.smtp_timeout,
+        helo=o.smtp_helo,
+        tls=o.smtp_tls,
+        auth_user=o.smtp_auth_user,
+        auth_pass=o.smtp_auth_pass,
+        tls_context=_tls_context(o),
+        pipelining=o.smtp_pipelining,
+        connections_per_host=o.connections_per_host,
+    )
+    try:
+        with _results_sink(o) as results_sink:
+            for r in results:
+                _print_result(o, r)
+                if results_sink is not None:
+                    results_sink.write_result(r)
+    finally:
+        resolver.cache.save()
+        resolver.close()
+    return 0
+
+
+def _main_history(o: Options) -> int:
+    import smtptester.history as history
+
+    try:
+        trends = history.trends(
+            o.history_file,
+            since=o.since,
+            window=o.window,
+            phase=o.phase,
+            host=o.host,
+        )
+    except history.HistoryError as e:
+        logging.error(e)
+        return 1
+    for line in history.trend_lines(trends):
+        print(line)
+    return 0
+
+
+def _main_replay(o: Options) -> int:
+    import smtptester.replay as replay
+
+    if o.serve:
+        try:
+            replay.serve(o.capture, time_scale=o.time_scale)
+        except replay.ReplayError as e:
+            logging.error(e)
+            return 1
+        return 0
+    with _results_sink(o) as results_sink:
+        try:
+            results = replay.run(
+                o.capture,
+                time_scale=o.time_scale,
+                dns_timeout=o.dns_timeout,
+                smtp_timeout=o.smtp_timeout,
+                smtp_strategy=o.smtp_strategy,
+                smtp_stagger=o.smtp_stagger,
+                adaptive_timeouts=o.adaptive_timeouts,
+                timeouts_file=o.timeouts_file,
+                timeout_min=o.timeout_min,
+                timeout_max=o.timeout_max,
+                results_sink=results_sink,
+            )
+        except replay.ReplayError as e:
+            logging.error(e)
+            return 1
+    for r in results:
+        _print_result(o, r)
+    return 0
+
+
+COMMANDS = {
+    "load": _main_load,
+    "verify": _main_verify,
+    "monitor": _main_monitor,
+    "history": _main_history,
+    "replay": _main_replay,
+}
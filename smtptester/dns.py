@@ -1,13 +1,34 @@
+import asyncio
+import collections
+import json
 import logging
-from typing import Iterable, NamedTuple
+import os
+import random
+import re
+import ssl
+import struct
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 
-import dns.resolver as resolver
+import smtptester.replay as replay
+import smtptester.rto as rto
+import smtptester.util as util
 
 
 DNS_DEFAULT_PORT = 53
 DNS_DEFAULT_TIMEOUT = 3
-DNS_PROTOCOL_CHOICES = ("udp", "tcp")
+DNS_PROTOCOL_CHOICES = ("udp", "tcp", "tls")
 DNS_DEFAULT_PROTOCOL = "udp"
+DNS_DEFAULT_TLS_PORT = 853
+DNS_DEFAULT_STAGGER = 1.0
+DNS_RACE_SIZE = 2
+DNS_SRTT_WEIGHT = 0.3
+DNS_SRTT_DECAY = 0.98
+DNS_CACHE_DEFAULT_SIZE = 10000
+DNS_CACHE_NEGATIVE_TTL = 300
+DNS_SOURCE_NETWORK = "network"
+DNS_SOURCE_CACHE = "cache"
+DNS_SOURCE_GLUE = "glue"
 
 log = logging.getLogger(__name__)
 
@@ -23,61 +44,573 @@ class MXRecord(NamedTuple):
     preference: int = 0
 
 
+class DNSAnswer(NamedTuple):
+    records: List[str]
+    glue: Dict[str, List[str]] = {}
+
+
+class DNSTiming(NamedTuple):
+    name: str
+    rdtype: str
+    source: str
+    duration: float
+
+
+class DNSCacheEntry(NamedTuple):
+    expires: float
+    records: List[str]
+    error: str = ""
+    message: str = ""
+
+
+class DNSCache:
+    def __init__(self, size: int = DNS_CACHE_DEFAULT_SIZE, path: str = ""):
+        self.size = size
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.entries: Dict[Tuple[str, str], DNSCacheEntry] = collections.OrderedDict()
+        if path:
+            self.load()
+
+    def get(self, qname: str, rdtype: str) -> Optional[DNSCacheEntry]:
+        key = (qname.lower().rstrip("."), rdtype)
+        entry = self.entries.get(key)
+        if entry is None or entry.expires <= time.monotonic():
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(
+        self,
+        qname: str,
+        rdtype: str,
+        ttl: int,
+        records: List[str] = [],
+        error: str = "",
+        message: str = "",
+    ):
+        if ttl <= 0 or self.size <= 0:
+            return
+        key = (qname.lower().rstrip("."), rdtype)
+        expires = time.monotonic() + ttl
+        self.entries[key] = DNSCacheEntry(expires, list(records), error, message)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring DNS cache file: {self.path} ({e})")
+            return
+        offset = time.monotonic() - time.time()
+        for qname, rdtype, expires, records, error, message in data:
+            ttl = expires + offset - time.monotonic()
+            self.put(qname, rdtype, ttl, records, error, message)
+        log.debug(f"Loaded {len(self.entries)} DNS cache entries from: {self.path}")
+
+    def save(self):
+        if not self.path:
+            return
+        now = time.monotonic()
+        offset = time.time() - now
+        data = [
+            [qname, rdtype, e.expires + offset, e.records, e.error, e.message]
+            for (qname, rdtype), e in self.entries.items()
+            if e.expires > now
+        ]
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.warning(f"Unable to save DNS cache file: {self.path} ({e})")
+            return
+        log.debug(f"Saved {len(data)} DNS cache entries to: {self.path}")
+
+
+class DNSConnection:
+    def __init__(
+        self,
+        host: str,
+        port: int = DNS_DEFAULT_PORT,
+        tls_context: Optional[ssl.SSLContext] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.tls_context = tls_context
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.receiver: Optional[asyncio.Future] = None
+        self.lock: Optional[asyncio.Lock] = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.connects = 0
+        self.queries = 0
+
+    async def query(self, request: "dns.message.Message") -> "dns.message.Message":
+        # Servers may close idle connections at any time (RFC 7766), so a
+        # query that was sent on a reused connection is retried once.
+        reused = self.writer is not None
+        try:
+            return await self._query(request)
+        except ConnectionError:
+            if not reused:
+                raise
+            log.debug(f"DNS connection to {self.host}:{self.port} closed, retrying")
+            return await self._query(request)
+
+    async def close(self):
+        if self.receiver is not None:
+            self.receiver.cancel()
+            await asyncio.gather(self.receiver, return_exceptions=True)
+
+    async def _query(self, request: "dns.message.Message") -> "dns.message.Message":
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.writer is None:
+                await self._connect()
+            while request.id in self.pending:
+                request.id = random.getrandbits(16)
+            future = asyncio.get_running_loop().create_future()
+            self.pending[request.id] = future
+            wire = request.to_wire()
+            self.writer.write(struct.pack("!H", len(wire)) + wire)
+            self.queries += 1
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                self.pending.pop(request.id, None)
+                raise
+        try:
+            return await future
+        finally:
+            if self.pending.get(request.id) is future:
+                del self.pending[request.id]
+
+    async def _connect(self):
+        protocol = "TLS" if self.tls_context else "TCP"
+        log.debug(f"Connecting to DNS host: {self.host}:{self.port}({protocol})")
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host,
+            self.port,
+            ssl=self.tls_context,
+            server_hostname=self.host if self.tls_context else None,
+        )
+        self.connects += 1
+        self.receiver = asyncio.ensure_future(self._receive(self.reader, self.writer))
+
+    async def _receive(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        import dns.exception as exception
+        import dns.message as message
+
+        try:
+            while True:
+                (length,) = struct.unpack("!H", await reader.readexactly(2))
+                wire = await reader.readexactly(length)
+                (query_id,) = struct.unpack("!H", wire[:2])
+                future = self.pending.get(query_id)
+                if future is None or future.done():
+                    continue
+                try:
+                    future.set_result(message.from_wire(wire))
+                except exception.DNSException as e:
+                    future.set_exception(e)
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if self.writer is writer:
+                self.reader = self.writer = self.receiver = None
+            writer.close()
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError("DNS connection closed"))
+            self.pending.clear()
+
+
+class NameserverStats:
+    def __init__(self):
+        self.queries = 0
+        self.failures = 0
+        self.samples = 0
+        self.srtt = 0.0
+
+    def success(self, rtt: float):
+        self.queries += 1
+        self._sample(rtt)
+
+    def failure(self, penalty: float):
+        self.queries += 1
+        self.failures += 1
+        self._sample(penalty)
+
+    def lost(self, elapsed: float):
+        # A query that lost a race was at least this slow.
+        self.queries += 1
+        if elapsed > self.srtt:
+            self._sample(elapsed)
+
+    def decay(self):
+        # Servers that aren't being queried slowly look faster again, so one
+        # bad result doesn't exclude a server forever.
+        self.srtt *= DNS_SRTT_DECAY
+
+    def _sample(self, rtt: float):
+        if self.samples:
+            self.srtt += DNS_SRTT_WEIGHT * (rtt - self.srtt)
+        else:
+            self.srtt = rtt
+        self.samples += 1
+
+
 class DNSResolver:
     def __init__(
         self,
-        host: str = "",
+        host: Union[str, Iterable[str], None] = "",
         port: int = DNS_DEFAULT_PORT,
         timeout: int = DNS_DEFAULT_TIMEOUT,
         protocol: str = DNS_DEFAULT_PROTOCOL,
+        cache_size: int = DNS_CACHE_DEFAULT_SIZE,
+        cache_path: str = "",
+        tls_context: Optional[ssl.SSLContext] = None,
+        race: bool = False,
+        timeouts: Optional[rto.AdaptiveTimeouts] = None,
+        recorder: Optional[replay.Capture] = None,
     ):
-        self.resolver = resolver.Resolver()
-        if host:
-            self.resolver.nameservers = [host]
-        self.resolver.port = port
+        self.nameservers = nameservers(host)
+        if not self.nameservers:
+            # dnspython takes longer to import than the rest of the package, so
+            # it is only imported once there's something to resolve.
+            import dns.resolver as resolver
+
+            self.nameservers = [str(h) for h in resolver.Resolver().nameservers]
+        if protocol == "tls" and port == DNS_DEFAULT_PORT:
+            port = DNS_DEFAULT_TLS_PORT
+        if protocol == "tls" and tls_context is None:
+            tls_context = ssl.create_default_context()
+        self.port = port
         self.timeout = timeout
-        self.tcp = True if protocol == "tcp" else False
-        hosts = ", ".join(
-            f"{h}:{self.resolver.port}" for h in self.resolver.nameservers
-        )
+        self.protocol = protocol or DNS_DEFAULT_PROTOCOL
+        self.tls_context = tls_context
+        self.race = race
+        self.timeouts = timeouts
+        self.recorder = recorder
+        self.connections: Dict[str, DNSConnection] = {}
+        self.stats = {h: NameserverStats() for h in self.nameservers}
+        self.cache = DNSCache(size=cache_size, path=cache_path)
+        hosts = ", ".join(self._address(h) for h in self.nameservers)
         log.debug(f"Using DNS hosts: {hosts}")
 
-    def a(self, domain: str) -> Iterable[ARecord]:
+    def close(self):
+        util.run_sync(self.close_async())
+
+    async def close_async(self):
+        await util.gather(*(c.close() for c in self.connections.values()))
+        self.connections.clear()
+        for host, stats in self.stats.items():
+            if stats.queries:
+                log.debug(
+                    f"DNS host {self._address(host)}: {stats.queries} queries,"
+                    f" {stats.failures} failures, SRTT {stats.srtt * 1000:.1f}ms"
+                )
+
+    def a(
+        self, domain: str, timings: Optional[List[DNSTiming]] = None
+    ) -> Iterable[ARecord]:
+        return util.run_sync(self.a_async(domain, timings=timings))
+
+    def mx(
+        self, domain: str, timings: Optional[List[DNSTiming]] = None
+    ) -> Iterable[MXRecord]:
+        return util.run_sync(self.mx_async(domain, timings=timings))
+
+    async def a_async(
+        self, domain: str, timings: Optional[List[DNSTiming]] = None
+    ) -> Iterable[ARecord]:
         rs = []
-        for r in self._resolve(domain, "a"):
-            log.debug(f"Got answer: {r.address}")
-            rs.append(ARecord(name=domain, address=str(r.address).rstrip(".")))
+        for address in (await self._resolve(domain, "a", timings=timings)).records:
+            log.debug(f"Got answer: {address}")
+            rs.append(ARecord(name=domain, address=address.rstrip(".")))
         return rs
 
-    def mx(self, domain: str) -> Iterable[MXRecord]:
-        rs = []
-        for r in sorted(self._resolve(domain, "mx"), key=lambda r: r.preference):
-            log.debug(f"Got answer: {r.preference} {r.exchange}")
-            name = str(r.exchange).rstrip(".")
-            rs.append(
-                MXRecord(
-                    name=name, address=self.a(name)[0].address, preference=r.preference
-                )
-            )
+    async def mx_async(
+        self, domain: str, timings: Optional[List[DNSTiming]] = None
+    ) -> Iterable[MXRecord]:
+        timings = [] if timings is None else timings
+        started = time.monotonic()
+        answer = await self._resolve(domain, "mx", timings=timings)
+        exchanges = sorted(
+            (r.split(" ", 1) for r in answer.records), key=lambda r: int(r[0])
+        )
+        names = [exchange.rstrip(".") for _, exchange in exchanges]
+        for (preference, _), name in zip(exchanges, names):
+            log.debug(f"Got answer: {preference} {name}")
+
+        async def address(name: str) -> str:
+            glue = answer.glue.get(name.lower())
+            if glue:
+                timings.append(DNSTiming(name, "a", DNS_SOURCE_GLUE, 0.0))
+                return glue[0]
+            return (await self.a_async(name, timings=timings))[0].address
+
+        addresses = await util.gather(*(address(name) for name in names))
+        rs = [
+            MXRecord(name=name, address=address, preference=int(preference))
+            for (preference, _), name, address in zip(exchanges, names, addresses)
+        ]
+        log_timings = ", ".join(
+            f"{t.rdtype.upper()} {t.name} {t.duration * 1000:.1f}ms ({t.source})"
+            for t in timings
+        )
+        elapsed = (time.monotonic() - started) * 1000
+        log.debug(f"MX lookup for {domain} took {elapsed:.1f}ms: {log_timings}")
         return rs
 
-    def _resolve(self, qname: str, rdtype: str) -> resolver.Answer:
+    async def _resolve(
+        self, qname: str, rdtype: str, timings: Optional[List[DNSTiming]] = None
+    ) -> DNSAnswer:
+        started = time.monotonic()
+
+        def timed(source: str):
+            if timings is not None:
+                duration = time.monotonic() - started
+                timings.append(DNSTiming(qname, rdtype, source, duration))
+
+        def record(records: List[str], error: Optional[DNSException] = None):
+            if self.recorder is not None:
+                name = type(error).__name__ if error else ""
+                duration = time.monotonic() - started
+                self.recorder.dns(qname, rdtype, records, error=name, duration=duration)
+
+        entry = self.cache.get(qname, rdtype)
+        if entry is not None:
+            log.debug(f"Using cached {rdtype.upper()} records for: {qname}")
+            timed(DNS_SOURCE_CACHE)
+            if entry.error:
+                error = DNS_CACHE_ERRORS[entry.error](entry.message)
+                record([], error)
+                raise error
+            record(entry.records)
+            return DNSAnswer(records=entry.records)
+
+        import dns.rdatatype as rdatatype
+        import dns.resolver as resolver
+
+        if self.timeouts is None:
+            timeout = self.timeout
+        else:
+            timeout = sum(self._host_timeout(h) for h in self.nameservers)
         try:
             log.debug(f"Looking up {rdtype.upper()} records for: {qname}")
-            return self.resolver.resolve(
-                qname, rdtype, lifetime=self.timeout, tcp=self.tcp
+            answer = await asyncio.wait_for(
+                self._query_nameservers(qname, rdtype), timeout
             )
         except resolver.NoAnswer as e:
-            raise DNSNoRecords(e) from e
+            error = self._cache_error(qname, rdtype, DNSNoRecords(e), e)
+            record([], error)
+            raise error from e
         except resolver.NXDOMAIN as e:
-            raise DNSNoDomain(e) from e
-        except resolver.Timeout as e:
-            host = self.resolver.nameservers[0]
-            port = self.resolver.port
-            protocol = "TCP" if self.tcp else "UDP"
-            address = f"{host}:{port}({protocol})"
-            msg = f"DNS host failed: {address} Timeout={self.timeout}s"
-            raise DNSConnectionError(msg) from e
+            error = self._cache_error(qname, rdtype, DNSNoDomain(e), e)
+            record([], error)
+            raise error from e
+        except asyncio.TimeoutError as e:
+            hosts = ", ".join(self._address(h) for h in self.nameservers)
+            msg = f"DNS host failed: {hosts} Timeout={timeout:g}s"
+            error = DNSConnectionError(msg)
+            record([], error)
+            raise error from e
+        except DNSException as e:
+            record([], e)
+            raise
+        finally:
+            timed(DNS_SOURCE_NETWORK)
+
+        records = [r.to_text() for r in answer]
+        self.cache.put(qname, rdtype, answer.rrset.ttl, records)
+        record(records)
+        glue = {}
+        if rdtype == "mx":
+            exchanges = [r.exchange for r in answer]
+            for rrset in answer.response.additional:
+                if rrset.rdtype == rdatatype.A and rrset.name in exchanges:
+                    name = str(rrset.name).rstrip(".")
+                    glue[name.lower()] = [r.to_text() for r in rrset]
+                    self.cache.put(name, "a", rrset.ttl, glue[name.lower()])
+                    if self.recorder is not None:
+                        self.recorder.dns(name, "a", glue[name.lower()])
+        return DNSAnswer(records=records, glue=glue)
+
+    async def _query_nameservers(
+        self, qname: str, rdtype: str
+    ) -> "dns.resolver.Answer":
+        # Nameservers are tried fastest first. When racing, the two fastest
+        # are queried at once and the first valid answer wins. Otherwise the
+        # next server is only started if there's no answer after a stagger.
+        # With adaptive timeouts, the stagger is the server's own timeout.
+        import dns.exception as exception
+        import dns.resolver as resolver
+
+        queue = sorted(self.nameservers, key=lambda h: self.stats[h].srtt)
+        width = DNS_RACE_SIZE if self.race else 1
+        for host in queue[width:]:
+            self.stats[host].decay()
+
+        loop = asyncio.get_running_loop()
+        pending: Dict[asyncio.Future, Tuple[str, float]] = {}
+        error: Optional[Exception] = None
+        answered = False
+        stagger = DNS_DEFAULT_STAGGER
+
+        def start():
+            nonlocal stagger
+            host = queue.pop(0)
+            query = self._query_host(host, qname, rdtype)
+            if self.timeouts is not None:
+                stagger = self._host_timeout(host)
+                query = asyncio.wait_for(query, stagger)
+            pending[asyncio.ensure_future(query)] = (host, loop.time())
+
+        try:
+            while queue or pending:
+                while queue and len(pending) < width:
+                    start()
+                done, _ = await asyncio.wait(
+                    pending,
+                    timeout=stagger if queue else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    log.debug(f"No DNS answer after {stagger:g}s")
+                    start()
+                for task in done:
+                    host, started = pending.pop(task)
+                    try:
+                        answer = task.result()
+                    except (resolver.NXDOMAIN, resolver.NoAnswer):
+                        # An answer with no records is still an answer.
+                        self._answered(host, loop.time() - started)
+                        answered = True
+                        raise
+                    except asyncio.TimeoutError as e:
+                        log.debug(f"DNS host timed out: {self._address(host)}")
+                        self.stats[host].failure(self.timeout)
+                        if self.timeouts is not None:
+                            self.timeouts.backoff(self._key(host), self.timeout)
+                        error = e
+                        continue
+                    except (OSError, DNSResponseError, exception.DNSException) as e:
+                        log.debug(f"DNS host failed: {self._address(host)} ({e})")
+                        self.stats[host].failure(self.timeout)
+                        error = e
+                        continue
+                    self._answered(host, loop.time() - started)
+                    answered = True
+                    return answer
+        finally:
+            for task, (host, started) in pending.items():
+                task.cancel()
+                if answered:
+                    self.stats[host].lost(loop.time() - started)
+                else:
+                    self.stats[host].failure(self.timeout)
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        if isinstance(error, DNSResponseError):
+            raise error
+        hosts = ", ".join(self._address(h) for h in self.nameservers)
+        raise DNSConnectionError(f"DNS host failed: {hosts} {error}") from error
+
+    async def _query_host(
+        self, host: str, qname: str, rdtype: str
+    ) -> "dns.resolver.Answer":
+        import dns.asyncquery as asyncquery
+        import dns.message as message
+        import dns.name
+        import dns.rcode as rcode
+        import dns.resolver as resolver
+
+        name = dns.name.from_text(qname)
+        request = message.make_query(name, rdtype)
+        if self.protocol == "udp":
+            response, _ = await asyncquery.udp_with_fallback(
+                request, host, port=self.port
+            )
+        else:
+            # TCP and TLS queries share one persistent connection per
+            # nameserver, with responses matched to queries by ID.
+            connection = self.connections.get(host)
+            if connection is None:
+                connection = DNSConnection(host, self.port, self.tls_context)
+                self.connections[host] = connection
+            response = await connection.query(request)
+        if response.rcode() == rcode.NXDOMAIN:
+            raise resolver.NXDOMAIN(qnames=[name], responses={name: response})
+        if response.rcode() != rcode.NOERROR:
+            code = rcode.to_text(response.rcode())
+            raise DNSResponseError(f"DNS host {host} answered {code}")
+        answer = resolver.Answer(
+            name, request.question[0].rdtype, request.question[0].rdclass, response
+        )
+        if answer.rrset is None:
+            raise resolver.NoAnswer(response=response)
+        return answer
+
+    def _answered(self, host: str, rtt: float):
+        self.stats[host].success(rtt)
+        if self.timeouts is not None:
+            self.timeouts.sample(self._key(host), rtt)
+
+    def _host_timeout(self, host: str) -> float:
+        return self.timeouts.timeout(self._key(host), self.timeout)
+
+    def _key(self, host: str) -> str:
+        return f"dns {self._address(host)}"
+
+    def _address(self, host: str) -> str:
+        return f"{host}:{self.port}({self.protocol.upper()})"
+
+    def _cache_error(
+        self,
+        qname: str,
+        rdtype: str,
+        error: "DNSException",
+        cause: "dns.exception.DNSException",
+    ) -> "DNSException":
+        ttl = negative_ttl(cause)
+        name = type(error).__name__
+        self.cache.put(qname, rdtype, ttl, error=name, message=str(error))
+        return error
+
+
+def nameservers(hosts: Union[str, Iterable[str], None]) -> List[str]:
+    if isinstance(hosts, str):
+        hosts = [hosts]
+    return [h for hs in hosts or [] for h in re.split(r"[\s,]+", hs) if h]
+
+
+def negative_ttl(e: "dns.exception.DNSException") -> int:
+    import dns.rdatatype as rdatatype
+
+    if "responses" in e.kwargs:
+        responses = e.kwargs["responses"].values()
+    else:
+        responses = [e.kwargs.get("response")]
+    for response in responses:
+        for rrset in getattr(response, "authority", []):
+            if rrset.rdtype == rdatatype.SOA:
+                return min(rrset.ttl, rrset[0].minimum)
+    return DNS_CACHE_NEGATIVE_TTL
 
 
 class DNSException(Exception):
@@ -98,3 +631,6 @@ class DNSNoDomain(DNSResponseError):
 
 class DNSNoRecords(DNSResponseError):
     pass
+
+
+DNS_CACHE_ERRORS = {e.__name__: e for e in (DNSNoDomain, DNSNoRecords)}
@@ -0,0 +1,276 @@
+import asyncio
+import logging
+import ssl
+import struct
+from typing import Dict, List, Optional, Set, Tuple
+
+import dns.exception as exception
+import dns.message as message
+import dns.rcode as rcode
+import dns.rdatatype as rdatatype
+import dns.rrset as rrset
+
+
+FAKE_DEFAULT_ADDRESS = "127.0.0.1"
+FAKE_DNS_DEFAULT_TTL = 300
+FAKE_SMTP_DEFAULT_EXTENSIONS = ["AUTH PLAIN LOGIN"]
+
+log = logging.getLogger(__name__)
+
+
+class FakeDNSServer:
+    def __init__(
+        self,
+        records: Dict[Tuple[str, str], Optional[List[str]]] = {},
+        delay: float = 0.0,
+        ttl: int = FAKE_DNS_DEFAULT_TTL,
+        glue: bool = True,
+        address: str = FAKE_DEFAULT_ADDRESS,
+        tls_context: Optional[ssl.SSLContext] = None,
+        delays: Dict[Tuple[str, str], float] = {},
+    ):
+        # Names with records of None are never answered.
+        self.records = {
+            (n.lower().rstrip("."), t.lower()): r for (n, t), r in records.items()
+        }
+        self.delays = {
+            (n.lower().rstrip("."), t.lower()): d for (n, t), d in delays.items()
+        }
+        self.delay = delay
+        self.ttl = ttl
+        self.glue = glue
+        self.address = address
+        self.tls_context = tls_context
+        self.queries = 0
+        self.connections = 0
+        self.port = 0
+        self.writers: Set[asyncio.StreamWriter] = set()
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: _FakeDNSProtocol(self), local_addr=(self.address, self.port)
+        )
+        self.port = self.transport.get_extra_info("sockname")[1]
+        self.server = await asyncio.start_server(
+            self.handle_tcp, self.address, self.port, ssl=self.tls_context
+        )
+
+    async def stop(self):
+        self.transport.close()
+        self.server.close()
+        # Clients may hold their connections open between queries.
+        for writer in self.writers:
+            writer.close()
+        await self.server.wait_closed()
+
+    async def respond(self, wire: bytes) -> Optional[bytes]:
+        try:
+            query = message.from_wire(wire)
+        except exception.DNSException as e:
+            log.debug(f"Ignoring invalid DNS query: {e}")
+            return None
+        self.queries += 1
+        question = query.question[0]
+        qname = question.name.to_text().rstrip(".").lower()
+        rdtype = rdatatype.to_text(question.rdtype).lower()
+        delay = self.delays.get((qname, rdtype), self.delay)
+        if delay:
+            await asyncio.sleep(delay)
+        records = self.records.get((qname, rdtype))
+        if records is None and (qname, rdtype) in self.records:
+            return None
+        response = message.make_response(query)
+        if records:
+            answer = self._rrset(question.name.to_text(), rdtype, records)
+            response.answer.append(answer)
+            if rdtype == "mx" and self.glue:
+                for r in answer:
+                    name = r.exchange.to_text()
+                    glue = self.records.get((name.rstrip(".").lower(), "a"))
+                    if glue:
+                        response.additional.append(self._rrset(name, "a", glue))
+        elif not any(name == qname for name, _ in self.records):
+            response.set_rcode(rcode.NXDOMAIN)
+        return response.to_wire()
+
+    async def handle_tcp(self, reader, writer):
+        # Queries on a connection are answered concurrently, so with a delay
+        # the answers can come back in a different order (RFC 7766).
+        async def answer(query: bytes):
+            wire = await self.respond(query)
+            if wire is not None and not writer.is_closing():
+                writer.write(struct.pack("!H", len(wire)) + wire)
+
+        self.connections += 1
+        self.writers.add(writer)
+        tasks = []
+        try:
+            while True:
+                (length,) = struct.unpack("!H", await reader.readexactly(2))
+                query = await reader.readexactly(length)
+                tasks.append(asyncio.ensure_future(answer(query)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.writers.discard(writer)
+        writer.close()
+
+    def _rrset(self, name: str, rdtype: str, records: List[str]) -> rrset.RRset:
+        return rrset.from_text_list(name, self.ttl, "IN", rdtype, records)
+
+
+class _FakeDNSProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server: FakeDNSServer):
+        self.server = server
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        asyncio.ensure_future(self.reply(data, addr))
+
+    async def reply(self, data: bytes, addr: Tuple[str, int]):
+        wire = await self.server.respond(data)
+        if wire is not None and not self.transport.is_closing():
+            self.transport.sendto(wire, addr)
+
+
+class FakeSMTPServer:
+    def __init__(
+        self,
+        extensions: List[str] = FAKE_SMTP_DEFAULT_EXTENSIONS,
+        max_messages: int = 0,
+        delay: float = 0.0,
+        tls_context: Optional[ssl.SSLContext] = None,
+        address: str = FAKE_DEFAULT_ADDRESS,
+        mailboxes: Optional[List[str]] = None,
+    ):
+        self.extensions = extensions
+        self.max_messages = max_messages
+        self.delay = delay
+        self.tls_context = tls_context
+        self.address = address
+        self.mailboxes = None if mailboxes is None else {m.lower() for m in mailboxes}
+        self.messages: List[str] = []
+        self.recipients: List[str] = []
+        self.connections = 0
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(
+            self.handle, self.address, 0, ssl=self.tls_context
+        )
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    @property
+    def port(self) -> int:
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        # The delay models network latency rather than processing time: each
+        # reply is due a fixed time after its command arrived, so pipelined
+        # commands are answered after a single delay.
+        loop = asyncio.get_running_loop()
+        replies: asyncio.Queue = asyncio.Queue()
+
+        async def reply(*lines):
+            data = "".join(f"{line}\r\n" for line in lines).encode()
+            replies.put_nowait((loop.time() + self.delay, data))
+
+        async def send():
+            while True:
+                due, data = await replies.get()
+                if data is None:
+                    break
+                if due > loop.time():
+                    await asyncio.sleep(due - loop.time())
+                writer.write(data)
+                await writer.drain()
+
+        sender = asyncio.ensure_future(send())
+        self.connections += 1
+        messages = 0
+        recipients = 0
+        chunks: List[bytes] = []
+        try:
+            await reply("220 fake.test ESMTP")
+            while True:
+                line = (await reader.readline()).decode().rstrip("\r\n")
+                verb = line.split(" ")[0].upper()
+                if self.max_messages and messages >= self.max_messages:
+                    await reply("421 Too many messages")
+                    break
+                elif not line or verb == "QUIT":
+                    await reply("221 Bye")
+                    break
+                elif verb == "EHLO":
+                    lines = ["fake.test"] + self.extensions
+                    await reply(
+                        *(f"250-{line}" for line in lines[:-1]), f"250 {lines[-1]}"
+                    )
+                elif verb == "AUTH" and line.upper().startswith("AUTH LOGIN"):
+                    await reply("334 UGFzc3dvcmQ6")
+                    await reader.readline()
+                    await reply("235 Authenticated")
+                elif verb == "AUTH":
+                    await reply("235 Authenticated")
+                elif verb in ("MAIL", "RSET"):
+                    recipients = 0
+                    chunks = []
+                    await reply("250 OK")
+                elif verb == "RCPT" and "<reject" in line:
+                    await reply("550 No such user")
+                elif verb == "RCPT" and "<defer" in line:
+                    await reply("450 Try again later")
+                elif verb == "RCPT":
+                    address = line.partition("<")[2].rstrip(">").lower()
+                    self.recipients.append(address)
+                    if self.mailboxes is not None and address not in self.mailboxes:
+                        await reply("550 No such user")
+                    else:
+                        recipients += 1
+                        await reply("250 OK")
+                elif verb == "DATA" and not recipients:
+                    await reply("554 No valid recipients")
+                elif verb == "DATA":
+                    await reply("354 Go ahead")
+                    data = []
+                    while True:
+                        line = (await reader.readline()).decode()
+                        if line == ".\r\n" or not line:
+                            break
+                        data.append(line)
+                    self.messages.append("".join(data))
+                    messages += 1
+                    recipients = 0
+                    await reply("250 Queued")
+                elif verb == "BDAT":
+                    size, _, last = line[5:].partition(" ")
+                    chunks.append(await reader.readexactly(int(size)))
+                    if last.upper() != "LAST":
+                        await reply(f"250 {size} octets received")
+                    elif not recipients:
+                        chunks = []
+                        await reply("554 No valid recipients")
+                    else:
+                        self.messages.append(b"".join(chunks).decode())
+                        chunks = []
+                        messages += 1
+                        recipients = 0
+                        await reply("250 Queued")
+                else:
+                    await reply("250 OK")
+            replies.put_nowait((0, None))
+            await sender
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            sender.cancel()
+        writer.close()
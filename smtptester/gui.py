@@ -1,8 +1,9 @@
+import collections
 import logging
 import os
 import signal
 import sys
-from typing import Callable
+from typing import Any, Deque, Dict, List
 
 import PySide6.QtCore as qtc
 import PySide6.QtGui as qtg
@@ -11,54 +12,163 @@ import PySide6.QtWidgets as qtw
 import smtptester
 import smtptester.cli as cli
 import smtptester.dns as dns
+import smtptester.sink as sink
 import smtptester.smtp as smtp
+import smtptester.util as util
 
 
 PORT_RANGE = (0, 65535)
+GUI_LOG_FLUSH_INTERVAL = 100  # milliseconds
+GUI_DEFAULT_LOG_MAX_LINES = 10000
+GUI_DEFAULT_CONCURRENCY = 4
+GUI_MAX_CONCURRENCY = 64
+GUI_STATUS_QUEUED = "queued"
+GUI_STATUS_RUNNING = "running"
+GUI_STATUS_CANCELLED = "cancelled"
+GUI_COLUMNS = (
+    ("recipient", "Recipient"),
+    ("status", "Status"),
+    ("host", "Host"),
+    ("code", "Code"),
+    ("duration_ms", "Total (ms)"),
+)
 ICON_PATH = os.path.join(os.path.dirname(__file__), "assets", "smtptester.png")
 
 log = logging.getLogger(__name__)
 
 
-class Worker(qtc.QThread):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._started = qtc.Signal()
-        self._finished = qtc.Signal()
+class WorkerSignals(qtc.QObject):
+    started = qtc.Signal(int)
+    attempt = qtc.Signal(int, object)
+    finished = qtc.Signal(int, object)
 
-    @property
-    def started(self):
-        return self._started
 
-    @property
-    def finished(self):
-        return self._finished
+class Worker(qtc.QRunnable):
+    def __init__(self, row: int, options: Dict[str, Any], cancel: util.CancelToken):
+        super().__init__()
+        self.row = row
+        self.options = options
+        self.cancel = cancel
+        self.signals = WorkerSignals()
 
-    @property
-    def task(self):
-        return self._task
+    def write_result(self, result: smtptester.Result):
+        # Each attempt is reported here as it finishes (the tester treats
+        # the worker as its results sink), so rows update while they run.
+        self.signals.attempt.emit(self.row, result)
 
-    @task.setter
-    def task(self, val: smtptester.SMTPTester):
-        self._task = val
+    async def write_result_async(self, result: smtptester.Result):
+        self.write_result(result)
 
     def run(self):
-        self._task.run()
+        self.signals.started.emit(self.row)
+        try:
+            tester = smtptester.SMTPTester(results_sink=self, **self.options)
+            result = tester.run(cancel=self.cancel)
+        except Exception as e:
+            log.exception(e)
+            recipient = self.options["recipient"]
+            result = smtptester.Result(
+                recipient, smtptester.RESULT_ERROR, message=str(e)
+            )
+        self.signals.finished.emit(self.row, result)
+
+
+class RunTableModel(qtc.QAbstractTableModel):
+    def __init__(self, parent: qtc.QObject = None):
+        super().__init__(parent)
+        self.columns = list(GUI_COLUMNS) + [(p, p.upper()) for p in smtp.SMTP_PHASES]
+        self.runs: List[Dict[str, Any]] = []
+
+    def rowCount(self, parent: qtc.QModelIndex = qtc.QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.runs)
+
+    def columnCount(self, parent: qtc.QModelIndex = qtc.QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.columns)
+
+    def headerData(self, section: int, orientation, role=qtc.Qt.DisplayRole):
+        if role == qtc.Qt.DisplayRole and orientation == qtc.Qt.Horizontal:
+            return self.columns[section][1]
+        return None
+
+    def data(self, index: qtc.QModelIndex, role=qtc.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        run = self.runs[index.row()]
+        key = self.columns[index.column()][0]
+        if key in smtp.SMTP_PHASES:
+            value = run["timings_ms"].get(key)
+        else:
+            value = run.get(key)
+        if role == qtc.Qt.UserRole:
+            # Used for sorting, so numbers sort as numbers.
+            return value if value is not None else -1
+        if role == qtc.Qt.DisplayRole:
+            if not value:
+                return ""
+            return f"{value:.1f}" if isinstance(value, float) else str(value)
+        if role == qtc.Qt.TextAlignmentRole and not isinstance(value, str):
+            return int(qtc.Qt.AlignRight | qtc.Qt.AlignVCenter)
+        return None
+
+    def add(self, recipient: str) -> int:
+        row = len(self.runs)
+        self.beginInsertRows(qtc.QModelIndex(), row, row)
+        self.runs.append(
+            dict(sink.record(recipient, GUI_STATUS_QUEUED), status=GUI_STATUS_QUEUED)
+        )
+        self.endInsertRows()
+        return row
+
+    def update(self, row: int, **values: Any):
+        if row >= len(self.runs):
+            return
+        self.runs[row].update(values)
+        left = self.index(row, 0)
+        right = self.index(row, len(self.columns) - 1)
+        self.dataChanged.emit(left, right)
+
+    def update_result(self, row: int, result: smtptester.Result, status: str):
+        record = sink.record(*result)
+        self.update(
+            row,
+            status=status,
+            host=record["host"],
+            code=record["code"],
+            duration_ms=record["duration_ms"],
+            timings_ms=record["timings_ms"],
+        )
 
+    def clear(self):
+        self.beginResetModel()
+        self.runs.clear()
+        self.endResetModel()
 
-class LogSignal(qtc.QObject):
-    signal = qtc.Signal(str, logging.LogRecord)
+    def rows(self, status: str) -> List[int]:
+        return [i for i, run in enumerate(self.runs) if run["status"] == status]
+
+    def count(self, *statuses: str) -> int:
+        return sum(1 for run in self.runs if run["status"] in statuses)
 
 
 class GuiHandler(logging.Handler):
-    def __init__(self, slot_function: Callable):
+    def __init__(self, max_lines: int = GUI_DEFAULT_LOG_MAX_LINES):
         super().__init__()
-        self.log_signal = LogSignal()
-        self.log_signal.signal.connect(slot_function)
+        # Records are buffered here and picked up by a timer in the GUI
+        # thread, so a flood of debug output can't starve the event loop.
+        # Anything older than max_lines would scroll out of view anyway.
+        self.records: Deque[str] = collections.deque(maxlen=max_lines)
 
     def emit(self, record: logging.LogRecord):
-        s = self.format(record)
-        self.log_signal.signal.emit(s, record)
+        self.records.append(self.format(record))
+
+    def drain(self) -> List[str]:
+        self.acquire()
+        try:
+            records = list(self.records)
+            self.records.clear()
+        finally:
+            self.release()
+        return records
 
 
 class CentralWidget(qtw.QWidget):
@@ -66,27 +176,33 @@ class CentralWidget(qtw.QWidget):
         super().__init__()
 
         app.aboutToQuit.connect(self.quit)
+        self.log_max_lines = options.log_max_lines or GUI_DEFAULT_LOG_MAX_LINES
+        self.log_handler = GuiHandler(self.log_max_lines)
         logging.basicConfig(
-            handlers=[GuiHandler(self.log_results)],
+            handlers=[self.log_handler],
             format="[%(levelname)s] %(message)s",
             level=getattr(logging, options.log_level.upper()),
         )
-
-        self.worker = Worker()
-        self.worker.started.connect(self.working_mode_enable)
-        self.worker.finished.connect(self.working_mode_disable)
+        self.log_timer = qtc.QTimer(self)
+        self.log_timer.setInterval(GUI_LOG_FLUSH_INTERVAL)
+        self.log_timer.timeout.connect(self.log_results)
+        self.log_timer.start()
 
         self.settings = qtc.QSettings()
+        self.pool = qtc.QThreadPool(self)
+        self.runs = RunTableModel(self)
+        self.cancel_tokens: Dict[int, util.CancelToken] = {}
 
         self._widgets()
         self._layout()
 
     def _widgets(self):
         self.sender_ = qtw.QLineEdit()
-        self.sender_.setText(self.settings.value("sender", smtp.SMTP_DEFAULT_SENDER))
+        self.sender_.setText(self.settings.value("sender", smtp.default_sender()))
 
         self.recipient = qtw.QLineEdit()
         self.recipient.setText(self.settings.value("recipient"))
+        self.recipient.setToolTip("Separate recipients with commas to test them all")
 
         self.message = qtw.QTextEdit()
         self.message.setText(self.settings.value("message", smtp.SMTP_DEFAULT_MESSAGE))
@@ -135,7 +251,7 @@ class CentralWidget(qtw.QWidget):
         )
 
         self.smtp_helo = qtw.QLineEdit()
-        self.smtp_helo.setText(self.settings.value("smtp_helo", smtp.SMTP_DEFAULT_HELO))
+        self.smtp_helo.setText(self.settings.value("smtp_helo", smtp.default_helo()))
 
         self.smtp_use_auth = qtw.QCheckBox("Use Authentication")
         self.smtp_use_auth.setCheckState(
@@ -157,14 +273,41 @@ class CentralWidget(qtw.QWidget):
             self.settings.value("smtp_use_tls", qtc.Qt.CheckState.PartiallyChecked)
         )
 
+        self.concurrency = qtw.QSpinBox()
+        self.concurrency.setRange(1, GUI_MAX_CONCURRENCY)
+        self.concurrency.setValue(
+            int(self.settings.value("concurrency", GUI_DEFAULT_CONCURRENCY))
+        )
+        self.concurrency.setToolTip("Number of runs at a time")
+
         self.button_cancel = qtw.QPushButton("Cancel")
-        self.button_cancel.clicked.connect(self.terminate_worker)
+        self.button_cancel.clicked.connect(self.cancel_workers)
 
         self.button_ok = qtw.QPushButton("OK")
-        self.button_ok.clicked.connect(self.start_worker)
-
-        self.results = qtw.QTextEdit()
+        self.button_ok.clicked.connect(self.start_workers)
+
+        self.runs_filter = qtw.QLineEdit()
+        self.runs_filter.setPlaceholderText("Filter")
+        self.runs_filter.setClearButtonEnabled(True)
+
+        self.runs_proxy = qtc.QSortFilterProxyModel(self)
+        self.runs_proxy.setSourceModel(self.runs)
+        self.runs_proxy.setSortRole(qtc.Qt.UserRole)
+        self.runs_proxy.setFilterKeyColumn(-1)
+        self.runs_proxy.setFilterCaseSensitivity(qtc.Qt.CaseInsensitive)
+        self.runs_filter.textChanged.connect(self.runs_proxy.setFilterFixedString)
+
+        self.runs_table = qtw.QTableView()
+        self.runs_table.setModel(self.runs_proxy)
+        self.runs_table.setSortingEnabled(True)
+        self.runs_table.setSelectionBehavior(qtw.QAbstractItemView.SelectRows)
+        self.runs_table.verticalHeader().hide()
+        self.runs_table.horizontalHeader().setStretchLastSection(True)
+
+        self.results = qtw.QPlainTextEdit()
         self.results.setReadOnly(True)
+        self.results.setUndoRedoEnabled(False)
+        self.results.setMaximumBlockCount(self.log_max_lines)
 
     def _layout(self):
         message_gbox = qtw.QGroupBox("Message")
@@ -217,14 +360,21 @@ class CentralWidget(qtw.QWidget):
 
         button_gbox = qtw.QGroupBox()
         button_hbox = qtw.QHBoxLayout()
+        button_hbox.addWidget(qtw.QLabel("Parallel:"))
+        button_hbox.addWidget(self.concurrency)
         button_hbox.addWidget(self.button_cancel)
         button_hbox.addWidget(self.button_ok)
         button_gbox.setLayout(button_hbox)
-        self.working_mode_disable()
+        self.working_mode_update()
+
+        results_splitter = qtw.QSplitter(qtc.Qt.Vertical)
+        results_splitter.addWidget(self.runs_table)
+        results_splitter.addWidget(self.results)
 
         results_gbox = qtw.QGroupBox("Results")
         results_vbox = qtw.QVBoxLayout()
-        results_vbox.addWidget(self.results)
+        results_vbox.addWidget(self.runs_filter)
+        results_vbox.addWidget(results_splitter)
         results_gbox.setLayout(results_vbox)
 
         main_grid = qtw.QGridLayout()
@@ -236,9 +386,11 @@ class CentralWidget(qtw.QWidget):
         main_grid.addWidget(results_gbox, 4, 0, 1, 2)
         self.setLayout(main_grid)
 
-    @qtc.Slot(str)
-    def log_results(self, record: str):
-        self.results.append(record)
+    @qtc.Slot()
+    def log_results(self):
+        records = self.log_handler.drain()
+        if records:
+            self.results.appendPlainText("\n".join(records))
 
     @qtc.Slot()
     def toggle_dns_set_host(self):
@@ -274,25 +426,25 @@ class CentralWidget(qtw.QWidget):
             for w in widgets:
                 w.clear()
 
-    @qtc.Slot()
-    def working_mode_enable(self):
-        log.debug("Worker thread started")
-        self.button_cancel.setEnabled(True)
-        self.button_ok.setEnabled(False)
+    @property
+    def active(self) -> int:
+        return self.runs.count(GUI_STATUS_QUEUED, GUI_STATUS_RUNNING)
 
     @qtc.Slot()
-    def working_mode_disable(self):
-        if self.worker.isFinished():
-            log.debug("Worker thread finished")
-        self.button_cancel.setEnabled(False)
-        self.button_ok.setEnabled(True)
+    def working_mode_update(self):
+        self.button_cancel.setEnabled(self.active > 0)
 
     @qtc.Slot()
-    def start_worker(self):
-        if not self.recipient.text().strip():
+    def start_workers(self):
+        recipients = self.recipient.text().replace(",", " ").split()
+        if not recipients:
             return qtw.QMessageBox.critical(self, "Error", "Recipient is required")
 
-        self.results.clear()
+        if not self.active and not self.pool.activeThreadCount():
+            self.log_handler.drain()
+            self.results.clear()
+            self.runs.clear()
+            self.cancel_tokens.clear()
 
         dns_proto = "tcp" if self.dns_use_tcp.isChecked() else "udp"
 
@@ -302,8 +454,7 @@ class CentralWidget(qtw.QWidget):
             qtc.Qt.CheckState.Unchecked: "no",
         }[self.smtp_use_tls.checkState()]
 
-        self.worker.task = smtptester.SMTPTester(
-            recipient=self.recipient.text(),
+        options = dict(
             sender=self.sender_.text(),
             message=self.message.toPlainText(),
             dns_host=self.dns_host.text(),
@@ -319,14 +470,46 @@ class CentralWidget(qtw.QWidget):
             smtp_auth_pass=self.smtp_auth_pass.text(),
         )
 
-        self.worker.start()
+        self.pool.setMaxThreadCount(self.concurrency.value())
+        for recipient in recipients:
+            row = self.runs.add(recipient)
+            self.cancel_tokens[row] = util.CancelToken()
+            worker = Worker(
+                row, dict(options, recipient=recipient), self.cancel_tokens[row]
+            )
+            worker.signals.started.connect(self.worker_started)
+            worker.signals.attempt.connect(self.worker_attempt)
+            worker.signals.finished.connect(self.worker_finished)
+            self.pool.start(worker)
+        self.working_mode_update()
+
+    @qtc.Slot(int)
+    def worker_started(self, row: int):
+        self.runs.update(row, status=GUI_STATUS_RUNNING)
+
+    @qtc.Slot(int, object)
+    def worker_attempt(self, row: int, result: smtptester.Result):
+        self.runs.update_result(row, result, GUI_STATUS_RUNNING)
+
+    @qtc.Slot(int, object)
+    def worker_finished(self, row: int, result: smtptester.Result):
+        self.log_results()
+        self.cancel_tokens.pop(row, None)
+        self.runs.update_result(row, result, result.outcome)
+        self.working_mode_update()
 
     @qtc.Slot()
-    def terminate_worker(self):
-        if self.worker.isRunning():
-            log.debug("Terminating worker thread")
-            self.worker.terminate()
-            self.worker.wait()
+    def cancel_workers(self):
+        # Runs that haven't started yet are dropped from the queue. The ones
+        # in progress stop at their next await and close their connections.
+        self.pool.clear()
+        for row in self.runs.rows(GUI_STATUS_QUEUED):
+            log.debug(f"Cancelled run for: {self.runs.runs[row]['recipient']}")
+            self.cancel_tokens.pop(row).cancel()
+            self.runs.update(row, status=GUI_STATUS_CANCELLED)
+        for cancel in self.cancel_tokens.values():
+            cancel.cancel()
+        self.working_mode_update()
 
     @qtc.Slot()
     def quit(self):
@@ -351,7 +534,10 @@ class CentralWidget(qtw.QWidget):
         self.settings.setValue("smtp_auth_user", self.smtp_auth_user.text())
         self.settings.setValue("smtp_auth_pass", self.smtp_auth_pass.text())
 
-        self.terminate_worker()
+        self.settings.setValue("concurrency", self.concurrency.value())
+
+        self.cancel_workers()
+        self.pool.waitForDone()
 
 
 class MainWindow(qtw.QMainWindow):
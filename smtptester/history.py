@@ -0,0 +1,254 @@
+import json
+import logging
+import math
+import pathlib
+import sqlite3
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import smtptester
+import smtptester.load as load
+import smtptester.sink as sink
+import smtptester.smtp as smtp
+
+
+HISTORY_SPANS = (300, 3600, 86400)
+HISTORY_PRECISION = 0.02
+HISTORY_DEFAULT_SINCE = "7d"
+HISTORY_DEFAULT_WINDOW = "1d"
+HISTORY_DEFAULT_PHASE = "total"
+HISTORY_PERCENTILES = (50.0, 90.0, 99.0)
+HISTORY_SCHEMA_VERSION = 1
+HISTORY_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+# Every attempt is kept in attempts. The outcomes and latency tables are
+# rollups per host over periods of each of HISTORY_SPANS seconds, with latency
+# kept as histogram buckets, so a trend is read from the coarsest rollup that
+# fits its window however many attempts there were.
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS attempts (
+    time REAL NOT NULL,
+    recipient TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    host TEXT NOT NULL,
+    address TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    preference INTEGER NOT NULL,
+    code INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    duration_ms REAL NOT NULL,
+    timings_ms TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS attempts_time ON attempts (time);
+CREATE INDEX IF NOT EXISTS attempts_domain ON attempts (domain, time);
+CREATE INDEX IF NOT EXISTS attempts_host ON attempts (address, port, time);
+CREATE TABLE IF NOT EXISTS outcomes (
+    span INTEGER NOT NULL,
+    period INTEGER NOT NULL,
+    host TEXT NOT NULL,
+    address TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    outcome TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (span, period, host, address, port, outcome)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS latency (
+    span INTEGER NOT NULL,
+    phase TEXT NOT NULL,
+    period INTEGER NOT NULL,
+    host TEXT NOT NULL,
+    address TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (span, phase, period, host, address, port, bucket)
+) WITHOUT ROWID;
+"""
+
+log = logging.getLogger(__name__)
+
+
+class Trend(NamedTuple):
+    start: float
+    host: smtp.SMTPHost
+    outcomes: Dict[str, int]
+    latency: load.Histogram
+
+    @property
+    def attempts(self) -> int:
+        return sum(self.outcomes.values())
+
+    @property
+    def success_ratio(self) -> float:
+        accepted = self.outcomes.get(smtptester.RESULT_ACCEPTED, 0)
+        return accepted / self.attempts if self.attempts else 0.0
+
+
+class HistoryStore(sink.QueuedSink):
+    def __init__(self, path: str, queue_size: int = sink.SINK_DEFAULT_QUEUE_SIZE):
+        self.path = path
+        try:
+            self.db = connect(path)
+        except sqlite3.Error as e:
+            raise HistoryError(f"Unable to open history: {path} ({e})") from None
+        self.histogram = load.Histogram(HISTORY_PRECISION)
+        super().__init__(queue_size=queue_size)
+
+    def close(self):
+        super().close()
+        self.db.close()
+
+    def write_batch(self, records: List[Dict[str, Any]]):
+        attempts = []
+        outcomes: Dict[Tuple, int] = {}
+        latency: Dict[Tuple, int] = {}
+        for r in records:
+            timings = dict(r["timings_ms"])
+            attempts.append(
+                (
+                    r["time"],
+                    r["recipient"],
+                    r["recipient"].rpartition("@")[2].lower(),
+                    r["outcome"],
+                    r["host"],
+                    r["address"],
+                    r["port"],
+                    r["preference"],
+                    r["code"],
+                    r["message"],
+                    r["duration_ms"],
+                    json.dumps(timings),
+                )
+            )
+            if not r["address"]:
+                continue
+            host = (r["host"], r["address"], r["port"])
+            if timings:
+                timings[HISTORY_DEFAULT_PHASE] = r["duration_ms"]
+            buckets = [
+                (p, self.histogram.index(ms / 1000)) for p, ms in timings.items()
+            ]
+            for span in HISTORY_SPANS:
+                period = int(r["time"] // span)
+                key = (span, period, *host, r["outcome"])
+                outcomes[key] = outcomes.get(key, 0) + 1
+                for phase, bucket in buckets:
+                    key = (span, phase, period, *host, bucket)
+                    latency[key] = latency.get(key, 0) + 1
+
+        # One transaction per batch, so a busy run costs one commit per
+        # SINK_BATCH_SIZE attempts rather than one per attempt.
+        try:
+            with self.db:
+                self.db.executemany(
+                    "INSERT INTO attempts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    attempts,
+                )
+                self.db.executemany(
+                    "INSERT INTO outcomes VALUES (?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT (span, period, host, address, port, outcome)"
+                    " DO UPDATE SET count = count + excluded.count",
+                    [(*k, c) for k, c in outcomes.items()],
+                )
+                self.db.executemany(
+                    "INSERT INTO latency VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT (span, phase, period, host, address, port, bucket)"
+                    " DO UPDATE SET count = count + excluded.count",
+                    [(*k, c) for k, c in latency.items()],
+                )
+        except sqlite3.Error as e:
+            log.error(f"Unable to write history: {self.path} ({e})")
+
+
+def connect(path: str) -> sqlite3.Connection:
+    # The connection is made here but only used by the writer thread.
+    db = sqlite3.connect(path, check_same_thread=False)
+    # WAL lets the history command read while a monitor is writing.
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(HISTORY_SCHEMA)
+    db.execute(f"PRAGMA user_version={HISTORY_SCHEMA_VERSION}")
+    return db
+
+
+def parse_duration(value: str) -> float:
+    unit = HISTORY_UNITS.get(value[-1:].lower())
+    seconds = float(value[:-1] if unit else value) * (unit or 1)
+    if seconds <= 0:
+        raise ValueError(value)
+    return seconds
+
+
+def trends(
+    path: str,
+    since: float = parse_duration(HISTORY_DEFAULT_SINCE),
+    window: float = parse_duration(HISTORY_DEFAULT_WINDOW),
+    phase: str = HISTORY_DEFAULT_PHASE,
+    host: str = "",
+    now: Optional[float] = None,
+) -> List[Trend]:
+    # Windows are rounded up to a whole number of the shortest span and line
+    # up with the epoch, so daily windows start at midnight UTC.
+    window = max(math.ceil(window / HISTORY_SPANS[0]), 1) * HISTORY_SPANS[0]
+    span = max(s for s in HISTORY_SPANS if window % s == 0)
+    now = time.time() if now is None else now
+    first = int((now - since) // window) * window // span
+    results: Dict[Tuple[smtp.SMTPHost, int], Trend] = {}
+
+    def trend(period: int, name: str, address: str, port: int) -> Trend:
+        smtp_host = smtp.SMTPHost(name=name, address=address, port=port)
+        start = period * span // window * window
+        key = (smtp_host, start)
+        if key not in results:
+            latency = load.Histogram(HISTORY_PRECISION)
+            results[key] = Trend(start, smtp_host, {}, latency)
+        return results[key]
+
+    where = "span = ? AND period >= ? AND (? = '' OR host = ? OR address = ?)"
+    uri = f"{pathlib.Path(path).resolve().as_uri()}?mode=ro"
+    try:
+        db = sqlite3.connect(uri, uri=True)
+        try:
+            rows: Iterable = db.execute(
+                f"SELECT period, host, address, port, outcome, count FROM outcomes"
+                f" WHERE {where}",
+                (span, first, host, host, host),
+            )
+            for period, name, address, port, outcome, count in rows:
+                outcomes = trend(period, name, address, port).outcomes
+                outcomes[outcome] = outcomes.get(outcome, 0) + count
+            rows = db.execute(
+                f"SELECT period, host, address, port, bucket, count FROM latency"
+                f" WHERE phase = ? AND {where}",
+                (phase, span, first, host, host, host),
+            )
+            for period, name, address, port, bucket, count in rows:
+                trend(period, name, address, port).latency.add(bucket, count)
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        raise HistoryError(f"Unable to read history: {path} ({e})") from None
+    return sorted(results.values(), key=lambda t: (t.host, t.start))
+
+
+def trend_lines(
+    trends: Iterable[Trend], percentiles: Iterable[float] = HISTORY_PERCENTILES
+) -> List[str]:
+    percentiles = list(percentiles)
+    header = ["start", "host", "attempts", "accepted"]
+    lines = ["\t".join(header + [f"p{p:g}_ms" for p in percentiles])]
+    for t in trends:
+        fields = [
+            time.strftime("%Y-%m-%dT%H:%MZ", time.gmtime(t.start)),
+            smtp.log_host(t.host),
+            str(t.attempts),
+            f"{t.success_ratio:.2%}",
+        ]
+        fields += [f"{t.latency.percentile(p) * 1000:.1f}" for p in percentiles]
+        lines.append("\t".join(fields))
+    return lines
+
+
+class HistoryError(Exception):
+    pass
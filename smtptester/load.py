@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import math
+from typing import Dict, Iterable, NamedTuple, Optional, Union
+
+import smtptester.body as body
+import smtptester.sink as sink
+import smtptester.smtp as smtp
+import smtptester.util as util
+
+
+LOAD_DEFAULT_RATE = 1.0
+LOAD_DEFAULT_DURATION = 10.0
+LOAD_DEFAULT_CONCURRENCY = 1000
+LOAD_PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+HISTOGRAM_DEFAULT_PRECISION = 0.01
+HISTOGRAM_MIN_VALUE = 1e-6
+
+log = logging.getLogger(__name__)
+
+
+class Histogram:
+    def __init__(self, precision: float = HISTOGRAM_DEFAULT_PRECISION):
+        self.base = math.log1p(precision)
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def index(self, value: float) -> int:
+        return math.ceil(math.log(max(value, HISTOGRAM_MIN_VALUE)) / self.base)
+
+    def value(self, index: int) -> float:
+        return math.exp(index * self.base)
+
+    def record(self, value: float):
+        index = self.index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def add(self, index: int, count: int = 1):
+        value = self.value(index)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+        self.max = max(self.max, value)
+
+    def merge(self, other: "Histogram"):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percentile: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * percentile / 100)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.value(index), self.max)
+        return self.max
+
+    def count_below(self, value: float) -> int:
+        limit = math.log(max(value, HISTOGRAM_MIN_VALUE)) / self.base
+        return sum(c for index, c in self.buckets.items() if index <= limit + 1e-9)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class LoadReport(NamedTuple):
+    host: smtp.SMTPHost
+    duration: float
+    sent: int
+    accepted: int
+    temporary: int
+    permanent: int
+    latency: Histogram
+
+    @property
+    def throughput(self) -> float:
+        return self.accepted / self.duration if self.duration else 0.0
+
+    def error_rate(self, errors: int) -> float:
+        return errors / self.sent if self.sent else 0.0
+
+
+async def run_async(
+    host: smtp.SMTPHost,
+    recipient: str,
+    rate: float = LOAD_DEFAULT_RATE,
+    duration: float = LOAD_DEFAULT_DURATION,
+    concurrency: int = LOAD_DEFAULT_CONCURRENCY,
+    reuse: bool = False,
+    sender: str = "",
+    message: Union[str, body.MessageBody] = smtp.SMTP_DEFAULT_MESSAGE,
+    timeout: int = smtp.SMTP_DEFAULT_TIMEOUT,
+    helo: str = "",
+    tls: str = smtp.SMTP_DEFAULT_TLS,
+    auth_user: str = "",
+    auth_pass: str = "",
+    tls_context: Optional[smtp.TLSContext] = None,
+    pipelining: bool = True,
+    results_sink: Optional[sink.ResultsSink] = None,
+) -> LoadReport:
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    latency = Histogram()
+    counts = {"accepted": 0, "temporary": 0, "permanent": 0}
+    pool = smtp.SMTPPool(
+        timeout=timeout,
+        helo=helo,
+        tls=tls,
+        auth_user=auth_user,
+        auth_pass=auth_pass,
+        max_idle=concurrency,
+        tls_context=tls_context,
+        pipelining=pipelining,
+    )
+
+    async def send(scheduled: float):
+        # Latency is measured from the scheduled start rather than the actual
+        # start, so time spent queued behind slow responses is not hidden.
+        async with semaphore:
+            outcome, error, result = "accepted", "", None
+            try:
+                if reuse:
+                    result = await pool.send_async(host, recipient, sender, message)
+                else:
+                    result = await smtp.send_async(
+                        host,
+                        recipient,
+                        sender=sender,
+                        message=message,
+                        timeout=timeout,
+                        helo=helo,
+                        tls=tls,
+                        auth_user=auth_user,
+                        auth_pass=auth_pass,
+                        tls_context=tls_context,
+                        pipelining=pipelining,
+                    )
+            except smtp.SMTPTemporaryError as e:
+                log.warning(e)
+                outcome, error, result = "temporary", str(e), e.result
+            except smtp.SMTPPermanentError as e:
+                log.error(e)
+                outcome, error, result = "permanent", str(e), e.result
+            counts[outcome] += 1
+            latency.record(loop.time() - scheduled)
+            if results_sink is not None:
+                record = sink.record(recipient, outcome, host, error, result)
+                await results_sink.write_async(record)
+
+    total = max(int(rate * duration), 1)
+    log.info(f"Sending {total} messages to {smtp.log_host(host)} at {rate}/s")
+    started = loop.time()
+    tasks = []
+    try:
+        for i in range(total):
+            scheduled = started + i / rate
+            delay = scheduled - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(send(scheduled)))
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await pool.close_async()
+
+    return LoadReport(
+        host=host,
+        duration=loop.time() - started,
+        sent=total,
+        latency=latency,
+        **counts,
+    )
+
+
+def run(host: smtp.SMTPHost, recipient: str, **options) -> LoadReport:
+    return util.run_sync(run_async(host, recipient, **options))
+
+
+def report_lines(
+    report: LoadReport, percentiles: Iterable[float] = LOAD_PERCENTILES
+) -> Iterable[str]:
+    latency = report.latency
+    return [
+        f"Host: {smtp.log_host(report.host)}",
+        f"Duration: {report.duration:.2f}s",
+        f"Messages: {report.sent} sent, {report.accepted} accepted",
+        f"Throughput: {report.throughput:.2f} messages/s",
+        f"Temporary errors: {report.temporary}"
+        f" ({report.error_rate(report.temporary):.2%})",
+        f"Permanent errors: {report.permanent}"
+        f" ({report.error_rate(report.permanent):.2%})",
+        "Latency: "
+        + " ".join(f"p{p:g}={latency.percentile(p) * 1000:.1f}ms" for p in percentiles)
+        + f" mean={latency.mean * 1000:.1f}ms max={latency.max * 1000:.1f}ms",
+    ]
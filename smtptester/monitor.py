@@ -0,0 +1,294 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, Iterable, List, Optional
+
+import smtptester
+import smtptester.dns as dns
+import smtptester.load as load
+import smtptester.rto as rto
+import smtptester.util as util
+
+
+MONITOR_DEFAULT_INTERVAL = 60.0
+MONITOR_DEFAULT_JITTER = 0.1
+MONITOR_DEFAULT_ADDRESS = "127.0.0.1"
+MONITOR_DEFAULT_PORT = 9587
+MONITOR_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+MONITOR_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+log = logging.getLogger(__name__)
+
+
+class TargetStats:
+    def __init__(self):
+        self.latency = load.Histogram()
+        self.outcomes: Dict[str, int] = {}
+        self.last_code = 0
+        self.last_error = ""
+        self.last_error_time = 0.0
+        self.last_success_time = 0.0
+
+    def record(self, result: "smtptester.Result", duration: float):
+        self.latency.record(duration)
+        self.outcomes[result.outcome] = self.outcomes.get(result.outcome, 0) + 1
+        reply = None
+        if result.delivery is not None:
+            reply = result.delivery.recipients.get(result.recipient)
+        self.last_code = reply.code if reply else 0
+        if result.outcome == smtptester.RESULT_ACCEPTED:
+            self.last_success_time = time.time()
+        else:
+            self.last_error = result.message
+            self.last_error_time = time.time()
+
+    @property
+    def success_ratio(self) -> float:
+        total = sum(self.outcomes.values())
+        accepted = self.outcomes.get(smtptester.RESULT_ACCEPTED, 0)
+        return accepted / total if total else 0.0
+
+
+class Monitor:
+    def __init__(
+        self,
+        targets: Iterable[str],
+        resolver: dns.DNSResolver,
+        interval: float = MONITOR_DEFAULT_INTERVAL,
+        jitter: float = MONITOR_DEFAULT_JITTER,
+        address: str = MONITOR_DEFAULT_ADDRESS,
+        port: int = MONITOR_DEFAULT_PORT,
+        timeouts: Optional[rto.AdaptiveTimeouts] = None,
+        **options,
+    ):
+        self.targets = list(targets)
+        self.resolver = resolver
+        self.interval = interval
+        self.jitter = jitter
+        self.address = address
+        self.port = port
+        self.timeouts = timeouts
+        self.options = options
+        self.stats = {t: TargetStats() for t in self.targets}
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.address, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        log.info(f"Serving metrics on http://{self.address}:{self.port}/metrics")
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.resolver.cache.save()
+        await self.resolver.close_async()
+        if self.timeouts is not None:
+            self.timeouts.save()
+
+    async def run_async(self, cancel: Optional[util.CancelToken] = None):
+        await self.start()
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(
+            util.gather(*(self._schedule(t) for t in self.targets))
+        )
+
+        def cancel_task():
+            loop.call_soon_threadsafe(task.cancel)
+
+        if cancel is not None:
+            cancel.add_callback(cancel_task)
+        try:
+            await task
+        except asyncio.CancelledError:
+            if cancel is None or not cancel.cancelled:
+                raise
+        finally:
+            if cancel is not None:
+                cancel.remove_callback(cancel_task)
+            await self.stop()
+
+    async def probe_async(self, target: str) -> "smtptester.Result":
+        started = time.monotonic()
+        tester = smtptester.SMTPTester(
+            recipient=target,
+            resolver=self.resolver,
+            timeouts=self.timeouts,
+            **self.options,
+        )
+        result = await tester.run_async()
+        self.stats[target].record(result, time.monotonic() - started)
+        return result
+
+    async def _schedule(self, target: str):
+        # Targets start at random offsets and every interval is jittered, so
+        # probes for many targets don't line up against the same MX hosts.
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(random.uniform(0, self.interval))
+        while True:
+            started = loop.time()
+            try:
+                await self.probe_async(target)
+            except Exception as e:
+                # A probe that fails unexpectedly is counted as an error, and
+                # doesn't stop this or any other target's schedule.
+                log.exception(f"Probe failed: {target}: {e}")
+                result = smtptester.Result(
+                    target, smtptester.RESULT_ERROR, message=str(e)
+                )
+                self.stats[target].record(result, loop.time() - started)
+            delay = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            await asyncio.sleep(max(started + delay - loop.time(), 0))
+
+    def metrics(self) -> str:
+        lines: List[str] = []
+
+        def family(name: str, kind: str, text: str, unit: str = ""):
+            lines.append(f"# TYPE {name} {kind}")
+            if unit:
+                lines.append(f"# UNIT {name} {unit}")
+            lines.append(f"# HELP {name} {text}")
+
+        def sample(name: str, value: float, **labels: str):
+            pairs = ",".join(f'{k}="{escape(v)}"' for k, v in labels.items())
+            lines.append(f"{name}{{{pairs}}} {number(value)}")
+
+        name = "smtptester_probe_duration_seconds"
+        family(name, "histogram", "Time taken by each probe.", unit="seconds")
+        for target, stats in self.stats.items():
+            for bound in MONITOR_BUCKETS:
+                count = stats.latency.count_below(bound)
+                sample(f"{name}_bucket", count, target=target, le=f"{bound:g}")
+            count = stats.latency.count
+            sample(f"{name}_bucket", count, target=target, le="+Inf")
+            sample(f"{name}_count", count, target=target)
+            sample(f"{name}_sum", stats.latency.total, target=target)
+
+        name = "smtptester_probes"
+        family(name, "counter", "Probes by outcome.")
+        for target, stats in self.stats.items():
+            for outcome, count in sorted(stats.outcomes.items()):
+                sample(f"{name}_total", count, target=target, outcome=outcome)
+
+        name = "smtptester_probe_success_ratio"
+        family(name, "gauge", "Fraction of probes that were accepted.")
+        for target, stats in self.stats.items():
+            sample(name, stats.success_ratio, target=target)
+
+        name = "smtptester_probe_last_code"
+        family(name, "gauge", "SMTP reply code for the recipient in the last probe.")
+        for target, stats in self.stats.items():
+            sample(name, stats.last_code, target=target)
+
+        name = "smtptester_probe_last_success_timestamp_seconds"
+        family(name, "gauge", "Time of the last accepted probe.", unit="seconds")
+        for target, stats in self.stats.items():
+            sample(name, stats.last_success_time, target=target)
+
+        name = "smtptester_probe_last_error_timestamp_seconds"
+        family(name, "gauge", "Time of the last failed probe.", unit="seconds")
+        for target, stats in self.stats.items():
+            sample(name, stats.last_error_time, target=target)
+
+        name = "smtptester_probe_last_error"
+        family(name, "info", "Message from the last failed probe.")
+        for target, stats in self.stats.items():
+            if stats.last_error:
+                sample(f"{name}_info", 1, target=target, message=stats.last_error)
+
+        name = "smtptester_dns_queries"
+        family(name, "counter", "Queries sent to each nameserver.")
+        for host, stats in self.resolver.stats.items():
+            sample(f"{name}_total", stats.queries, nameserver=host)
+
+        name = "smtptester_dns_failures"
+        family(name, "counter", "Queries that failed or timed out.")
+        for host, stats in self.resolver.stats.items():
+            sample(f"{name}_total", stats.failures, nameserver=host)
+
+        name = "smtptester_dns_srtt_seconds"
+        family(name, "gauge", "Smoothed round trip time.", unit="seconds")
+        for host, stats in self.resolver.stats.items():
+            sample(name, stats.srtt, nameserver=host)
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            method, path = (request.decode("latin-1").split(" ") + ["", ""])[:2]
+            if method == "GET" and path.split("?")[0] == "/metrics":
+                status, content_type = "200 OK", MONITOR_CONTENT_TYPE
+                payload = self.metrics().encode("utf-8")
+            else:
+                status, content_type = "404 Not Found", "text/plain"
+                payload = b"Not Found\n"
+            headers = (
+                f"HTTP/1.0 {status}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n\r\n"
+            )
+            writer.write(headers.encode("latin-1") + payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def number(value: float) -> str:
+    # Counters and timestamps need every digit, which "g" formatting drops.
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def run(
+    targets: Iterable[str],
+    interval: float = MONITOR_DEFAULT_INTERVAL,
+    jitter: float = MONITOR_DEFAULT_JITTER,
+    address: str = MONITOR_DEFAULT_ADDRESS,
+    port: int = MONITOR_DEFAULT_PORT,
+    **options,
+):
+    # One resolver is shared by every probe for the life of the process, so
+    # its cache does the work that the cache file did between cron runs.
+    timeouts = None
+    if options.get("adaptive_timeouts") or options.get("timeouts_file"):
+        timeouts = rto.AdaptiveTimeouts(
+            minimum=options.get("timeout_min", rto.RTO_DEFAULT_MIN),
+            maximum=options.get("timeout_max", rto.RTO_DEFAULT_MAX),
+            path=options.get("timeouts_file", ""),
+        )
+    resolver = dns.DNSResolver(
+        host=options["dns_host"],
+        port=options["dns_port"],
+        timeout=options["dns_timeout"],
+        protocol=options["dns_proto"],
+        cache_path=options.get("dns_cache", ""),
+        race=options.get("dns_race", False),
+        timeouts=timeouts,
+    )
+    monitor = Monitor(
+        targets,
+        resolver,
+        interval=interval,
+        jitter=jitter,
+        address=address,
+        port=port,
+        timeouts=timeouts,
+        **options,
+    )
+    # Ctrl+C cancels the probes through the token, so the cache and the
+    # timeouts are saved before the process exits.
+    cancel = util.CancelToken()
+    util.run_sync(monitor.run_async(cancel=cancel), cancel=cancel)
+    log.info("Monitor stopped")
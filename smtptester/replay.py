@@ -0,0 +1,421 @@
+import asyncio
+import ipaddress
+import json
+import logging
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import smtptester
+import smtptester.util as util
+
+
+REPLAY_VERSION = 1
+REPLAY_DEFAULT_TIME_SCALE = 1.0
+REPLAY_DNS_ADDRESS = "127.0.0.1"
+REPLAY_SMTP_NETWORK = "127.0.1.0"
+REPLAY_CLIENT = "c"
+REPLAY_SERVER = "s"
+REPLAY_TLS = "tls"
+REPLAY_CLOSE = "close"
+
+log = logging.getLogger(__name__)
+
+
+class Event(NamedTuple):
+    time: float
+    kind: str
+    text: str = ""
+
+
+class DNSEntry(NamedTuple):
+    records: List[str]
+    error: str = ""
+    duration: float = 0.0
+
+
+class Transcript:
+    def __init__(self, name: str, address: str, port: int):
+        self.name = name
+        self.address = address
+        self.port = port
+        self.started = time.monotonic()
+        self.events: List[Event] = []
+
+    def client(self, text: str):
+        # Credentials never make it into a capture.
+        last = self.events[-1] if self.events else None
+        if text.upper().startswith("AUTH "):
+            text = " ".join(text.split(" ")[:2])
+        elif last and last.kind == REPLAY_SERVER and last.text.startswith("334"):
+            text = "<redacted>"
+        self._add(REPLAY_CLIENT, text)
+
+    def server(self, text: str):
+        self._add(REPLAY_SERVER, text)
+
+    def tls(self, version: str):
+        self._add(REPLAY_TLS, version)
+
+    def closed(self):
+        self._add(REPLAY_CLOSE)
+
+    def _add(self, kind: str, text: str = ""):
+        self.events.append(Event(time.monotonic() - self.started, kind, text))
+
+
+class Capture:
+    def __init__(self):
+        self.time = time.time()
+        self.recipients: List[str] = []
+        self.sender = ""
+        self.smtp_host = ""
+        self.auth = False
+        self.pipelining = True
+        self.dns_answers: Dict[Tuple[str, str], DNSEntry] = {}
+        self.sessions: List[Transcript] = []
+
+    def dns(
+        self,
+        qname: str,
+        rdtype: str,
+        records: Iterable[str],
+        error: str = "",
+        duration: float = 0.0,
+    ):
+        # Only the first answer to each question is kept, since later ones
+        # usually come from the cache.
+        key = (qname.lower().rstrip("."), rdtype)
+        self.dns_answers.setdefault(key, DNSEntry(list(records), error, duration))
+
+    def session(self, name: str, address: str, port: int) -> Transcript:
+        transcript = Transcript(name, address, port)
+        self.sessions.append(transcript)
+        return transcript
+
+    def save(self, path: str):
+        data = {
+            "version": REPLAY_VERSION,
+            "time": round(self.time, 3),
+            "recipients": self.recipients,
+            "sender": self.sender,
+            "smtp_host": self.smtp_host,
+            "auth": self.auth,
+            "pipelining": self.pipelining,
+            "dns": [
+                [name, rdtype, e.records, e.error, round(e.duration * 1000, 1)]
+                for (name, rdtype), e in self.dns_answers.items()
+            ],
+            "sessions": [
+                {
+                    "host": [s.name, s.address, s.port],
+                    "events": [
+                        [round(e.time * 1000, 1), e.kind, e.text] for e in s.events
+                    ],
+                }
+                for s in self.sessions
+            ],
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        log.info(
+            f"Recorded {len(self.sessions)} SMTP sessions and"
+            f" {len(self.dns_answers)} DNS answers to: {path}"
+        )
+
+
+class ReplaySMTPServer:
+    def __init__(
+        self,
+        transcripts: Iterable[Transcript],
+        address: str,
+        port: int = 0,
+        time_scale: float = REPLAY_DEFAULT_TIME_SCALE,
+    ):
+        self.transcripts = [plaintext(t.events) for t in transcripts]
+        self.address = address
+        self.port = port
+        self.time_scale = time_scale
+        self.connections = 0
+        self.writers: Set[asyncio.StreamWriter] = set()
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.address, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        for writer in self.writers:
+            writer.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        # Connections get the recorded sessions in turn. Each reply is due
+        # the recorded (scaled) time after the client line it followed, so
+        # pipelined commands are answered the way they were originally.
+        events = self.transcripts[self.connections % len(self.transcripts)]
+        self.connections += 1
+        self.writers.add(writer)
+        loop = asyncio.get_running_loop()
+        replies: asyncio.Queue = asyncio.Queue()
+        sender = asyncio.ensure_future(self._send(writer, replies))
+        position = 0
+        received, recorded = loop.time(), 0.0
+        body = False
+
+        def schedule():
+            nonlocal position, body
+            while position < len(events) and events[position].kind != REPLAY_CLIENT:
+                event = events[position]
+                due = received + (event.time - recorded) * self.time_scale
+                if event.kind == REPLAY_SERVER:
+                    replies.put_nowait((due, f"{event.text}\r\n".encode()))
+                    body = body or event.text.startswith("354")
+                elif event.kind == REPLAY_CLOSE:
+                    replies.put_nowait((due, None))
+                position += 1
+
+        try:
+            schedule()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if body:
+                    while line and line != b".\r\n":
+                        line = await reader.readline()
+                    body = False
+                elif line[:5].upper() == b"BDAT ":
+                    await reader.readexactly(int(line.split()[1]))
+                # Past the end of the recording the client gets no reply, the
+                # same as from a server that stopped responding.
+                if position < len(events):
+                    received, recorded = loop.time(), events[position].time
+                    position += 1
+                    schedule()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            sender.cancel()
+            self.writers.discard(writer)
+            writer.close()
+
+    async def _send(self, writer: asyncio.StreamWriter, replies: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                due, data = await replies.get()
+                if due > loop.time():
+                    await asyncio.sleep(due - loop.time())
+                if data is None:
+                    writer.close()
+                    break
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+
+
+class ReplayServer:
+    def __init__(self, capture: Capture, time_scale: float = REPLAY_DEFAULT_TIME_SCALE):
+        self.capture = capture
+        self.time_scale = time_scale
+        # Every address in the capture gets its own loopback address, and A
+        # records point there instead. Hosts that were never connected to get
+        # no server, so connections to them are refused. This needs all of
+        # 127.0.0.0/8 on the loopback interface, as on Linux but not macOS.
+        self.addresses: Dict[str, str] = {}
+        for (_, rdtype), entry in capture.dns_answers.items():
+            if rdtype == "a":
+                for address in entry.records:
+                    self._map(address)
+        for s in capture.sessions:
+            self._map(s.address)
+        self.dns_server = None
+        self.smtp_servers: List[ReplaySMTPServer] = []
+        self.port = 0
+
+    @property
+    def dns_port(self) -> int:
+        return self.dns_server.port if self.dns_server else 0
+
+    @property
+    def smtp_host(self) -> str:
+        # An address given with --smtp-host wasn't looked up, so it's mapped
+        # here instead.
+        host = self.capture.smtp_host
+        return self.addresses.get(host, host)
+
+    def _map(self, address: str) -> str:
+        if address not in self.addresses:
+            network = ipaddress.ip_address(REPLAY_SMTP_NETWORK)
+            self.addresses[address] = str(network + len(self.addresses) + 1)
+        return self.addresses[address]
+
+    async def start(self):
+        # The stand-in DNS server needs dnspython, which is slow to import,
+        # so it's only loaded for a replay.
+        import smtptester.fake as fake
+
+        records: Dict[Tuple[str, str], Optional[List[str]]] = {}
+        delays: Dict[Tuple[str, str], float] = {}
+        for key, entry in self.capture.dns_answers.items():
+            # A missing name gets NXDOMAIN and an empty list gets no records.
+            # Any other failure is replayed as a server that doesn't answer.
+            if entry.error == "DNSNoDomain":
+                continue
+            elif entry.error and entry.error != "DNSNoRecords":
+                records[key] = None
+            elif key[1] == "a":
+                records[key] = [self.addresses.get(r, r) for r in entry.records]
+            else:
+                records[key] = entry.records
+            delays[key] = entry.duration * self.time_scale
+        self.dns_server = fake.FakeDNSServer(
+            records, delays=delays, address=REPLAY_DNS_ADDRESS
+        )
+        await self.dns_server.start()
+
+        # The tester connects to every host on the same port, so all the
+        # stand-in SMTP servers share one.
+        sessions: Dict[str, List[Transcript]] = {}
+        for s in self.capture.sessions:
+            sessions.setdefault(self.addresses[s.address], []).append(s)
+        for address, transcripts in sessions.items():
+            server = ReplaySMTPServer(
+                transcripts, address, port=self.port, time_scale=self.time_scale
+            )
+            try:
+                await server.start()
+            except OSError as e:
+                await self.stop()
+                raise ReplayError(
+                    f"Unable to listen on {address}, replay needs the whole"
+                    f" 127.0.0.0/8 network on the loopback interface ({e})"
+                ) from None
+            self.port = server.port
+            self.smtp_servers.append(server)
+
+    async def stop(self):
+        for server in self.smtp_servers:
+            await server.stop()
+        if self.dns_server is not None:
+            await self.dns_server.stop()
+
+    async def serve_async(self):
+        await self.start()
+        log.info(f"Serving DNS on {REPLAY_DNS_ADDRESS}:{self.dns_port}")
+        for original, address in self.addresses.items():
+            log.info(f"Serving SMTP for {original} on {address}:{self.port}")
+        try:
+            await asyncio.get_running_loop().create_future()
+        finally:
+            await self.stop()
+
+
+def plaintext(events: Iterable[Event]) -> List[Event]:
+    # The stand-in servers don't speak TLS. If the session was upgraded, the
+    # upgrade and the EHLO that followed it are dropped and STARTTLS is no
+    # longer offered, so clients carry on in plaintext after the first EHLO.
+    events = list(events)
+    if not any(e.kind == REPLAY_TLS for e in events):
+        return events
+    result = []
+    remaining = iter(events)
+    for event in remaining:
+        if event.kind == REPLAY_TLS:
+            continue
+        if event.kind == REPLAY_CLIENT and event.text.upper() == "STARTTLS":
+            for event in remaining:
+                if event.kind == REPLAY_CLIENT and event.text.upper()[:4] in (
+                    "EHLO",
+                    "HELO",
+                ):
+                    break
+            for event in remaining:
+                if event.kind == REPLAY_SERVER:
+                    break
+            continue
+        if event.kind == REPLAY_SERVER:
+            event = event._replace(text=without_starttls(event.text))
+        result.append(event)
+    return result
+
+
+def without_starttls(reply: str) -> str:
+    lines = reply.split("\r\n")
+    if len(lines) < 2 or not lines[0].startswith("250"):
+        return reply
+    lines = [line for line in lines if line[4:].upper() != "STARTTLS"]
+    lines = [f"{line[:3]}-{line[4:]}" for line in lines[:-1]] + [
+        f"{lines[-1][:3]} {lines[-1][4:]}"
+    ]
+    return "\r\n".join(lines)
+
+
+def load(path: str) -> Capture:
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != REPLAY_VERSION:
+            raise ValueError(f"unsupported version: {data.get('version')}")
+        capture = Capture()
+        capture.time = data["time"]
+        capture.recipients = data["recipients"]
+        capture.sender = data["sender"]
+        capture.smtp_host = data["smtp_host"]
+        capture.auth = data["auth"]
+        capture.pipelining = data["pipelining"]
+        for name, rdtype, records, error, ms in data["dns"]:
+            capture.dns_answers[(name, rdtype)] = DNSEntry(records, error, ms / 1000)
+        for s in data["sessions"]:
+            transcript = Transcript(*s["host"])
+            for ms, kind, text in s["events"]:
+                transcript.events.append(Event(ms / 1000, kind, text))
+            capture.sessions.append(transcript)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise ReplayError(f"Unable to read capture: {path} ({e})") from None
+    return capture
+
+
+def run(
+    path: str, time_scale: float = REPLAY_DEFAULT_TIME_SCALE, **options
+) -> List["smtptester.Result"]:
+    capture = load(path)
+    server = ReplayServer(capture, time_scale=time_scale)
+    util.run_sync(server.start())
+    try:
+        # The message isn't recorded, so any will do. Credentials are only
+        # needed so AUTH is sent when it was originally.
+        credentials = "replay" if capture.auth else ""
+        options.setdefault("message", smtptester.smtp.SMTP_DEFAULT_MESSAGE)
+        options.setdefault("smtp_helo", "")
+        tester = smtptester.SMTPTester(
+            recipient=capture.recipients,
+            sender=capture.sender,
+            dns_host=REPLAY_DNS_ADDRESS,
+            dns_port=server.dns_port,
+            dns_proto="udp",
+            smtp_host=server.smtp_host,
+            smtp_port=server.port,
+            smtp_tls="try",
+            smtp_auth_user=credentials,
+            smtp_auth_pass=credentials,
+            smtp_pipelining=capture.pipelining,
+            **options,
+        )
+        return tester.run_all()
+    finally:
+        util.run_sync(server.stop())
+
+
+def serve(path: str, time_scale: float = REPLAY_DEFAULT_TIME_SCALE):
+    server = ReplayServer(load(path), time_scale=time_scale)
+    try:
+        util.run_sync(server.serve_async())
+    except KeyboardInterrupt:
+        log.info("Replay stopped")
+
+
+class ReplayError(Exception):
+    pass
@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+from typing import Dict
+
+
+RTO_ALPHA = 1 / 8
+RTO_BETA = 1 / 4
+RTO_K = 4
+RTO_GRANULARITY = 0.01
+RTO_DEFAULT_MIN = 1.0
+RTO_DEFAULT_MAX = 60.0
+
+log = logging.getLogger(__name__)
+
+
+class RTTEstimate:
+    def __init__(self, srtt: float = 0.0, rttvar: float = 0.0, samples: int = 0):
+        self.srtt = srtt
+        self.rttvar = rttvar
+        self.samples = samples
+        self.backoff = 0
+
+    def sample(self, rtt: float):
+        # RFC 6298, section 2.
+        if self.samples:
+            self.rttvar += RTO_BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += RTO_ALPHA * (rtt - self.srtt)
+        else:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        self.samples += 1
+        self.backoff = 0
+
+    def rto(self) -> float:
+        rto = self.srtt + max(RTO_GRANULARITY, RTO_K * self.rttvar)
+        return rto * 2**self.backoff
+
+
+class AdaptiveTimeouts:
+    def __init__(
+        self,
+        minimum: float = RTO_DEFAULT_MIN,
+        maximum: float = RTO_DEFAULT_MAX,
+        path: str = "",
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.path = path
+        self.estimates: Dict[str, RTTEstimate] = {}
+        if path:
+            self.load()
+
+    def timeout(self, key: str, initial: float) -> float:
+        # Until something has been measured, the configured timeout is used.
+        estimate = self.estimates.get(key)
+        if estimate is None or not estimate.samples:
+            timeout = initial
+            if estimate is not None:
+                timeout *= 2**estimate.backoff
+        else:
+            timeout = estimate.rto()
+        return min(max(timeout, self.minimum), self.maximum)
+
+    def sample(self, key: str, rtt: float):
+        self.estimates.setdefault(key, RTTEstimate()).sample(rtt)
+
+    def backoff(self, key: str, initial: float):
+        # RFC 6298, section 5.5: double the timeout after each expiry.
+        estimate = self.estimates.setdefault(key, RTTEstimate())
+        if self.timeout(key, initial) < self.maximum:
+            estimate.backoff += 1
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring timeouts file: {self.path} ({e})")
+            return
+        for key, (srtt, rttvar, samples) in data.items():
+            self.estimates[key] = RTTEstimate(srtt, rttvar, samples)
+        log.debug(f"Loaded {len(self.estimates)} RTT estimates from: {self.path}")
+
+    def save(self):
+        if not self.path:
+            return
+        data = {
+            key: [e.srtt, e.rttvar, e.samples]
+            for key, e in self.estimates.items()
+            if e.samples
+        }
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.warning(f"Unable to save timeouts file: {self.path} ({e})")
+            return
+        log.debug(f"Saved {len(data)} RTT estimates to: {self.path}")
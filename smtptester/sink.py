@@ -0,0 +1,234 @@
+import abc
+import asyncio
+import contextlib
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, TextIO, Tuple, Union
+
+import smtptester
+import smtptester.smtp as smtp
+
+
+SINK_DEFAULT_BUFFER_SIZE = 1024 * 1024
+SINK_DEFAULT_QUEUE_SIZE = 10000
+SINK_BATCH_SIZE = 1000
+SINK_PUT_INTERVAL = 1.0
+
+log = logging.getLogger(__name__)
+
+
+class PhaseSummary(NamedTuple):
+    timings: Dict[str, float]
+    timeouts: Dict[str, float]
+    code: int
+    recipients: Dict[str, Tuple[float, float]]
+
+
+_last_summary: Tuple[Optional[smtp.SMTPResult], Optional[PhaseSummary]] = (None, None)
+
+
+def phase_summary(delivery: smtp.SMTPResult) -> PhaseSummary:
+    # Every recipient in a transaction gets a record, so the summary of the
+    # last delivery is kept rather than walking its phases for each of them.
+    global _last_summary
+    last, summary = _last_summary
+    if last is delivery and summary is not None:
+        return summary
+    timings: Dict[str, float] = {}
+    timeouts: Dict[str, float] = {}
+    recipients: Dict[str, Tuple[float, float]] = {}
+    code = 0
+    for phase in delivery.phases:
+        ms, timeout = phase.duration * 1000, round(phase.timeout * 1000, 3)
+        if phase.recipient:
+            # Each RCPT is only timed in its own recipient's record.
+            total = recipients.get(phase.recipient, (0.0, 0.0))[0] + ms
+            recipients[phase.recipient] = (round(total, 3), timeout)
+        else:
+            timings[phase.name] = round(timings.get(phase.name, 0.0) + ms, 3)
+            timeouts[phase.name] = timeout
+        if phase.code and phase.name != "quit":
+            code = phase.code
+    summary = PhaseSummary(timings, timeouts, code, recipients)
+    _last_summary = (delivery, summary)
+    return summary
+
+
+def record(
+    recipient: str,
+    outcome: str,
+    host: Optional[smtp.SMTPHost] = None,
+    message: str = "",
+    delivery: Optional[smtp.SMTPResult] = None,
+) -> Dict[str, Any]:
+    timings: Dict[str, float] = {}
+    timeouts: Dict[str, float] = {}
+    code = 0
+    if delivery is not None:
+        summary = phase_summary(delivery)
+        timings, timeouts = dict(summary.timings), dict(summary.timeouts)
+        if recipient in summary.recipients:
+            timings["rcpt"], timeouts["rcpt"] = summary.recipients[recipient]
+        code = summary.code
+        reply = delivery.recipients.get(recipient)
+        if reply is not None and reply.code not in (250, 251):
+            code = reply.code
+    return {
+        "time": round(time.time(), 3),
+        "recipient": recipient,
+        "outcome": outcome,
+        "host": host.name if host else "",
+        "address": host.address if host else "",
+        "port": host.port if host else 0,
+        "preference": host.preference if host else 0,
+        "code": code,
+        "message": message,
+        "duration_ms": round(delivery.duration * 1000, 3) if delivery else 0.0,
+        "timings_ms": timings,
+        "timeouts_ms": timeouts,
+        "tls": delivery.tls_version if delivery else "",
+        "bytes_sent": delivery.bytes_sent if delivery else 0,
+        "bytes_received": delivery.bytes_received if delivery else 0,
+    }
+
+
+class ResultsSink(abc.ABC):
+    def __enter__(self) -> "ResultsSink":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @abc.abstractmethod
+    def write(self, record: Dict[str, Any]):
+        pass
+
+    def write_result(self, result: "smtptester.Result"):
+        self.write(record(*result))
+
+    async def write_async(self, record: Dict[str, Any]):
+        self.write(record)
+
+    async def write_result_async(self, result: "smtptester.Result"):
+        await self.write_async(record(*result))
+
+    def close(self):
+        pass
+
+
+class QueuedSink(ResultsSink):
+    def __init__(self, queue_size: int = SINK_DEFAULT_QUEUE_SIZE):
+        # The queue is bounded, so a slow disk slows producers down instead of
+        # letting records pile up in memory.
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.written = 0
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._write_records, daemon=True)
+        self.thread.start()
+
+    def write(self, record: Dict[str, Any]):
+        while True:
+            self._check()
+            try:
+                self.queue.put(record, timeout=SINK_PUT_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    async def write_async(self, record: Dict[str, Any]):
+        # Producers on the event loop wait for room in another thread, so a
+        # full queue never stalls the other sessions on the loop.
+        self._check()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.write, record)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    @abc.abstractmethod
+    def write_batch(self, records: List[Dict[str, Any]]):
+        pass
+
+    def _check(self):
+        if self.error is not None:
+            raise SinkError(f"Unable to write results: {self.error}")
+        if not self.thread.is_alive():
+            raise SinkError("Results sink is closed")
+
+    def _write_records(self):
+        try:
+            self._write_batches()
+        except Exception as e:
+            self.error = e
+            log.error(f"Unable to write results: {e}")
+
+    def _write_batches(self):
+        while True:
+            records: List[Optional[Dict[str, Any]]] = [self.queue.get()]
+            with contextlib.suppress(queue.Empty):
+                while len(records) < SINK_BATCH_SIZE and records[-1] is not None:
+                    records.append(self.queue.get_nowait())
+            done = records[-1] is None
+            if done:
+                records.pop()
+            if records:
+                self.write_batch(records)
+                self.written += len(records)
+            if done:
+                break
+
+
+class JSONLinesSink(QueuedSink):
+    def __init__(
+        self,
+        f: Union[str, TextIO] = "-",
+        buffer_size: int = SINK_DEFAULT_BUFFER_SIZE,
+        queue_size: int = SINK_DEFAULT_QUEUE_SIZE,
+    ):
+        self.close_file = isinstance(f, str) and f != "-"
+        if f == "-":
+            f = sys.stdout
+        elif isinstance(f, str):
+            f = open(f, "a", buffering=buffer_size, encoding="utf-8")
+        self.file = f
+        super().__init__(queue_size=queue_size)
+
+    def close(self):
+        super().close()
+        if self.close_file:
+            self.file.close()
+        else:
+            self.file.flush()
+
+    def write_batch(self, records: List[Dict[str, Any]]):
+        self.file.write("".join(json.dumps(r) + "\n" for r in records))
+
+
+class MultiSink(ResultsSink):
+    def __init__(self, *sinks: ResultsSink):
+        self.sinks = sinks
+
+    def write(self, record: Dict[str, Any]):
+        for s in self.sinks:
+            s.write(record)
+
+    async def write_async(self, record: Dict[str, Any]):
+        for s in self.sinks:
+            await s.write_async(record)
+
+    def close(self):
+        for s in self.sinks:
+            s.close()
+
+
+class SinkError(Exception):
+    pass
@@ -1,25 +1,74 @@
+import asyncio
+import base64
+import collections
+import contextlib
+import contextvars
+import functools
 import getpass
+import hmac
 import logging
 import os
-import smtplib
 import socket
-from typing import Iterable, NamedTuple
+import ssl
+import time
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import smtptester.util as util
 import smtptester.dns as dns
+import smtptester.body as body
+import smtptester.replay as replay
+import smtptester.rto as rto
 
 
-SMTP_DEFAULT_SENDER = f"{getpass.getuser()}@{socket.getfqdn()}"
 SMTP_DEFAULT_PORT = 25
 SMTP_DEFAULT_TIMEOUT = 3
-SMTP_DEFAULT_HELO = socket.getfqdn()
 SMTP_TLS_CHOICES = ("no", "try", "yes")
 SMTP_DEFAULT_TLS = "try"
 SMTP_DEFAULT_DEBUGLEVEL = 0
 SMTP_DEFAULT_MESSAGE = f"Subject: Test{os.linesep * 2}Test"
+SMTP_AUTH_MECHANISMS = ("CRAM-MD5", "PLAIN", "LOGIN")
+SMTP_LINE_MAX = 8192
+SMTP_POOL_DEFAULT_MAX_IDLE = 2
+SMTP_STRATEGY_CHOICES = ("serial", "race")
+SMTP_DEFAULT_STRATEGY = "serial"
+SMTP_DEFAULT_STAGGER = 0.5
+SMTP_TLS_VERSION_CHOICES = ("TLSv1", "TLSv1.1", "TLSv1.2", "TLSv1.3")
+SMTP_TLS_SESSION_CACHE_SIZE = 1000
+SMTP_DEFAULT_MAX_RECIPIENTS = 100
+SMTP_BDAT_WINDOW = 8
+SMTP_PHASES = (
+    "connect",
+    "tls",
+    "banner",
+    "ehlo",
+    "starttls",
+    "auth",
+    "mail",
+    "rcpt",
+    "data",
+    "bdat",
+    "rset",
+    "quit",
+)
+
+CRLF = "\r\n"
 
 log = logging.getLogger(__name__)
 
+_tls_session: contextvars.ContextVar = contextvars.ContextVar(
+    "tls_session", default=None
+)
+
 
 class SMTPHost(NamedTuple):
     name: str
@@ -28,12 +77,81 @@ class SMTPHost(NamedTuple):
     preference: int = 0
 
 
-def hosts_discover(
+class SMTPReply(NamedTuple):
+    code: int
+    message: str
+
+
+class SMTPPhase(NamedTuple):
+    name: str
+    started: float
+    finished: float
+    code: int = 0
+    timeout: float = 0.0
+    recipient: str = ""
+
+    @property
+    def duration(self) -> float:
+        return self.finished - self.started
+
+
+class SMTPResult(NamedTuple):
+    host: SMTPHost
+    phases: List[SMTPPhase]
+    tls_version: str = ""
+    tls_cipher: str = ""
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    tls_resumed: bool = False
+    round_trips_saved: int = 0
+    recipients: Dict[str, SMTPReply] = {}
+    message_bytes: int = 0
+
+    @property
+    def duration(self) -> float:
+        if not self.phases:
+            return 0.0
+        return self.phases[-1].finished - self.phases[0].started
+
+    @property
+    def tls_handshake(self) -> float:
+        return sum(p.duration for p in self.phases if p.name == "tls")
+
+    @property
+    def codes(self) -> List[int]:
+        return [p.code for p in self.phases if p.code]
+
+
+class TLSContext(ssl.SSLContext):
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.sessions: Dict[
+            Tuple[str, str, int], ssl.SSLSession
+        ] = collections.OrderedDict()
+
+    # asyncio doesn't expose the session argument of wrap_bio(), so the session
+    # to resume is handed over by the connecting task in a context variable.
+    def wrap_bio(self, *args, session=None, **kwargs):
+        session = session or _tls_session.get()
+        return super().wrap_bio(*args, session=session, **kwargs)
+
+    def session(self, host: SMTPHost) -> Optional[ssl.SSLSession]:
+        return self.sessions.get((host.name, host.address, host.port))
+
+    def save_session(self, host: SMTPHost, session: ssl.SSLSession):
+        key = (host.name, host.address, host.port)
+        self.sessions[key] = session
+        self.sessions.move_to_end(key)
+        while len(self.sessions) > SMTP_TLS_SESSION_CACHE_SIZE:
+            self.sessions.popitem(last=False)
+
+
+async def hosts_discover_async(
     resolver: dns.DNSResolver, domain: str, port: int = SMTP_DEFAULT_PORT
 ) -> Iterable[SMTPHost]:
     hosts = []
     try:
-        for mx in resolver.mx(domain):
+        for mx in await resolver.mx_async(domain):
             hosts.append(
                 SMTPHost(
                     name=mx.name,
@@ -43,12 +161,18 @@ def hosts_discover(
                 )
             )
     except dns.DNSNoRecords:
-        address = resolver.a(domain)[0].address
+        address = (await resolver.a_async(domain))[0].address
         hosts.append(SMTPHost(name=domain, address=address, port=port))
     return hosts
 
 
-def hosts_set(
+def hosts_discover(
+    resolver: dns.DNSResolver, domain: str, port: int = SMTP_DEFAULT_PORT
+) -> Iterable[SMTPHost]:
+    return util.run_sync(hosts_discover_async(resolver, domain, port=port))
+
+
+async def hosts_set_async(
     resolver: dns.DNSResolver, host: str, port=SMTP_DEFAULT_PORT
 ) -> Iterable[SMTPHost]:
     if util.is_ip_address(host):
@@ -56,66 +180,949 @@ def hosts_set(
         address = host
     else:
         name = host
-        address = resolver.a(host)[0].address
+        address = (await resolver.a_async(host))[0].address
     return [SMTPHost(name=name, address=address, port=port, preference=0)]
 
 
+def hosts_set(
+    resolver: dns.DNSResolver, host: str, port=SMTP_DEFAULT_PORT
+) -> Iterable[SMTPHost]:
+    return util.run_sync(hosts_set_async(resolver, host, port=port))
+
+
+class SMTPClient:
+    def __init__(
+        self,
+        host: SMTPHost,
+        timeout: int = SMTP_DEFAULT_TIMEOUT,
+        helo: str = "",
+        debuglevel: int = SMTP_DEFAULT_DEBUGLEVEL,
+        tls_context: Optional[TLSContext] = None,
+        timeouts: Optional[rto.AdaptiveTimeouts] = None,
+        recorder: Optional[replay.Capture] = None,
+    ):
+        self.host = host
+        self.timeout = timeout
+        self.timeouts = timeouts
+        self.recorder = recorder
+        self.transcript: Optional[replay.Transcript] = None
+        self.phase_timeout: float = timeout
+        self.helo = helo or default_helo()
+        self.debuglevel = debuglevel
+        self.tls_context = tls_context or make_tls_context()
+        self.extensions: Dict[str, str] = {}
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.tls_version = ""
+        self.tls_cipher = ""
+        self.tls_resumed = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.phases: List[SMTPPhase] = []
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.last_code = 0
+        self.round_trips_saved = 0
+        self.recipients: Dict[str, SMTPReply] = {}
+        self.message_bytes = 0
+
+    @property
+    def last_timeout(self) -> float:
+        return self.phases[-1].timeout if self.phases else self.timeout
+
+    def result(self) -> SMTPResult:
+        return SMTPResult(
+            host=self.host,
+            phases=list(self.phases),
+            tls_version=self.tls_version,
+            tls_cipher=self.tls_cipher,
+            bytes_sent=self.bytes_sent,
+            bytes_received=self.bytes_received,
+            tls_resumed=self.tls_resumed,
+            round_trips_saved=self.round_trips_saved,
+            recipients=dict(self.recipients),
+            message_bytes=self.message_bytes,
+        )
+
+    @contextlib.contextmanager
+    def phase(self, name: str, recipient: str = ""):
+        # With adaptive timeouts, every phase gets its own timeout based on
+        # how long the same phase has taken on this host before.
+        key = f"smtp {self.host.address}:{self.host.port} {name}"
+        if self.timeouts is not None:
+            self.phase_timeout = self.timeouts.timeout(key, self.timeout)
+        started = time.monotonic()
+        self.last_code = 0
+        answered = False
+        try:
+            yield
+            answered = True
+        except SMTPException:
+            # An error reply still measures a round trip.
+            answered = True
+            raise
+        except asyncio.TimeoutError:
+            if self.timeouts is not None:
+                self.timeouts.backoff(key, self.timeout)
+            raise
+        finally:
+            finished = time.monotonic()
+            if answered and self.timeouts is not None:
+                self.timeouts.sample(key, finished - started)
+            code = self.last_code
+            phase = SMTPPhase(
+                name, started, finished, code, self.phase_timeout, recipient
+            )
+            self.phases.append(phase)
+            self.phase_timeout = self.timeout
+
+    async def connect(self, tls: bool = False):
+        with self.phase("connect"):
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    self.host.address, self.host.port, limit=SMTP_LINE_MAX
+                ),
+                self.phase_timeout,
+            )
+        if self.recorder is not None:
+            host = self.host
+            self.transcript = self.recorder.session(host.name, host.address, host.port)
+        if tls:
+            await self._start_tls()
+        with self.phase("banner"):
+            self._check(await self.reply(), 220)
+
+    async def close(self):
+        if self.writer is not None:
+            self.save_tls_session()
+            self.writer.close()
+            try:
+                await asyncio.wait_for(self.writer.wait_closed(), self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                pass
+            self.reader = self.writer = None
+
+    async def command(self, line: str) -> SMTPReply:
+        await self.write(line)
+        return await self.reply()
+
+    async def write(self, *lines: str):
+        for line in lines:
+            self._debug(f"send: {line!r}")
+            if self.transcript is not None:
+                self.transcript.client(line)
+        data = "".join(f"{line}{CRLF}" for line in lines).encode()
+        self.bytes_sent += len(data)
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), self.phase_timeout)
+
+    async def reply(self) -> SMTPReply:
+        code = 0
+        lines = []
+        raw = []
+        while True:
+            try:
+                line = await asyncio.wait_for(
+                    self.reader.readline(), self.phase_timeout
+                )
+            except ValueError:
+                raise SMTPTemporaryError("Reply line too long") from None
+            self._debug(f"reply: {line!r}")
+            self.bytes_received += len(line)
+            if not line.endswith(b"\n"):
+                if self.transcript is not None:
+                    self.transcript.closed()
+                raise ConnectionResetError("Connection unexpectedly closed")
+            line = line.decode("utf-8", "replace").rstrip(CRLF)
+            raw.append(line)
+            try:
+                code = int(line[:3])
+            except ValueError:
+                raise SMTPTemporaryError(f"Invalid reply: {line}") from None
+            lines.append(line[4:])
+            self.last_code = code
+            if line[3:4] != "-":
+                if self.transcript is not None:
+                    self.transcript.server(CRLF.join(raw))
+                return SMTPReply(code=code, message="\n".join(lines))
+
+    async def ehlo(self) -> SMTPReply:
+        with self.phase("ehlo"):
+            return await self._ehlo()
+
+    async def _ehlo(self) -> SMTPReply:
+        self.extensions = {}
+        reply = await self.command(f"EHLO {self.helo}")
+        if reply.code != 250:
+            return self._check(await self.command(f"HELO {self.helo}"), 250)
+        for line in reply.message.split("\n")[1:]:
+            keyword, _, params = line.partition(" ")
+            self.extensions[keyword.upper()] = params
+        return reply
+
+    def has_extn(self, name: str) -> bool:
+        return name.upper() in self.extensions
+
+    async def starttls(self):
+        with self.phase("starttls"):
+            self._check(await self.command("STARTTLS"), 220)
+        await self._start_tls()
+        await self.ehlo()
+
+    async def login(self, user: str, password: str):
+        with self.phase("auth"):
+            await self._login(user, password)
+
+    async def _login(self, user: str, password: str):
+        if not self.has_extn("AUTH"):
+            raise SMTPPermanentError("SMTP AUTH extension not supported by server")
+        advertised = self.extensions["AUTH"].upper().split()
+        for mechanism in SMTP_AUTH_MECHANISMS:
+            if mechanism in advertised:
+                break
+        else:
+            raise SMTPPermanentError("No suitable authentication method found")
+
+        if mechanism == "CRAM-MD5":
+            reply = self._check(await self.command("AUTH CRAM-MD5"), 334)
+            challenge = base64.b64decode(reply.message)
+            digest = hmac.new(password.encode(), challenge, "md5").hexdigest()
+            reply = await self.command(_b64(f"{user} {digest}"))
+        elif mechanism == "PLAIN":
+            credentials = _b64(f"\0{user}\0{password}")
+            reply = await self.command(f"AUTH PLAIN {credentials}")
+        else:
+            self._check(await self.command(f"AUTH LOGIN {_b64(user)}"), 334)
+            reply = await self.command(_b64(password))
+        self._check(reply, 235)
+
+    async def mail(self, sender: str) -> SMTPReply:
+        with self.phase("mail"):
+            return self._check(await self.command(f"MAIL FROM:<{sender}>"), 250)
+
+    async def rcpt(self, recipient: str) -> SMTPReply:
+        with self.phase("rcpt", recipient):
+            reply = await self.command(f"RCPT TO:<{recipient}>")
+            self.recipients[recipient] = reply
+            return self._check(reply, 250, 251)
+
+    def check_recipients(self, recipients: Iterable[str]):
+        replies = [self.recipients[r] for r in recipients]
+        failed = [r for r in replies if r.code not in (250, 251)]
+        if failed and len(failed) == len(replies):
+            temporary = [r for r in failed if r.code < 500]
+            self._check((temporary or failed)[0], 250, 251)
+
+    async def envelope(
+        self, sender: str, recipients: List[str], pipelining: bool = True
+    ):
+        if pipelining:
+            with self.phase("mail"):
+                rcpts = [f"RCPT TO:<{r}>" for r in recipients]
+                await self.write(f"MAIL FROM:<{sender}>", *rcpts)
+                self.round_trips_saved += len(recipients)
+                mail = await self.reply()
+            for recipient in recipients:
+                with self.phase("rcpt", recipient):
+                    self.recipients[recipient] = await self.reply()
+            self._check(mail, 250)
+        else:
+            await self.mail(sender)
+            for recipient in recipients:
+                try:
+                    await self.rcpt(recipient)
+                except SMTPException:
+                    if recipient not in self.recipients:
+                        raise
+        self.check_recipients(recipients)
+
+    async def data(self, message: body.MessageBody) -> SMTPReply:
+        with self.phase("data"):
+            self._check(await self.command("DATA"), 354)
+            return await self._body(message)
+
+    async def bdat(
+        self, message: body.MessageBody, pipelining: bool = True
+    ) -> SMTPReply:
+        # RFC 3030: the message goes out unstuffed in sized chunks. With
+        # pipelining, up to SMTP_BDAT_WINDOW chunks are in flight at once.
+        window = SMTP_BDAT_WINDOW if pipelining else 1
+        pending = chunks = waits = 0
+
+        async def send(chunk: bytes, last: bool) -> Optional[SMTPReply]:
+            nonlocal pending, chunks, waits
+            line = f"BDAT {len(chunk)} LAST" if last else f"BDAT {len(chunk)}"
+            self._debug(f"send: {line!r} + {len(chunk)} bytes")
+            if self.transcript is not None:
+                self.transcript.client(line)
+            data = f"{line}{CRLF}".encode()
+            self.bytes_sent += len(data) + len(chunk)
+            self.message_bytes += len(chunk)
+            self.writer.write(data)
+            self.writer.write(chunk)
+            await asyncio.wait_for(self.writer.drain(), self.phase_timeout)
+            pending += 1
+            chunks += 1
+            if not last and pending < window:
+                return None
+            waits += 1
+            reply = None
+            while pending > (0 if last else window - 1):
+                reply = self._check(await self.reply(), 250)
+                pending -= 1
+            return reply
+
+        with self.phase("bdat"):
+            previous = b""
+            for chunk in body.encode(message.chunks(), stuff=False):
+                if previous:
+                    await send(previous, last=False)
+                previous = chunk
+            reply = await send(previous, last=True)
+            self.round_trips_saved += chunks - waits
+            return reply
+
+    async def pipeline(
+        self, sender: str, recipients: List[str], message: body.MessageBody
+    ) -> SMTPReply:
+        # RFC 2920: MAIL, RCPT and DATA go out in one write, then the replies
+        # are read back in order.
+        with self.phase("mail"):
+            rcpts = [f"RCPT TO:<{r}>" for r in recipients]
+            await self.write(f"MAIL FROM:<{sender}>", *rcpts, "DATA")
+            self.round_trips_saved += len(recipients) + 1
+            mail = await self.reply()
+        for recipient in recipients:
+            with self.phase("rcpt", recipient):
+                self.recipients[recipient] = await self.reply()
+        with self.phase("data"):
+            data = await self.reply()
+            try:
+                self._check(mail, 250)
+                self.check_recipients(recipients)
+            except SMTPException:
+                if data.code == 354:
+                    # The server accepted DATA anyway, so end an empty message
+                    # to get the connection back into a known state.
+                    await self.write(".")
+                    await self.reply()
+                raise
+            self._check(data, 354)
+            return await self._body(message)
+
+    async def rset(self) -> SMTPReply:
+        with self.phase("rset"):
+            return self._check(await self.command("RSET"), 250)
+
+    async def quit(self):
+        try:
+            with self.phase("quit"):
+                await self.command("QUIT")
+        finally:
+            await self.close()
+
+    async def probe(
+        self, sender: str, recipient: str, pipelining: bool = True
+    ) -> SMTPReply:
+        sender = sender or default_sender()
+        if pipelining and self.has_extn("PIPELINING"):
+            with self.phase("mail"):
+                await self.write(f"MAIL FROM:<{sender}>", f"RCPT TO:<{recipient}>")
+                self.round_trips_saved += 1
+                mail = await self.reply()
+            with self.phase("rcpt", recipient):
+                self.recipients[recipient] = await self.reply()
+            self._check(mail, 250)
+        else:
+            await self.mail(sender)
+            try:
+                await self.rcpt(recipient)
+            except SMTPException:
+                if recipient not in self.recipients:
+                    raise
+        reply = self.recipients[recipient]
+        if reply.code == 421:
+            self._check(reply)
+        return reply
+
+    async def _body(self, message: body.MessageBody) -> SMTPReply:
+        self._debug(f"data: {message.size} bytes")
+        size = 0
+        for chunk in body.encode(message.chunks()):
+            size += len(chunk)
+            self.bytes_sent += len(chunk)
+            self.message_bytes += len(chunk)
+            self.writer.write(chunk)
+            await asyncio.wait_for(self.writer.drain(), self.phase_timeout)
+        if self.transcript is not None:
+            # Only the size of the message is recorded, not its content.
+            self.transcript.client(f"<{size} bytes>")
+        self._debug(f"data: {self.message_bytes} bytes on the wire")
+        return self._check(await self.reply(), 250)
+
+    def save_tls_session(self):
+        ssl_object = self.writer.get_extra_info("ssl_object")
+        # TLS 1.3 session tickets arrive after the handshake, so this is only
+        # worth doing once the server has sent something over the TLS session.
+        if ssl_object is not None and ssl_object.session is not None:
+            self.tls_context.save_session(self.host, ssl_object.session)
+
+    async def _start_tls(self):
+        token = _tls_session.set(self.tls_context.session(self.host))
+        try:
+            with self.phase("tls"):
+                await asyncio.wait_for(
+                    start_tls(
+                        self.reader,
+                        self.writer,
+                        self.tls_context,
+                        server_hostname=self.host.name or self.host.address,
+                    ),
+                    self.phase_timeout,
+                )
+        finally:
+            _tls_session.reset(token)
+        ssl_object = self.writer.get_extra_info("ssl_object")
+        self.tls_version = ssl_object.version() or ""
+        self.tls_cipher = (ssl_object.cipher() or ("",))[0]
+        self.tls_resumed = ssl_object.session_reused
+        if self.transcript is not None:
+            self.transcript.tls(self.tls_version)
+        resumed = " (resumed)" if self.tls_resumed else ""
+        log.debug(f"TLS established: {self.tls_version} {self.tls_cipher}{resumed}")
+
+    def _check(self, reply: SMTPReply, *codes: int) -> SMTPReply:
+        if reply.code in codes:
+            return reply
+        exception = SMTPPermanentError if reply.code >= 500 else SMTPTemporaryError
+        message = reply.message.replace("\n", " ")
+        raise exception(f"{reply.code} {message}", code=reply.code)
+
+    def _debug(self, msg: str):
+        if self.debuglevel > 0:
+            log.debug(msg)
+
+
+async def start_tls(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    tls_context: ssl.SSLContext,
+    server_hostname: str = "",
+):
+    if hasattr(writer, "start_tls"):
+        await writer.start_tls(tls_context, server_hostname=server_hostname or None)
+        return
+    # StreamWriter.start_tls() was added in Python 3.11
+    await writer.drain()
+    loop = asyncio.get_running_loop()
+    protocol = writer.transport.get_protocol()
+    transport = await loop.start_tls(
+        writer.transport,
+        protocol,
+        tls_context,
+        server_hostname=server_hostname or None,
+    )
+    writer._transport = transport
+    protocol._transport = transport
+    protocol._over_ssl = True
+
+
+# The defaults need a reverse DNS lookup, which can block for seconds on hosts
+# with broken DNS, so they're only looked up when first needed.
+@functools.lru_cache(maxsize=None)
+def default_helo() -> str:
+    return socket.getfqdn()
+
+
+@functools.lru_cache(maxsize=None)
+def default_sender() -> str:
+    return f"{getpass.getuser()}@{default_helo()}"
+
+
+def __getattr__(name: str):
+    if name == "SMTP_DEFAULT_SENDER":
+        return default_sender()
+    if name == "SMTP_DEFAULT_HELO":
+        return default_helo()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Contexts are cached so the CA store is only loaded once, and so sessions can
+# be resumed (a session can only be used with the context that created it).
+@functools.lru_cache(maxsize=None)
+def make_tls_context(
+    ca_file: str = "", min_version: str = "", ciphers: str = ""
+) -> TLSContext:
+    context = TLSContext(ssl.PROTOCOL_TLS_CLIENT)
+    if ca_file:
+        context.load_verify_locations(ca_file)
+    else:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if min_version:
+        context.minimum_version = ssl.TLSVersion[min_version.replace(".", "_")]
+    if ciphers:
+        context.set_ciphers(ciphers)
+    return context
+
+
+def dot_stuff(message: str) -> bytes:
+    return b"".join(body.encode([message.encode("utf-8")]))
+
+
+def log_host(host: SMTPHost) -> str:
+    return f"{host.name}({host.address}):{host.port}"
+
+
+def host_failed(
+    host: SMTPHost, timeout: float, result: Optional[SMTPResult] = None
+) -> "SMTPTemporaryError":
+    msg = f"SMTP host failed: {log_host(host)} Timeout={timeout:g}s"
+    return SMTPTemporaryError(msg, result=result)
+
+
+def format_phases(phases: Iterable[SMTPPhase]) -> str:
+    return " ".join(f"{p.name}={p.duration * 1000:.1f}ms" for p in phases)
+
+
+def format_timeouts(phases: Iterable[SMTPPhase]) -> str:
+    return " ".join(f"{p.name}={p.timeout:.2f}s" for p in phases)
+
+
+def _b64(s: str) -> str:
+    return base64.b64encode(s.encode()).decode()
+
+
+async def connect_async(
+    host: SMTPHost,
+    timeout: int = SMTP_DEFAULT_TIMEOUT,
+    helo: str = "",
+    tls: str = SMTP_DEFAULT_TLS,
+    auth_user: str = "",
+    auth_pass: str = "",
+    debuglevel: int = SMTP_DEFAULT_DEBUGLEVEL,
+    tls_context: Optional[TLSContext] = None,
+    timeouts: Optional[rto.AdaptiveTimeouts] = None,
+    recorder: Optional[replay.Capture] = None,
+) -> SMTPClient:
+    client = SMTPClient(
+        host,
+        timeout=timeout,
+        helo=helo,
+        debuglevel=debuglevel,
+        tls_context=tls_context,
+        timeouts=timeouts,
+        recorder=recorder,
+    )
+    try:
+        await setup_async(client, tls=tls, auth_user=auth_user, auth_pass=auth_pass)
+    except BaseException:
+        await client.close()
+        raise
+    return client
+
+
+async def setup_async(
+    client: SMTPClient,
+    tls: str = SMTP_DEFAULT_TLS,
+    auth_user: str = "",
+    auth_pass: str = "",
+):
+    log.debug(f"Trying SMTP host: {log_host(client.host)}")
+    await client.connect(tls=tls == "yes")
+    await client.ehlo()
+    if tls == "try" and client.has_extn("STARTTLS"):
+        await client.starttls()
+    if client.tls_version:
+        client.save_tls_session()
+    if auth_user or auth_pass:
+        await client.login(auth_user, auth_pass)
+
+
+async def transaction_async(
+    client: SMTPClient,
+    recipients: Union[str, Iterable[str]],
+    sender: str = "",
+    message: Union[str, bytes, body.MessageBody] = SMTP_DEFAULT_MESSAGE,
+    pipelining: bool = True,
+    chunking: bool = True,
+) -> SMTPReply:
+    recipients = [recipients] if isinstance(recipients, str) else list(recipients)
+    sender = sender or default_sender()
+    message = body.PrefixedBody(f"From: {sender}{CRLF}", body.message_body(message))
+    pipelining = pipelining and client.has_extn("PIPELINING")
+    if chunking and client.has_extn("CHUNKING"):
+        await client.envelope(sender, recipients, pipelining=pipelining)
+        return await client.bdat(message, pipelining=pipelining)
+    if pipelining:
+        return await client.pipeline(sender, recipients, message)
+    await client.envelope(sender, recipients, pipelining=False)
+    return await client.data(message)
+
+
+async def send_async(
+    host: SMTPHost,
+    recipients: Union[str, Iterable[str]],
+    sender: str = "",
+    message: Union[str, bytes, body.MessageBody] = SMTP_DEFAULT_MESSAGE,
+    timeout: int = SMTP_DEFAULT_TIMEOUT,
+    helo: str = "",
+    tls: str = SMTP_DEFAULT_TLS,
+    auth_user: str = "",
+    auth_pass: str = "",
+    debuglevel: int = SMTP_DEFAULT_DEBUGLEVEL,
+    tls_context: Optional[TLSContext] = None,
+    pipelining: bool = True,
+    timeouts: Optional[rto.AdaptiveTimeouts] = None,
+    recorder: Optional[replay.Capture] = None,
+) -> SMTPResult:
+    client = SMTPClient(
+        host,
+        timeout=timeout,
+        helo=helo,
+        debuglevel=debuglevel,
+        tls_context=tls_context,
+        timeouts=timeouts,
+        recorder=recorder,
+    )
+    try:
+        await setup_async(client, tls=tls, auth_user=auth_user, auth_pass=auth_pass)
+        await transaction_async(
+            client, recipients, sender=sender, message=message, pipelining=pipelining
+        )
+        await client.quit()
+        log.info(f"Message accepted by {log_host(host)}")
+        return client.result()
+    except SMTPException as e:
+        e.result = client.result()
+        raise
+    # Base class for ConnectionError, ssl.SSLError, socket.timeout, etc.
+    except (OSError, asyncio.TimeoutError) as e:
+        raise host_failed(host, client.last_timeout, result=client.result()) from e
+    finally:
+        await client.close()
+
+
 def send(
     host: SMTPHost,
-    recipient: str,
-    sender: str = SMTP_DEFAULT_SENDER,
-    message: str = SMTP_DEFAULT_MESSAGE,
+    recipients: Union[str, Iterable[str]],
+    sender: str = "",
+    message: Union[str, bytes, body.MessageBody] = SMTP_DEFAULT_MESSAGE,
     timeout: int = SMTP_DEFAULT_TIMEOUT,
-    helo: str = SMTP_DEFAULT_HELO,
+    helo: str = "",
     tls: str = SMTP_DEFAULT_TLS,
     auth_user: str = "",
     auth_pass: str = "",
     debuglevel: int = SMTP_DEFAULT_DEBUGLEVEL,
+    tls_context: Optional[TLSContext] = None,
+    pipelining: bool = True,
+    timeouts: Optional[rto.AdaptiveTimeouts] = None,
+    recorder: Optional[replay.Capture] = None,
 ):
+    return util.run_sync(
+        send_async(
+            host,
+            recipients,
+            sender=sender,
+            message=message,
+            timeout=timeout,
+            helo=helo,
+            tls=tls,
+            auth_user=auth_user,
+            auth_pass=auth_pass,
+            debuglevel=debuglevel,
+            tls_context=tls_context,
+            pipelining=pipelining,
+            timeouts=timeouts,
+            recorder=recorder,
+        )
+    )
+
+
+async def race_async(
+    hosts: Iterable[SMTPHost],
+    recipients: Union[str, Iterable[str]],
+    sender: str = "",
+    message: Union[str, bytes, body.MessageBody] = SMTP_DEFAULT_MESSAGE,
+    timeout: int = SMTP_DEFAULT_TIMEOUT,
+    helo: str = "",
+    tls: str = SMTP_DEFAULT_TLS,
+    auth_user: str = "",
+    auth_pass: str = "",
+    debuglevel: int = SMTP_DEFAULT_DEBUGLEVEL,
+    stagger: float = SMTP_DEFAULT_STAGGER,
+    tls_context: Optional[TLSContext] = None,
+    pipelining: bool = True,
+    timeouts: Optional[rto.AdaptiveTimeouts] = None,
+    recorder: Optional[replay.Capture] = None,
+) -> SMTPResult:
+    # Sessions are set up in parallel (staggered in preference order), but the
+    # transaction only ever runs on one established session at a time, so a
+    # message can't be accepted by more than one host.
+    queue = list(hosts)
+    order = {h: i for i, h in enumerate(queue)}
+    pending: Dict[asyncio.Future, SMTPClient] = {}
+    established: List[SMTPClient] = []
+    error: Optional[SMTPException] = None
+
+    def start():
+        host = queue.pop(0)
+        client = SMTPClient(
+            host,
+            timeout=timeout,
+            helo=helo,
+            debuglevel=debuglevel,
+            tls_context=tls_context,
+            timeouts=timeouts,
+            recorder=recorder,
+        )
+        setup = setup_async(client, tls=tls, auth_user=auth_user, auth_pass=auth_pass)
+        pending[asyncio.ensure_future(setup)] = client
+
+    def failed(client: SMTPClient, e: BaseException) -> SMTPException:
+        if not isinstance(e, SMTPException):
+            cause, e = e, host_failed(client.host, client.last_timeout)
+            e.__cause__ = cause
+        e.result = client.result()
+        if isinstance(e, SMTPPermanentError):
+            raise e
+        log.warning(e)
+        return e
 
-    log_host = f"{host.name}({host.address}):{host.port}"
     try:
-        log.debug(f"Trying SMTP host: {log_host}")
-        f = smtplib.SMTP_SSL if tls == 'yes' else smtplib.SMTP
-        s = f(
-            host=host.address, port=host.port, timeout=timeout, local_hostname=helo
+        while queue or pending or established:
+            if established:
+                client = min(established, key=lambda c: order[c.host])
+                established.remove(client)
+                try:
+                    await transaction_async(
+                        client,
+                        recipients,
+                        sender=sender,
+                        message=message,
+                        pipelining=pipelining,
+                    )
+                    await client.quit()
+                    log.info(f"Message accepted by {log_host(client.host)}")
+                    return client.result()
+                except (SMTPException, OSError, asyncio.TimeoutError) as e:
+                    error = failed(client, e)
+                finally:
+                    await client.close()
+                continue
+
+            if not pending:
+                start()
+            done, _ = await asyncio.wait(
+                pending,
+                timeout=stagger if queue else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                log.debug(f"No SMTP session after {stagger}s, starting another")
+                start()
+            for task in done:
+                client = pending.pop(task)
+                try:
+                    task.result()
+                    established.append(client)
+                except (SMTPException, OSError, asyncio.TimeoutError) as e:
+                    await client.close()
+                    error = failed(client, e)
+                    if queue:
+                        start()
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for client in list(pending.values()) + established:
+            await client.close()
+
+    raise error or SMTPTemporaryError("No SMTP hosts available")
+
+
+def race(
+    hosts: Iterable[SMTPHost], recipients: Union[str, Iterable[str]], **options
+) -> SMTPResult:
+    return util.run_sync(race_async(hosts, recipients, **options))
+
+
+class SMTPPool:
+    def __init__(
+        self,
+        timeout: int = SMTP_DEFAULT_TIMEOUT,
+        helo: str = "",
+        tls: str = SMTP_DEFAULT_TLS,
+        auth_user: str = "",
+        auth_pass: str = "",
+        debuglevel: int = SMTP_DEFAULT_DEBUGLEVEL,
+        max_idle: int = SMTP_POOL_DEFAULT_MAX_IDLE,
+        tls_context: Optional[TLSContext] = None,
+        pipelining: bool = True,
+        max_connections: int = 0,
+    ):
+        self.timeout = timeout
+        self.helo = helo
+        self.tls = tls
+        self.auth_user = auth_user
+        self.auth_pass = auth_pass
+        self.debuglevel = debuglevel
+        self.max_idle = max_idle
+        self.tls_context = tls_context
+        self.pipelining = pipelining
+        self.max_connections = max_connections
+        self.idle: Dict[SMTPHost, List[SMTPClient]] = {}
+        self.limits: Dict[SMTPHost, asyncio.Semaphore] = {}
+        self.connections = 0
+
+    def __enter__(self) -> "SMTPPool":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    async def __aenter__(self) -> "SMTPPool":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close_async()
+
+    def send(
+        self,
+        host: SMTPHost,
+        recipients: Union[str, Iterable[str]],
+        sender: str = "",
+        message: Union[str, bytes, body.MessageBody] = SMTP_DEFAULT_MESSAGE,
+    ) -> SMTPResult:
+        return util.run_sync(
+            self.send_async(host, recipients, sender=sender, message=message)
         )
-        s.set_debuglevel(debuglevel)
-        s.ehlo_or_helo_if_needed()
-        if (tls == "try" and s.has_extn("STARTTLS")):
-            s.starttls()
-        if auth_user or auth_pass:
-            s.login(auth_user, auth_pass)
-        headers = f"From: {sender}{os.linesep}"
-        s.sendmail(sender, recipient, headers + message)
-        s.quit()
-        log.info(f"Message accepted by {log_host}")
-    except smtplib.SMTPRecipientsRefused as e:
-        raise SMTPPermanentError(exception_message(e.args)) from e
-    except smtplib.SMTPResponseException as e:
-        if e.smtp_code >= 500:
-            exception = SMTPPermanentError
+
+    async def send_async(
+        self,
+        host: SMTPHost,
+        recipients: Union[str, Iterable[str]],
+        sender: str = "",
+        message: Union[str, bytes, body.MessageBody] = SMTP_DEFAULT_MESSAGE,
+    ) -> SMTPResult:
+        async def transaction(client: SMTPClient):
+            await transaction_async(
+                client,
+                recipients,
+                sender=sender,
+                message=message,
+                pipelining=self.pipelining,
+            )
+
+        result = await self.run_async(host, transaction)
+        log.info(f"Message accepted by {log_host(host)}")
+        return result
+
+    async def verify_async(
+        self, host: SMTPHost, recipient: str, sender: str = ""
+    ) -> SMTPResult:
+        async def transaction(client: SMTPClient):
+            await client.probe(sender, recipient, pipelining=self.pipelining)
+
+        return await self.run_async(host, transaction)
+
+    async def run_async(
+        self, host: SMTPHost, transaction: Callable[[SMTPClient], Awaitable]
+    ) -> SMTPResult:
+        if not self.max_connections:
+            return await self._run(host, transaction)
+        if host not in self.limits:
+            self.limits[host] = asyncio.Semaphore(self.max_connections)
+        async with self.limits[host]:
+            return await self._run(host, transaction)
+
+    async def _run(
+        self, host: SMTPHost, transaction: Callable[[SMTPClient], Awaitable]
+    ) -> SMTPResult:
+        while True:
+            client, reused = await self._acquire(host)
+            try:
+                await transaction(client)
+            except SMTPException as e:
+                e.result = client.result()
+                if e.code == 421:
+                    await client.close()
+                    if reused:
+                        log.debug(f"Reconnecting to {log_host(host)}: {e}")
+                        continue
+                else:
+                    await self._release(client)
+                raise
+            except (OSError, asyncio.TimeoutError) as e:
+                await client.close()
+                if reused and isinstance(e, ConnectionError):
+                    log.debug(f"Reconnecting to {log_host(host)}: {e!r}")
+                    continue
+                raise host_failed(host, self.timeout, client.result()) from e
+            except BaseException:
+                await client.close()
+                raise
+            result = client.result()
+            await self._release(client)
+            return result
+
+    def close(self):
+        util.run_sync(self.close_async())
+
+    async def close_async(self):
+        clients = [c for clients in self.idle.values() for c in clients]
+        self.idle = {}
+        await asyncio.gather(*(self._quit(c) for c in clients))
+
+    async def _acquire(self, host: SMTPHost) -> Tuple[SMTPClient, bool]:
+        idle = self.idle.get(host, [])
+        while idle:
+            client = idle.pop()
+            client.reset_stats()
+            try:
+                await client.rset()
+                return client, True
+            except (SMTPException, OSError, asyncio.TimeoutError) as e:
+                log.debug(f"Discarding connection to {log_host(host)}: {e!r}")
+                await client.close()
+        try:
+            client = await connect_async(
+                host,
+                timeout=self.timeout,
+                helo=self.helo,
+                tls=self.tls,
+                auth_user=self.auth_user,
+                auth_pass=self.auth_pass,
+                debuglevel=self.debuglevel,
+                tls_context=self.tls_context,
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            raise host_failed(host, self.timeout) from e
+        self.connections += 1
+        return client, False
+
+    async def _release(self, client: SMTPClient):
+        idle = self.idle.setdefault(client.host, [])
+        if client.writer is None or len(idle) >= self.max_idle:
+            await self._quit(client)
         else:
-            exception = SMTPTemporaryError
-        raise exception(f"{e.smtp_code} {e.smtp_error}") from e
-    except smtplib.SMTPException as e:
-        raise SMTPTemporaryError(exception_message(e.args)) from e
-    # Base class for smtplib.SMTPConnectError, socket.timeout,
-    # TimeoutError, etc. See: https://bugs.python.org/issue20903
-    except OSError as e:
-        msg = f"SMTP host failed: {log_host} Timeout={timeout}s"
-        raise SMTPTemporaryError(msg) from e
-
-
-def exception_message(args: tuple) -> str:
-    if isinstance(args[0], str):
-        return args[0]
-    else:
-        return ", ".join(f"{r[0]} {r[1].decode('utf-8')}" for r in args[0].values())
+            idle.append(client)
+
+    async def _quit(self, client: SMTPClient):
+        try:
+            await client.quit()
+        except (SMTPException, OSError, asyncio.TimeoutError):
+            await client.close()
 
 
 class SMTPException(Exception):
-    pass
+    def __init__(
+        self, message: str, code: int = 0, result: Optional[SMTPResult] = None
+    ):
+        super().__init__(message)
+        self.code = code
+        self.result = result
 
 
 class SMTPTemporaryError(SMTPException):
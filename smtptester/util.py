@@ -1,6 +1,15 @@
+import asyncio
 import ipaddress
 import re
-from typing import NamedTuple
+import threading
+from typing import Awaitable, Callable, List, NamedTuple, Optional, TypeVar
+
+
+T = TypeVar("T")
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_loop_lock = threading.Lock()
 
 
 class EmailAddress(NamedTuple):
@@ -8,6 +17,32 @@ class EmailAddress(NamedTuple):
     domain: str
 
 
+class CancelToken:
+    def __init__(self):
+        self.cancelled = False
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
 def is_ip_address(addr: str) -> bool:
     try:
         ipaddress.ip_address(addr)
@@ -24,3 +59,42 @@ def parse_email_address(address: str) -> EmailAddress:
     d = "" if d_match is None else d_match.group(1)
 
     return EmailAddress(user=u, domain=d)
+
+
+def event_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(
+                target=_loop.run_forever, name="smtptester-loop", daemon=True
+            )
+            _loop_thread.start()
+    return _loop
+
+
+def run_sync(coro: Awaitable[T], cancel: Optional[CancelToken] = None) -> T:
+    loop = event_loop()
+    if threading.current_thread() is _loop_thread:
+        raise RuntimeError("run_sync() cannot be called from the event loop thread")
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return future.result()
+    except KeyboardInterrupt:
+        if cancel is None:
+            future.cancel()
+            raise
+    # The coroutine handles its own cancellation, so it gets the chance to
+    # clean up and return whatever it has.
+    cancel.cancel()
+    return future.result()
+
+
+async def gather(*aws: Awaitable[T]) -> List[T]:
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import queue
+import secrets
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+import smtptester
+import smtptester.dns as dns
+import smtptester.smtp as smtp
+import smtptester.util as util
+
+
+VERIFY_DEFAULT_CONCURRENCY = 100
+VERIFY_DEFAULT_CONNECTIONS_PER_HOST = 2
+VERIFY_PROBE_USER = "smtptester-probe"
+
+log = logging.getLogger(__name__)
+
+
+class Verifier:
+    def __init__(
+        self,
+        resolver: dns.DNSResolver,
+        sender: str = "",
+        smtp_host: str = "",
+        smtp_port: int = smtp.SMTP_DEFAULT_PORT,
+        timeout: int = smtp.SMTP_DEFAULT_TIMEOUT,
+        helo: str = "",
+        tls: str = smtp.SMTP_DEFAULT_TLS,
+        auth_user: str = "",
+        auth_pass: str = "",
+        tls_context: Optional[smtp.TLSContext] = None,
+        pipelining: bool = True,
+        connections_per_host: int = VERIFY_DEFAULT_CONNECTIONS_PER_HOST,
+    ):
+        self.resolver = resolver
+        self.sender = sender
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.pool = smtp.SMTPPool(
+            timeout=timeout,
+            helo=helo,
+            tls=tls,
+            auth_user=auth_user,
+            auth_pass=auth_pass,
+            tls_context=tls_context,
+            pipelining=pipelining,
+            max_idle=connections_per_host,
+            max_connections=connections_per_host,
+        )
+        self.hosts: Dict[str, asyncio.Future] = {}
+        self.catch_all: Dict[str, asyncio.Future] = {}
+
+    async def run_async(
+        self,
+        recipients: Iterable[str],
+        callback: Callable[["smtptester.Result"], None],
+        concurrency: int = VERIFY_DEFAULT_CONCURRENCY,
+    ):
+        # Recipients can come from a pipe that goes quiet, so they're read in
+        # another thread and handed to the workers through a queue.
+        recipients = iter(recipients)
+        workers = max(concurrency, 1)
+        pending: asyncio.Queue = asyncio.Queue(maxsize=workers)
+        loop = asyncio.get_running_loop()
+
+        async def reader():
+            while True:
+                recipient = await loop.run_in_executor(None, next, recipients, None)
+                if recipient is None:
+                    break
+                await pending.put(recipient)
+            for _ in range(workers):
+                await pending.put(None)
+
+        async def worker():
+            while True:
+                recipient = await pending.get()
+                if recipient is None:
+                    break
+                callback(await self.verify_async(recipient))
+
+        await util.gather(reader(), *(worker() for _ in range(workers)))
+
+    async def verify_async(self, recipient: str) -> "smtptester.Result":
+        domain = util.parse_email_address(recipient).domain.lower()
+        try:
+            hosts = await self._memo(self.hosts, domain, self._discover)
+        except dns.DNSException as e:
+            return smtptester.Result(recipient, smtptester.RESULT_ERROR, message=str(e))
+        catch_all = await self._memo(
+            self.catch_all, domain, self._probe_catch_all, hosts
+        )
+        result = await self._probe(hosts, recipient)
+        if catch_all and result.outcome == smtptester.RESULT_ACCEPTED:
+            result = result._replace(outcome=smtptester.RESULT_CATCH_ALL)
+        return result
+
+    async def close_async(self):
+        await self.pool.close_async()
+
+    async def _memo(
+        self, memo: Dict[str, asyncio.Future], key: str, fn: Callable, *args
+    ) -> Any:
+        # Concurrent recipients at the same domain share a single lookup.
+        if key not in memo:
+            memo[key] = asyncio.ensure_future(fn(key, *args))
+        return await asyncio.shield(memo[key])
+
+    async def _discover(self, domain: str) -> List[smtp.SMTPHost]:
+        if self.smtp_host:
+            return await smtp.hosts_set_async(
+                self.resolver, self.smtp_host, port=self.smtp_port
+            )
+        return await smtp.hosts_discover_async(
+            self.resolver, domain, port=self.smtp_port
+        )
+
+    async def _probe_catch_all(self, domain: str, hosts: List[smtp.SMTPHost]) -> bool:
+        address = f"{VERIFY_PROBE_USER}-{secrets.token_hex(8)}@{domain}"
+        result = await self._probe(hosts, address)
+        if result.outcome == smtptester.RESULT_ACCEPTED:
+            log.info(f"Domain accepts all recipients: {domain}")
+            return True
+        return False
+
+    async def _probe(
+        self, hosts: List[smtp.SMTPHost], recipient: str
+    ) -> "smtptester.Result":
+        result = smtptester.Result(
+            recipient, smtptester.RESULT_ERROR, message="No SMTP hosts available"
+        )
+        for host in hosts:
+            try:
+                delivery = await self.pool.verify_async(
+                    host, recipient, sender=self.sender
+                )
+            except smtp.SMTPTemporaryError as e:
+                log.warning(e)
+                outcome = smtptester.RESULT_TEMPORARY
+                result = smtptester.Result(recipient, outcome, host, str(e), e.result)
+                if e.code:
+                    break
+                continue
+            except smtp.SMTPPermanentError as e:
+                log.error(e)
+                outcome = smtptester.RESULT_PERMANENT
+                return smtptester.Result(recipient, outcome, host, str(e), e.result)
+
+            reply = delivery.recipients[recipient]
+            message = f"{reply.code} {reply.message}".replace("\n", " ")
+            if reply.code in (250, 251):
+                outcome, message = smtptester.RESULT_ACCEPTED, ""
+            elif reply.code >= 500:
+                outcome = smtptester.RESULT_PERMANENT
+            else:
+                outcome = smtptester.RESULT_TEMPORARY
+            return smtptester.Result(recipient, outcome, host, message, delivery)
+        return result
+
+
+def run(
+    recipients: Iterable[str],
+    resolver: dns.DNSResolver,
+    concurrency: int = VERIFY_DEFAULT_CONCURRENCY,
+    **options,
+) -> Iterator["smtptester.Result"]:
+    results: queue.Queue = queue.Queue()
+    verifier = Verifier(resolver, **options)
+
+    async def main():
+        try:
+            await verifier.run_async(recipients, results.put, concurrency)
+        finally:
+            await verifier.close_async()
+
+    future = asyncio.run_coroutine_threadsafe(main(), util.event_loop())
+    future.add_done_callback(lambda f: results.put(None))
+    try:
+        while True:
+            result = results.get()
+            if result is None:
+                break
+            yield result
+        future.result()
+    finally:
+        future.cancel()
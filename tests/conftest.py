@@ -0,0 +1,56 @@
+import asyncio
+import os
+import ssl
+
+import pytest
+
+import smtptester.fake as fake
+import smtptester.smtp as smtp
+import smtptester.util as util
+
+
+TLS_CERT = os.path.join(os.path.dirname(__file__), "tls.pem")
+
+
+class Blackhole:
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        await reader.read()
+        writer.close()
+
+
+@pytest.fixture
+def tls_cert():
+    return TLS_CERT
+
+
+@pytest.fixture
+def smtp_sink(request, tls_cert):
+    params = dict(getattr(request, "param", {}))
+    if params.pop("tls", False):
+        params["tls_context"] = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        params["tls_context"].load_cert_chain(tls_cert)
+    sink = fake.FakeSMTPServer(**params)
+    util.run_sync(sink.start())
+    yield sink
+    util.run_sync(sink.stop())
+
+
+@pytest.fixture
+def smtp_sink_host(smtp_sink):
+    return smtp.SMTPHost(name="", address="127.0.0.1", port=smtp_sink.port)
+
+
+@pytest.fixture
+def smtp_blackhole_host():
+    blackhole = Blackhole()
+    util.run_sync(blackhole.start())
+    port = blackhole.server.sockets[0].getsockname()[1]
+    yield smtp.SMTPHost(name="", address="127.0.0.1", port=port)
+    util.run_sync(blackhole.stop())
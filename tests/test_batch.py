@@ -0,0 +1,156 @@
+import io
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+import smtptester
+import smtptester.batch as batch
+import smtptester.fake as fake
+import smtptester.util as util
+
+
+@pytest.fixture
+def options():
+    return dict(
+        sender="sender@example.test",
+        message="Test",
+        dns_host="",
+        dns_port=53,
+        dns_timeout=1,
+        dns_proto="udp",
+        smtp_host="127.0.0.1",
+        smtp_port=0,
+        smtp_timeout=1,
+        smtp_helo="localhost",
+        smtp_tls="no",
+        smtp_auth_user="",
+        smtp_auth_pass="",
+    )
+
+
+def test_read_recipients():
+    f = io.StringIO("a@example.test\n\n  # comment\n b@example.test \n")
+    assert list(batch.read_recipients(f)) == ["a@example.test", "b@example.test"]
+
+
+def test_group_by_domain():
+    recipients = ["a@example.test", "b@Example.test", "c@example.invalid"]
+    assert batch.group_by_domain(recipients) == {
+        "example.test": ["a@example.test", "b@Example.test"],
+        "example.invalid": ["c@example.invalid"],
+    }
+
+
+def test_run_temporary_error(options):
+    recipients = ["a@example.test", "b@example.test", "c@example.invalid"]
+    results = list(batch.run(recipients, workers=2, **options))
+    assert sorted(r.recipient for r in results) == sorted(recipients)
+    assert all(r.outcome == smtptester.RESULT_TEMPORARY for r in results)
+
+
+def test_run_multiple_recipients(options, smtp_sink):
+    options.update(smtp_port=smtp_sink.port, smtp_max_recipients=2)
+    recipients = ["a@example.test", "reject@example.test", "b@example.invalid"]
+    results = {r.recipient: r for r in batch.run(recipients, workers=2, **options)}
+    assert results["a@example.test"].outcome == smtptester.RESULT_ACCEPTED
+    assert results["reject@example.test"].outcome == smtptester.RESULT_PERMANENT
+    assert results["reject@example.test"].message == "550 No such user"
+    assert results["b@example.invalid"].outcome == smtptester.RESULT_ACCEPTED
+    assert smtp_sink.connections == 2
+
+
+def test_run_streams_before_discovery_finishes(options, smtp_sink):
+    dns_server = fake.FakeDNSServer(
+        {
+            ("fast.test", "mx"): ["10 mx.fast.test."],
+            ("slow.test", "mx"): ["10 mx.fast.test."],
+            ("mx.fast.test", "a"): ["127.0.0.1"],
+        },
+        delays={("slow.test", "mx"): 0.8},
+    )
+    util.run_sync(dns_server.start())
+    try:
+        options.update(
+            dns_host=dns_server.address,
+            dns_port=dns_server.port,
+            dns_timeout=2,
+            smtp_host="",
+            smtp_port=smtp_sink.port,
+            smtp_max_recipients=1,
+        )
+        started = time.monotonic()
+        results = batch.run(["a@fast.test", "b@slow.test"], workers=2, **options)
+        first = next(results)
+        assert time.monotonic() - started < 0.5
+        assert first.recipient == "a@fast.test"
+        assert [r.recipient for r in results] == ["b@slow.test"]
+    finally:
+        util.run_sync(dns_server.stop())
+
+
+def test_tester_run_all(options, smtp_sink):
+    options.update(smtp_port=smtp_sink.port)
+    recipients = ["a@example.test", "defer@example.test", "b@example.invalid"]
+    tester = smtptester.SMTPTester(recipient=recipients, **options)
+    results = tester.run_all()
+    assert [r.recipient for r in results] == recipients
+    assert [r.outcome for r in results] == [
+        smtptester.RESULT_ACCEPTED,
+        smtptester.RESULT_TEMPORARY,
+        smtptester.RESULT_ACCEPTED,
+    ]
+    assert smtp_sink.connections == 1
+
+
+def test_tester_deadline(options, smtp_blackhole_host):
+    options.update(smtp_timeout=10)
+    hosts = [smtp_blackhole_host, smtp_blackhole_host]
+    tester = smtptester.SMTPTester(recipient="a@example.test", hosts=hosts, **options)
+    started = time.monotonic()
+    result = tester.run(deadline=started + 0.2)
+    assert time.monotonic() - started < 1
+    assert result.outcome == smtptester.RESULT_ERROR
+    assert result.message == "Deadline exceeded"
+
+
+def test_tester_cancel(options, smtp_blackhole_host):
+    options.update(smtp_timeout=10)
+    tester = smtptester.SMTPTester(
+        recipient="a@example.test", hosts=[smtp_blackhole_host], **options
+    )
+    cancel = util.CancelToken()
+    threading.Timer(0.1, cancel.cancel).start()
+    started = time.monotonic()
+    result = tester.run(cancel=cancel)
+    assert time.monotonic() - started < 1
+    assert result.message == "Session cancelled"
+
+
+def test_tester_releases_cancel_token(options, smtp_sink_host):
+    # Finished runs don't leave their tasks behind on a shared token.
+    cancel = util.CancelToken()
+    for _ in range(3):
+        tester = smtptester.SMTPTester(
+            recipient="a@example.test", hosts=[smtp_sink_host], **options
+        )
+        tester.run(cancel=cancel)
+    assert cancel._callbacks == []
+
+
+def test_run_interrupted(options, smtp_blackhole_host):
+    # Ctrl+C cancels deliveries in progress instead of waiting for them.
+    options.update(
+        smtp_host=smtp_blackhole_host.address,
+        smtp_port=smtp_blackhole_host.port,
+        smtp_timeout=10,
+    )
+    cancel = util.CancelToken()
+    threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGINT)).start()
+    started = time.monotonic()
+    with pytest.raises(KeyboardInterrupt):
+        list(batch.run(["a@example.test"], cancel=cancel, **options))
+    assert time.monotonic() - started < 1
+    assert cancel.cancelled
@@ -0,0 +1,58 @@
+import pytest
+
+import smtptester.body as body
+
+
+MESSAGE = b"Subject: Test\r\n\r\n.one\rtwo\n..three\r\n.\r\nfour"
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, len(MESSAGE)])
+def test_encode_chunks(size):
+    chunks = body.BytesBody(MESSAGE).chunks(size)
+    assert b"".join(body.encode(chunks)) == (
+        b"Subject: Test\r\n\r\n..one\r\ntwo\r\n...three\r\n..\r\nfour\r\n.\r\n"
+    )
+
+
+@pytest.mark.parametrize("size", [1, 4, len(MESSAGE)])
+def test_encode_chunks_unstuffed(size):
+    chunks = body.BytesBody(MESSAGE).chunks(size)
+    assert b"".join(body.encode(chunks, stuff=False)) == (
+        b"Subject: Test\r\n\r\n.one\r\ntwo\r\n..three\r\n.\r\nfour\r\n"
+    )
+
+
+def test_encode_split_crlf():
+    chunks = [b"a\r", b"\n", b"\n.b"]
+    assert b"".join(body.encode(chunks)) == b"a\r\n\r\n..b\r\n.\r\n"
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_file_body(tmp_path, use_mmap):
+    path = tmp_path / "message.eml"
+    path.write_bytes(MESSAGE * 100)
+    message = body.FileBody(str(path), use_mmap=use_mmap)
+    assert message.size == len(MESSAGE) * 100
+    assert b"".join(message.chunks(1000)) == MESSAGE * 100
+
+
+def test_file_body_empty(tmp_path):
+    path = tmp_path / "message.eml"
+    path.write_bytes(b"")
+    assert list(body.FileBody(str(path), use_mmap=True).chunks()) == []
+
+
+def test_prefixed_body():
+    message = body.PrefixedBody("From: a@example.test\r\n", body.message_body("Hi"))
+    assert message.size == 24
+    assert b"".join(message.chunks()) == b"From: a@example.test\r\nHi"
+
+
+def test_message_body_abstract():
+    class Body(body.MessageBody):
+        @property
+        def size(self):
+            return 0
+
+    with pytest.raises(TypeError):
+        Body()
@@ -1,3 +1,7 @@
+import json
+import subprocess
+import sys
+
 import pytest
 
 import smtptester.cli as cli
@@ -9,6 +13,8 @@ import smtptester.cli as cli
         (("--log-level", "debug"), None),
         (("recipient@example.test",), "cli"),
         (("recipient@example.test", "--sender", "sender@example.test"), "cli"),
+        (("recipient@example.test", "--rate", "10", "--duration", "5"), "load"),
+        (("recipient@example.test", "--connections-per-host", "1"), "verify"),
     ],
 )
 def test_parse(args, interface):
@@ -33,3 +39,58 @@ def test_options_list(options, redacted_keys, no_log_keys, expected):
         )
         == expected
     )
+
+
+def test_parse_recipients_file(tmp_path):
+    path = tmp_path / "recipients.txt"
+    path.write_text("recipient@example.test\n")
+    options = cli.parse(("--recipients-file", str(path), "-w", "4"), "cli")
+    assert options.recipients == []
+    assert options.workers == 4
+    options.recipients_file.close()
+
+
+def test_parse_recipient_required():
+    with pytest.raises(SystemExit):
+        cli.parse((), "cli")
+
+
+def test_parse_recipients():
+    options = cli.parse(("a@example.test", "b@example.test"), "cli")
+    assert options.recipients == ["a@example.test", "b@example.test"]
+
+
+@pytest.mark.parametrize("interface", ["cli", "verify"])
+def test_main_results_file(tmp_path, interface):
+    path = tmp_path / "results.jsonl"
+    args = ["a@example.test", "-o", str(path), "-h", "127.0.0.1", "--smtp-port", "0"]
+    assert cli.main(([interface] if interface != "cli" else []) + args) == 0
+    assert '"outcome": "temporary"' in path.read_text()
+
+
+@pytest.mark.parametrize("interface", ["cli", "verify"])
+def test_main_results_stdout(smtp_sink, capsys, interface):
+    args = ["a@example.test", "b@example.test", "-o", "-", "-h", "127.0.0.1"]
+    args += ["--smtp-port", str(smtp_sink.port)]
+    assert cli.main(([interface] if interface != "cli" else []) + args) == 0
+    out, err = capsys.readouterr()
+    records = [json.loads(line) for line in out.splitlines()]
+    assert sorted(r["recipient"] for r in records) == [
+        "a@example.test",
+        "b@example.test",
+    ]
+    assert "a@example.test\t" in err
+
+
+def test_import_is_lazy():
+    code = (
+        "import socket, sys\n"
+        "socket.getfqdn = None\n"
+        "import smtptester.cli as cli\n"
+        "cli.parse(['a@example.test'], 'cli')\n"
+        "assert 'dns.resolver' not in sys.modules\n"
+        "assert 'sqlite3' not in sys.modules\n"
+        "for m in ['history', 'load', 'monitor', 'verify']:\n"
+        "    assert f'smtptester.{m}' not in sys.modules\n"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
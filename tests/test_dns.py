@@ -1,3 +1,9 @@
+import dns.message as message
+import dns.name as name
+import dns.rdataclass as rdataclass
+import dns.rdatatype as rdatatype
+import dns.resolver as dnsresolver
+import dns.rrset as rrset
 import pytest
 
 import smtptester.dns as dns
@@ -39,3 +45,97 @@ def test_resolver_no_records(resolver):
 def test_resolver_timeout(timeout_resolver):
     with pytest.raises(dns.DNSConnectionError):
         timeout_resolver.a("conigliaro.org")
+
+
+@pytest.fixture
+def cache():
+    return dns.DNSCache(size=2)
+
+
+def test_cache_get_put(cache):
+    assert cache.get("example.test", "a") is None
+    cache.put("Example.test.", "a", 60, ["127.0.0.1"])
+    assert cache.get("example.test", "a").records == ["127.0.0.1"]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_expired(cache):
+    cache.put("example.test", "a", 0, ["127.0.0.1"])
+    assert cache.get("example.test", "a") is None
+
+
+def test_cache_lru_eviction(cache):
+    cache.put("a.test", "a", 60, ["127.0.0.1"])
+    cache.put("b.test", "a", 60, ["127.0.0.2"])
+    cache.get("a.test", "a")
+    cache.put("c.test", "a", 60, ["127.0.0.3"])
+    assert cache.get("b.test", "a") is None
+    assert cache.get("a.test", "a") is not None
+
+
+def test_cache_persistence(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = dns.DNSCache(path=path)
+    cache.put("example.test", "a", 60, ["127.0.0.1"])
+    cache.put("example.invalid", "a", 60, error="DNSNoDomain", message="No domain")
+    cache.save()
+    cache = dns.DNSCache(path=path)
+    assert cache.get("example.test", "a").records == ["127.0.0.1"]
+    assert cache.get("example.invalid", "a").error == "DNSNoDomain"
+
+
+def test_resolver_cached_records(resolver):
+    resolver.cache.put("example.test", "mx", 60, ["20 mx2.example.test."])
+    resolver.cache.put("mx2.example.test", "a", 60, ["127.0.0.2"])
+    assert resolver.mx("example.test") == [
+        dns.MXRecord(name="mx2.example.test", address="127.0.0.2", preference=20)
+    ]
+
+
+def test_resolver_cached_errors(resolver):
+    resolver.cache.put("example.test", "a", 60, error="DNSNoDomain", message="")
+    with pytest.raises(dns.DNSNoDomain):
+        resolver.a("example.test")
+
+
+def fake_answer(qname, rdtype, records, additional=[]):
+    response = message.make_response(message.make_query(qname, rdtype))
+    response.answer.append(rrset.from_text(qname, 60, "IN", rdtype, *records))
+    for n, address in additional:
+        response.additional.append(rrset.from_text(n, 60, "IN", "A", address))
+    return dnsresolver.Answer(
+        name.from_text(qname),
+        rdatatype.from_text(rdtype),
+        rdataclass.IN,
+        message.from_wire(response.to_wire()),
+    )
+
+
+def test_resolver_mx_glue(resolver, monkeypatch):
+    answers = {
+        ("example.test", "mx"): fake_answer(
+            "example.test.",
+            "MX",
+            ["20 mx2.example.test.", "10 mx1.example.test."],
+            additional=[("mx1.example.test.", "127.0.0.1")],
+        ),
+        ("mx2.example.test", "a"): fake_answer("mx2.example.test.", "A", ["127.0.0.2"]),
+    }
+    queries = []
+
+    async def query_host(host, qname, rdtype):
+        queries.append((qname, rdtype))
+        return answers[(qname, rdtype)]
+
+    monkeypatch.setattr(resolver, "_query_host", query_host)
+    timings = []
+    assert resolver.mx("example.test", timings=timings) == [
+        dns.MXRecord(name="mx1.example.test", address="127.0.0.1", preference=10),
+        dns.MXRecord(name="mx2.example.test", address="127.0.0.2", preference=20),
+    ]
+    assert queries == [("example.test", "mx"), ("mx2.example.test", "a")]
+    assert [(t.name, t.source) for t in timings] == [
+        ("example.test", dns.DNS_SOURCE_NETWORK),
+        ("mx1.example.test", dns.DNS_SOURCE_GLUE),
+        ("mx2.example.test", dns.DNS_SOURCE_NETWORK),
+    ]
@@ -0,0 +1,158 @@
+import ssl
+
+import pytest
+
+import smtptester.dns as dns
+import smtptester.fake as fake
+import smtptester.rto as rto
+import smtptester.util as util
+
+
+@pytest.fixture
+def dns_server():
+    server = fake.FakeDNSServer(
+        {
+            ("example.test", "mx"): ["10 mx1.example.test.", "20 mx2.example.test."],
+            ("mx1.example.test", "a"): ["127.0.0.1"],
+            ("mx2.example.test", "a"): ["127.0.0.2"],
+            ("a.example.test", "a"): ["127.0.0.3"],
+        },
+        glue=False,
+    )
+    util.run_sync(server.start())
+    yield server
+    util.run_sync(server.stop())
+
+
+@pytest.mark.parametrize("protocol", ["udp", "tcp"])
+def test_dns_server_mx(dns_server, protocol):
+    resolver = dns.DNSResolver(
+        host=dns_server.address, port=dns_server.port, protocol=protocol
+    )
+    assert resolver.mx("example.test") == [
+        dns.MXRecord(name="mx1.example.test", address="127.0.0.1", preference=10),
+        dns.MXRecord(name="mx2.example.test", address="127.0.0.2", preference=20),
+    ]
+    assert dns_server.queries == 3
+
+
+def test_dns_server_glue(dns_server):
+    dns_server.glue = True
+    resolver = dns.DNSResolver(host=dns_server.address, port=dns_server.port)
+    timings = []
+    resolver.mx("example.test", timings=timings)
+    assert [t.source for t in timings].count(dns.DNS_SOURCE_GLUE) == 2
+    assert dns_server.queries == 1
+
+
+def test_dns_server_errors(dns_server):
+    resolver = dns.DNSResolver(host=dns_server.address, port=dns_server.port)
+    with pytest.raises(dns.DNSNoDomain):
+        resolver.a("missing.example.test")
+    with pytest.raises(dns.DNSNoRecords):
+        resolver.mx("a.example.test")
+
+
+@pytest.mark.parametrize("protocol", ["udp", "tcp"])
+def test_dns_server_delay(dns_server, protocol):
+    dns_server.delay = 0.5
+    resolver = dns.DNSResolver(
+        host=dns_server.address, port=dns_server.port, timeout=0.1, protocol=protocol
+    )
+    with pytest.raises(dns.DNSConnectionError):
+        resolver.a("a.example.test")
+
+
+def test_dns_tcp_connection_reused(dns_server):
+    dns_server.delay = 0.05
+    resolver = dns.DNSResolver(
+        host=dns_server.address, port=dns_server.port, protocol="tcp"
+    )
+    names = ["mx1.example.test", "mx2.example.test", "a.example.test"]
+    answers = util.run_sync(util.gather(*(resolver.a_async(n) for n in names * 3)))
+    assert [a[0].address for a in answers[:3]] == [
+        "127.0.0.1",
+        "127.0.0.2",
+        "127.0.0.3",
+    ]
+    with pytest.raises(dns.DNSNoDomain):
+        resolver.a("missing.example.test")
+    assert dns_server.queries == 10
+    assert dns_server.connections == 1
+    resolver.close()
+
+
+def test_dns_tls(dns_server, tls_cert):
+    util.run_sync(dns_server.stop())
+    dns_server.tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    dns_server.tls_context.load_cert_chain(tls_cert)
+    util.run_sync(dns_server.start())
+    resolver = dns.DNSResolver(
+        host=dns_server.address,
+        port=dns_server.port,
+        protocol="tls",
+        tls_context=ssl.create_default_context(cafile=tls_cert),
+    )
+    assert resolver.a("a.example.test")[0].address == "127.0.0.3"
+    assert resolver.a("mx1.example.test")[0].address == "127.0.0.1"
+    assert dns_server.connections == 1
+    resolver.close()
+
+
+def test_dns_tls_default_port():
+    resolver = dns.DNSResolver(host="127.0.0.1", protocol="tls")
+    assert resolver.port == dns.DNS_DEFAULT_TLS_PORT
+
+
+@pytest.fixture
+def slow_dns_server(dns_server):
+    server = fake.FakeDNSServer(dns_server.records, delay=0.3, address="127.0.0.2")
+    server.port = dns_server.port
+    util.run_sync(server.start())
+    yield server
+    util.run_sync(server.stop())
+
+
+def test_dns_nameserver_fallback(dns_server, slow_dns_server, monkeypatch):
+    monkeypatch.setattr(dns, "DNS_DEFAULT_STAGGER", 0.05)
+    resolver = dns.DNSResolver(
+        host=[slow_dns_server.address, dns_server.address], port=dns_server.port
+    )
+    assert resolver.a("a.example.test")[0].address == "127.0.0.3"
+    assert resolver.a("mx1.example.test")[0].address == "127.0.0.1"
+    assert slow_dns_server.queries == 1
+    assert dns_server.queries == 2
+    slow, fast = (resolver.stats[h] for h in resolver.nameservers)
+    assert fast.srtt < slow.srtt
+    assert (slow.queries, fast.queries) == (1, 2)
+
+
+def test_dns_nameserver_race(dns_server, slow_dns_server):
+    resolver = dns.DNSResolver(
+        host=f"{slow_dns_server.address},{dns_server.address}",
+        port=dns_server.port,
+        race=True,
+    )
+    assert resolver.nameservers == [slow_dns_server.address, dns_server.address]
+    with pytest.raises(dns.DNSNoDomain):
+        resolver.a("missing.example.test")
+    assert resolver.a("a.example.test")[0].address == "127.0.0.3"
+    assert (slow_dns_server.queries, dns_server.queries) == (2, 2)
+    slow, fast = (resolver.stats[h] for h in resolver.nameservers)
+    assert fast.srtt < slow.srtt
+    assert (slow.failures, fast.failures) == (0, 0)
+
+
+def test_dns_adaptive_timeouts(dns_server, slow_dns_server):
+    timeouts = rto.AdaptiveTimeouts(minimum=0.05)
+    resolver = dns.DNSResolver(
+        host=[slow_dns_server.address, dns_server.address],
+        port=dns_server.port,
+        timeouts=timeouts,
+    )
+    slow, fast = (resolver._key(h) for h in resolver.nameservers)
+    timeouts.sample(slow, 0.01)
+    assert resolver.a("a.example.test")[0].address == "127.0.0.3"
+    assert timeouts.estimates[fast].samples == 1
+    assert timeouts.estimates[slow].backoff == 1
+    assert resolver.stats[slow_dns_server.address].failures == 1
@@ -0,0 +1,112 @@
+import asyncio
+import contextlib
+import sqlite3
+import time
+
+import pytest
+
+import smtptester
+import smtptester.cli as cli
+import smtptester.history as history
+import smtptester.sink as sink
+import smtptester.smtp as smtp
+import smtptester.util as util
+
+
+HOST = smtp.SMTPHost(name="mx.example.test", address="127.0.0.1", port=25)
+NOW = 1700000000.0
+
+
+def attempt(t, duration, outcome=smtptester.RESULT_ACCEPTED, host=HOST):
+    delivery = smtp.SMTPResult(
+        host=host,
+        phases=[
+            smtp.SMTPPhase("connect", 0.0, duration / 2),
+            smtp.SMTPPhase("rcpt", duration / 2, duration, 250),
+        ],
+    )
+    r = sink.record("a@example.test", outcome, host, "", delivery)
+    r["time"] = t
+    return r
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / "history.db")
+    with history.HistoryStore(path) as store:
+        for i in range(1, 101):
+            store.write(attempt(NOW - 3600, i / 100))
+            store.write(attempt(NOW - 86400 - 3600, i / 10))
+        store.write(attempt(NOW, 1.0, smtptester.RESULT_TEMPORARY))
+        store.write(sink.record("b@example.test", smtptester.RESULT_TEMPORARY))
+    assert store.written == 202
+    return path
+
+
+def test_history_store_lossless(tmp_path):
+    # A slow commit makes producers on the event loop wait, not drop rows.
+    class SlowStore(history.HistoryStore):
+        def write_batch(self, records):
+            time.sleep(0.01)
+            super().write_batch(records)
+
+    path = str(tmp_path / "history.db")
+    store = SlowStore(path, queue_size=4)
+
+    async def write():
+        await asyncio.gather(
+            *(store.write_async(attempt(NOW, i / 100)) for i in range(1, 201))
+        )
+
+    util.run_sync(write())
+    store.close()
+    assert store.written == 200
+    with contextlib.closing(sqlite3.connect(path)) as db:
+        assert db.execute("SELECT COUNT(*) FROM attempts").fetchone() == (200,)
+
+
+def test_history_trends(path):
+    trends = history.trends(path, since=2 * 86400, window=86400, now=NOW)
+    assert [t.attempts for t in trends] == [100, 101]
+    assert trends[0].start == (NOW - 86400 - 3600) // 86400 * 86400
+    assert trends[0].latency.percentile(50) == pytest.approx(5.0, rel=0.02)
+    assert trends[1].latency.percentile(99) == pytest.approx(0.99, rel=0.02)
+    assert trends[1].success_ratio == pytest.approx(100 / 101)
+    assert trends[1].host == HOST._replace(preference=0)
+
+
+def test_history_trends_filters(path):
+    trends = history.trends(path, since=600, window=3600, now=NOW)
+    assert [t.attempts for t in trends] == [1]
+    trends = history.trends(path, since=7200, phase="rcpt", now=NOW)
+    assert trends[0].latency.max == pytest.approx(0.5, rel=0.02)
+    assert history.trends(path, host="mx.other.test", now=NOW) == []
+    assert len(history.trends(path, host="127.0.0.1", now=NOW)) == 2
+
+
+def test_history_trends_missing(tmp_path):
+    with pytest.raises(history.HistoryError):
+        history.trends(str(tmp_path / "missing.db"))
+
+
+@pytest.mark.parametrize(
+    "value, expected", [("30", 30), ("5m", 300), ("1.5h", 5400), ("7d", 604800)]
+)
+def test_parse_duration(value, expected):
+    assert history.parse_duration(value) == expected
+
+
+@pytest.mark.parametrize("value", ["", "d", "-1h", "1y"])
+def test_parse_duration_invalid(value):
+    with pytest.raises(ValueError):
+        history.parse_duration(value)
+
+
+def test_main_history(tmp_path, capsys):
+    path = str(tmp_path / "history.db")
+    args = ["a@example.test", "--history-file", path, "-h", "127.0.0.1"]
+    assert cli.main(args + ["--smtp-port", "0"]) == 0
+    assert cli.main(["history", path, "--window", "1h"]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith("start\thost\tattempts\taccepted\tp50_ms")
+    assert "\t(127.0.0.1):0\t1\t0.00%\t" in lines[-1]
@@ -0,0 +1,49 @@
+import pytest
+
+import smtptester.load as load
+
+
+@pytest.fixture
+def histogram():
+    h = load.Histogram()
+    for i in range(1, 1001):
+        h.record(i / 1000)
+    return h
+
+
+@pytest.mark.parametrize("percentile, expected", [(50, 0.5), (99, 0.99), (100, 1)])
+def test_histogram_percentile(histogram, percentile, expected):
+    assert histogram.percentile(percentile) == pytest.approx(expected, rel=0.01)
+
+
+def test_histogram_merge(histogram):
+    other = load.Histogram()
+    other.record(2.0)
+    histogram.merge(other)
+    assert histogram.count == 1001
+    assert histogram.max == 2.0
+
+
+@pytest.mark.parametrize("value, expected", [(0.1, 100), (0.5, 500), (2.0, 1000)])
+def test_histogram_count_below(histogram, value, expected):
+    assert histogram.count_below(value) == pytest.approx(expected, rel=0.02)
+
+
+def test_histogram_empty():
+    assert load.Histogram().percentile(99) == 0.0
+
+
+@pytest.mark.parametrize("reuse", [False, True])
+def test_run(smtp_sink, smtp_sink_host, reuse):
+    report = load.run(
+        smtp_sink_host, "recipient@example.test", rate=50, duration=0.2, reuse=reuse
+    )
+    assert (report.sent, report.accepted) == (10, 10)
+    assert len(smtp_sink.messages) == 10
+    assert report.latency.count == 10
+
+
+def test_run_errors(smtp_sink_host):
+    report = load.run(smtp_sink_host, "reject@example.test", rate=50, duration=0.1)
+    assert report.permanent == report.sent
+    assert report.error_rate(report.permanent) == 1.0
@@ -0,0 +1,117 @@
+import asyncio
+import signal
+import subprocess
+import sys
+import time
+
+import smtptester.dns as dns
+import smtptester.monitor as monitor
+import smtptester.util as util
+
+
+def make_monitor(smtp_sink, targets):
+    return monitor.Monitor(
+        targets,
+        dns.DNSResolver(host="127.0.0.1"),
+        interval=0.05,
+        port=0,
+        sender="sender@example.test",
+        message="Test",
+        dns_host="",
+        dns_port=53,
+        dns_timeout=1,
+        dns_proto="udp",
+        smtp_host="127.0.0.1",
+        smtp_port=smtp_sink.port,
+        smtp_timeout=1,
+        smtp_helo="localhost",
+        smtp_tls="no",
+        smtp_auth_user="",
+        smtp_auth_pass="",
+    )
+
+
+async def fetch(m, path):
+    await asyncio.sleep(0.3)
+    reader, writer = await asyncio.open_connection(m.address, m.port)
+    writer.write(f"GET {path} HTTP/1.0\r\n\r\n".encode())
+    response = (await reader.read()).decode()
+    writer.close()
+    return response
+
+
+def test_monitor(smtp_sink):
+    m = make_monitor(smtp_sink, ["a@example.test", "reject@example.test"])
+
+    async def main():
+        task = asyncio.ensure_future(m.run_async())
+        try:
+            return await fetch(m, "/metrics"), await fetch(m, "/")
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    metrics, not_found = util.run_sync(main())
+    assert metrics.startswith("HTTP/1.0 200 OK\r\n")
+    assert metrics.endswith("# EOF\n")
+    assert 'smtptester_probe_success_ratio{target="a@example.test"} 1\n' in metrics
+    assert 'smtptester_probe_last_code{target="reject@example.test"} 550\n' in metrics
+    assert 'smtptester_probe_last_error_info{target="reject@example.test"' in metrics
+    assert 'smtptester_dns_queries_total{nameserver="127.0.0.1"} 0\n' in metrics
+    assert not_found.startswith("HTTP/1.0 404 Not Found\r\n")
+    assert len(smtp_sink.messages) >= 2
+
+
+def test_metrics_escape(smtp_sink):
+    m = make_monitor(smtp_sink, ["a@example.test"])
+    m.stats["a@example.test"].last_error = 'bad "reply"\n'
+    assert 'message="bad \\"reply\\"\\n"} 1\n' in m.metrics()
+
+
+def test_metrics_precision(smtp_sink):
+    m = make_monitor(smtp_sink, ["a@example.test"])
+    stats = m.stats["a@example.test"]
+    stats.last_error_time = 1760812345.678
+    stats.outcomes["accepted"] = 1234567
+    metrics = m.metrics()
+    assert 'last_error_timestamp_seconds{target="a@example.test"} 1760812345.678\n' in (
+        metrics
+    )
+    assert 'outcome="accepted"} 1234567\n' in metrics
+
+
+def test_monitor_probe_error(smtp_sink):
+    m = make_monitor(smtp_sink, ["a@example.test", "b@example.test"])
+    probe_async = m.probe_async
+
+    async def probe(target):
+        if target == "b@example.test":
+            raise RuntimeError("unexpected")
+        return await probe_async(target)
+
+    m.probe_async = probe
+
+    async def main():
+        task = asyncio.ensure_future(m.run_async())
+        await asyncio.sleep(0.5)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    util.run_sync(main())
+    assert m.stats["a@example.test"].outcomes["accepted"] >= 2
+    assert m.stats["b@example.test"].outcomes["error"] >= 2
+    assert m.stats["b@example.test"].last_error == "unexpected"
+
+
+def test_run_interrupted(tmp_path, smtp_sink):
+    cache, timeouts = tmp_path / "cache.json", tmp_path / "timeouts.json"
+    args = ["monitor", "a@example.test", "-h", "127.0.0.1", "--interval", "0.1"]
+    args += ["--smtp-port", str(smtp_sink.port), "--metrics-port", "0"]
+    args += ["--dns-cache", str(cache), "--timeouts-file", str(timeouts)]
+    code = f"import smtptester.cli as cli\ncli.main({args!r})\n"
+    process = subprocess.Popen([sys.executable, "-c", code])
+    time.sleep(1)
+    process.send_signal(signal.SIGINT)
+    assert process.wait(timeout=10) == 0
+    assert cache.exists()
+    assert timeouts.exists()
@@ -0,0 +1,149 @@
+import json
+
+import pytest
+
+import smtptester
+import smtptester.cli as cli
+import smtptester.fake as fake
+import smtptester.replay as replay
+import smtptester.util as util
+
+
+RECIPIENTS = ["a@example.test", "defer@example.test"]
+
+
+@pytest.fixture
+def dns_server():
+    server = fake.FakeDNSServer(
+        {
+            ("example.test", "mx"): ["10 mx1.example.test."],
+            ("mx1.example.test", "a"): ["127.0.0.1"],
+        }
+    )
+    util.run_sync(server.start())
+    yield server
+    util.run_sync(server.stop())
+
+
+@pytest.fixture
+def options(dns_server, smtp_sink):
+    return dict(
+        message="Test",
+        dns_host=dns_server.address,
+        dns_port=dns_server.port,
+        dns_timeout=1,
+        dns_proto="udp",
+        smtp_host="",
+        smtp_port=smtp_sink.port,
+        smtp_timeout=1,
+        smtp_helo="localhost",
+        smtp_tls="no",
+        smtp_auth_user="",
+        smtp_auth_pass="",
+    )
+
+
+@pytest.fixture
+def capture(tmp_path, options):
+    path = str(tmp_path / "capture.json")
+    recorder = replay.Capture()
+    tester = smtptester.SMTPTester(
+        recipient=RECIPIENTS, sender="s@example.test", recorder=recorder, **options
+    )
+    tester.run_all()
+    recorder.save(path)
+    return path
+
+
+@pytest.mark.parametrize("smtp_sink", [{"delay": 0.2}], indirect=True)
+def test_record(capture):
+    with open(capture) as f:
+        data = json.load(f)
+    assert data["recipients"] == RECIPIENTS
+    assert data["sender"] == "s@example.test"
+    assert ["example.test", "mx", ["10 mx1.example.test."], ""] == data["dns"][0][:4]
+    events = data["sessions"][0]["events"]
+    assert events[0][1:] == [replay.REPLAY_SERVER, "220 fake.test ESMTP"]
+    assert events[0][0] >= 200
+    assert [replay.REPLAY_CLIENT, "<31 bytes>"] in [e[1:] for e in events]
+
+
+@pytest.mark.parametrize("smtp_sink", [{"delay": 0.2}], indirect=True)
+def test_replay(capture, smtp_sink):
+    results = replay.run(capture, time_scale=0.5, smtp_timeout=5, dns_timeout=1)
+    assert [r.outcome for r in results] == [
+        smtptester.RESULT_ACCEPTED,
+        smtptester.RESULT_TEMPORARY,
+    ]
+    assert results[0].host.address == "127.0.1.1"
+    banner = results[0].delivery.phases[1]
+    assert banner.name == "banner"
+    assert 0.08 < banner.duration < 0.2
+    assert smtp_sink.connections == 1
+
+
+@pytest.mark.parametrize("smtp_sink", [{"delay": 0.2}], indirect=True)
+def test_replay_timeout(capture):
+    # Replies that took longer than the timeout still time out on replay.
+    results = replay.run(capture, time_scale=5, smtp_timeout=1, dns_timeout=1)
+    assert results[0].outcome == smtptester.RESULT_TEMPORARY
+    assert "Timeout=1s" in results[0].message
+
+
+@pytest.mark.parametrize("smtp_sink", [{"delay": 0.2}], indirect=True)
+def test_replay_unavailable_address(capture, monkeypatch):
+    monkeypatch.setattr(replay, "REPLAY_SMTP_NETWORK", "192.0.2.0")
+    with pytest.raises(replay.ReplayError, match="Unable to listen on 192.0.2.1"):
+        replay.run(capture, time_scale=0)
+
+
+def test_transcript_redacts_credentials():
+    transcript = replay.Transcript("", "127.0.0.1", 25)
+    transcript.client("AUTH LOGIN dXNlcg==")
+    transcript.server("334 UGFzc3dvcmQ6")
+    transcript.client("cGFzc3dvcmQ=")
+    transcript.server("235 Authenticated")
+    transcript.client("MAIL FROM:<s@example.test>")
+    texts = [e.text for e in transcript.events if e.kind == replay.REPLAY_CLIENT]
+    assert texts == ["AUTH LOGIN", "<redacted>", "MAIL FROM:<s@example.test>"]
+
+
+def test_plaintext():
+    c, s = replay.REPLAY_CLIENT, replay.REPLAY_SERVER
+    events = [
+        replay.Event(0.0, s, "220 mx.example.test"),
+        replay.Event(0.1, c, "EHLO localhost"),
+        replay.Event(0.2, s, "250-mx.example.test\r\n250-STARTTLS\r\n250 SIZE"),
+        replay.Event(0.3, c, "STARTTLS"),
+        replay.Event(0.4, s, "220 Go ahead"),
+        replay.Event(0.5, replay.REPLAY_TLS, "TLSv1.3"),
+        replay.Event(0.6, c, "EHLO localhost"),
+        replay.Event(0.7, s, "250-mx.example.test\r\n250 SIZE"),
+        replay.Event(0.8, c, "QUIT"),
+        replay.Event(0.9, s, "221 Bye"),
+    ]
+    assert replay.plaintext(events) == [
+        events[0],
+        events[1],
+        events[2]._replace(text="250-mx.example.test\r\n250 SIZE"),
+        events[8],
+        events[9],
+    ]
+    assert replay.plaintext(events[:5]) == events[:5]
+
+
+def test_load_invalid(tmp_path):
+    path = tmp_path / "capture.json"
+    path.write_text('{"version": 0}')
+    with pytest.raises(replay.ReplayError):
+        replay.load(str(path))
+
+
+def test_main_replay(tmp_path, options, capsys):
+    path = str(tmp_path / "capture.json")
+    args = ["a@example.test", "-d", options["dns_host"], "--record", path]
+    args += ["--dns-port", str(options["dns_port"]), "--smtp-port"]
+    assert cli.main(args + [str(options["smtp_port"]), "--smtp-tls", "no"]) == 0
+    assert cli.main(["replay", path, "--time-scale", "0"]) == 0
+    line = capsys.readouterr().out.splitlines()[-1]
+    assert line.startswith("a@example.test\taccepted\tmx1.example.test(127.0.1.1):")
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+import smtptester.rto as rto
+
+
+def test_rtt_estimate():
+    estimate = rto.RTTEstimate()
+    estimate.sample(1.0)
+    assert (estimate.srtt, estimate.rttvar) == (1.0, 0.5)
+    assert estimate.rto() == 3.0
+    estimate.sample(2.0)
+    assert estimate.rttvar == pytest.approx(0.625)
+    assert estimate.srtt == pytest.approx(1.125)
+    estimate.backoff = 2
+    assert estimate.rto() == pytest.approx((1.125 + 2.5) * 4)
+
+
+def test_timeout_initial():
+    timeouts = rto.AdaptiveTimeouts(minimum=1, maximum=60)
+    assert timeouts.timeout("a", 30) == 30
+    assert timeouts.timeout("a", 0.1) == 1
+    assert timeouts.timeout("a", 120) == 60
+
+
+def test_timeout_measured():
+    timeouts = rto.AdaptiveTimeouts(minimum=0.5, maximum=60)
+    timeouts.sample("a", 0.01)
+    assert timeouts.timeout("a", 30) == 0.5
+    timeouts.sample("b", 1.0)
+    assert timeouts.timeout("b", 30) == 3.0
+
+
+def test_timeout_backoff():
+    timeouts = rto.AdaptiveTimeouts(minimum=1, maximum=10)
+    timeouts.backoff("a", 3)
+    assert timeouts.timeout("a", 3) == 6
+    timeouts.backoff("a", 3)
+    timeouts.backoff("a", 3)
+    assert timeouts.timeout("a", 3) == 10
+    assert timeouts.estimates["a"].backoff == 2
+    timeouts.sample("a", 1.0)
+    assert timeouts.timeout("a", 3) == 3.0
+
+
+def test_timeouts_file(tmp_path):
+    path = str(tmp_path / "timeouts.json")
+    timeouts = rto.AdaptiveTimeouts(path=path)
+    timeouts.sample("a", 1.0)
+    timeouts.backoff("b", 5)
+    timeouts.save()
+    with open(path) as f:
+        assert json.load(f) == {"a": [1.0, 0.5, 1]}
+    assert rto.AdaptiveTimeouts(path=path).timeout("a", 30) == 3.0
+
+
+def test_timeouts_file_invalid(tmp_path):
+    path = tmp_path / "timeouts.json"
+    path.write_text("{")
+    timeouts = rto.AdaptiveTimeouts(path=str(path))
+    assert timeouts.estimates == {}
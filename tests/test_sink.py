@@ -0,0 +1,177 @@
+import asyncio
+import io
+import json
+import threading
+
+import pytest
+
+import smtptester
+import smtptester.load as load
+import smtptester.sink as sink
+import smtptester.smtp as smtp
+import smtptester.util as util
+
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_record():
+    host = smtp.SMTPHost(name="mx.example.test", address="127.0.0.1", port=25)
+    delivery = smtp.SMTPResult(
+        host=host,
+        phases=[
+            smtp.SMTPPhase("connect", 1.0, 1.5),
+            smtp.SMTPPhase("rcpt", 1.5, 1.75, 450),
+            smtp.SMTPPhase("quit", 1.75, 2.0, 221),
+        ],
+        recipients={"a@example.test": smtp.SMTPReply(450, "Try again later")},
+    )
+    r = sink.record("a@example.test", "temporary", host, "450", delivery)
+    assert r["host"] == "mx.example.test"
+    assert r["preference"] == 0
+    assert r["code"] == 450
+    assert r["duration_ms"] == 1000.0
+    assert r["timings_ms"] == {"connect": 500.0, "rcpt": 250.0, "quit": 250.0}
+    assert r["timeouts_ms"] == {"connect": 0.0, "rcpt": 0.0, "quit": 0.0}
+
+
+def test_record_recipient_timings():
+    host = smtp.SMTPHost(name="mx.example.test", address="127.0.0.1", port=25)
+    delivery = smtp.SMTPResult(
+        host=host,
+        phases=[
+            smtp.SMTPPhase("mail", 1.0, 1.5),
+            smtp.SMTPPhase("rcpt", 1.5, 1.75, 250, 3.0, "a@example.test"),
+            smtp.SMTPPhase("rcpt", 1.75, 2.25, 250, 3.0, "b@example.test"),
+            smtp.SMTPPhase("data", 2.25, 2.5, 250),
+        ],
+        recipients={
+            "a@example.test": smtp.SMTPReply(250, "OK"),
+            "b@example.test": smtp.SMTPReply(250, "OK"),
+        },
+    )
+    a = sink.record("a@example.test", "accepted", host, "", delivery)
+    b = sink.record("b@example.test", "accepted", host, "", delivery)
+    assert a["timings_ms"] == {"mail": 500.0, "rcpt": 250.0, "data": 250.0}
+    assert b["timings_ms"] == {"mail": 500.0, "rcpt": 500.0, "data": 250.0}
+    assert b["timeouts_ms"]["rcpt"] == 3000.0
+    assert sink.phase_summary(delivery) is sink.phase_summary(delivery)
+
+
+def test_sink_writes_records(tmp_path):
+    path = tmp_path / "results.jsonl"
+    with sink.JSONLinesSink(str(path), queue_size=10) as results_sink:
+        for i in range(100):
+            results_sink.write_result(smtptester.Result(f"{i}@example.test", "error"))
+    assert results_sink.written == 100
+    records = read_records(path)
+    assert [r["recipient"] for r in records[:2]] == ["0@example.test", "1@example.test"]
+    assert records[0]["host"] == ""
+
+
+def test_sink_file_object():
+    f = io.StringIO()
+    results_sink = sink.JSONLinesSink(f)
+    results_sink.write({"recipient": "a@example.test"})
+    results_sink.close()
+    assert f.getvalue() == '{"recipient": "a@example.test"}\n'
+
+
+def test_sink_abstract():
+    class Sink(sink.QueuedSink):
+        pass
+
+    with pytest.raises(TypeError):
+        Sink()
+
+
+class SlowSink(sink.QueuedSink):
+    def __init__(self, **kwargs):
+        self.ready = threading.Event()
+        self.batches = []
+        super().__init__(**kwargs)
+
+    def write_batch(self, records):
+        self.ready.wait()
+        if records[0].get("fail"):
+            raise OSError("disk full")
+        self.batches.append(records)
+
+
+def test_sink_waits_on_event_loop():
+    # A full queue makes producers on the loop wait, without blocking it.
+    results_sink = SlowSink(queue_size=2)
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(1)
+            await asyncio.sleep(0.01)
+
+    async def write():
+        ticker = asyncio.ensure_future(tick())
+        await asyncio.gather(
+            *(results_sink.write_async({"recipient": str(i)}) for i in range(10))
+        )
+        ticker.cancel()
+
+    threading.Timer(0.2, results_sink.ready.set).start()
+    util.run_sync(write())
+    results_sink.close()
+    assert results_sink.written == 10
+    assert len(ticks) > 5
+
+
+def test_sink_writer_error():
+    results_sink = SlowSink()
+    results_sink.write({"fail": True})
+    results_sink.ready.set()
+    results_sink.thread.join()
+    with pytest.raises(sink.SinkError, match="disk full"):
+        results_sink.write({"recipient": "a@example.test"})
+
+
+def test_tester_records_attempts(tmp_path, smtp_sink, smtp_sink_host):
+    path = tmp_path / "results.jsonl"
+    with sink.JSONLinesSink(str(path)) as results_sink:
+        tester = smtptester.SMTPTester(
+            recipient=["a@example.test", "reject@example.test"],
+            sender="sender@example.test",
+            message="Test",
+            dns_host="",
+            dns_port=53,
+            dns_timeout=1,
+            dns_proto="udp",
+            smtp_host="",
+            smtp_port=smtp_sink.port,
+            smtp_timeout=1,
+            smtp_helo="localhost",
+            smtp_tls="no",
+            smtp_auth_user="",
+            smtp_auth_pass="",
+            hosts=[smtp_sink_host],
+            results_sink=results_sink,
+        )
+        tester.run_all()
+    records = {r["recipient"]: r for r in read_records(path)}
+    assert records["a@example.test"]["outcome"] == smtptester.RESULT_ACCEPTED
+    assert records["a@example.test"]["code"] == 250
+    assert records["reject@example.test"]["code"] == 550
+    assert "data" in records["a@example.test"]["timings_ms"]
+
+
+@pytest.mark.parametrize(
+    "recipient, outcome",
+    [("a@example.test", "accepted"), ("reject@example.test", "permanent")],
+)
+def test_load_records(tmp_path, smtp_sink_host, recipient, outcome):
+    path = tmp_path / "results.jsonl"
+    with sink.JSONLinesSink(str(path)) as results_sink:
+        load.run(
+            smtp_sink_host, recipient, rate=50, duration=0.1, results_sink=results_sink
+        )
+    records = read_records(path)
+    assert len(records) == 5
+    assert {r["outcome"] for r in records} == {outcome}
@@ -1,7 +1,14 @@
+import asyncio
+import ssl
+import time
+
 import pytest
 
+import smtptester.body as body
 import smtptester.dns as dns
+import smtptester.rto as rto
 import smtptester.smtp as smtp
+import smtptester.util as util
 
 
 @pytest.fixture
@@ -43,3 +50,252 @@ def test_send_timeout(resolver):
     host = smtp.SMTPHost(name="", address="127.0.0.1", port=0, preference=0)
     with pytest.raises(smtp.SMTPTemporaryError):
         smtp.send(host, "recipient@example.test", timeout=1)
+
+
+def test_send(smtp_sink, smtp_sink_host):
+    smtp.send(smtp_sink_host, "recipient@example.test", message="Subject: Test\n\n.")
+    assert smtp_sink.messages[0].endswith("Subject: Test\r\n\r\n..\r\n")
+
+
+def test_send_auth(smtp_sink_host):
+    smtp.send(smtp_sink_host, "recipient@example.test", auth_user="u", auth_pass="p")
+
+
+@pytest.mark.parametrize(
+    "recipient, exception",
+    [
+        ("reject@example.test", smtp.SMTPPermanentError),
+        ("defer@example.test", smtp.SMTPTemporaryError),
+    ],
+)
+def test_send_recipient_refused(smtp_sink_host, recipient, exception):
+    with pytest.raises(exception):
+        smtp.send(smtp_sink_host, recipient)
+
+
+def test_send_async(smtp_sink, smtp_sink_host):
+    util.run_sync(smtp.send_async(smtp_sink_host, "recipient@example.test"))
+    assert len(smtp_sink.messages) == 1
+
+
+@pytest.mark.parametrize(
+    "message, expected",
+    [
+        ("Test", b"Test\r\n.\r\n"),
+        ("a\nb\n", b"a\r\nb\r\n.\r\n"),
+        (".a\r\n.", b"..a\r\n..\r\n.\r\n"),
+    ],
+)
+def test_dot_stuff(message, expected):
+    assert smtp.dot_stuff(message) == expected
+
+
+@pytest.mark.parametrize(
+    "smtp_sink, saved",
+    [
+        ({"extensions": ["CHUNKING"]}, 0),
+        ({"extensions": ["CHUNKING", "PIPELINING"]}, 6),
+    ],
+    indirect=["smtp_sink"],
+)
+def test_send_bdat(smtp_sink, smtp_sink_host, tmp_path, saved):
+    path = tmp_path / "message.eml"
+    path.write_bytes(b"Subject: Test\n\n" + b".\n" * body.BODY_CHUNK_SIZE * 2)
+    message = body.FileBody(str(path), use_mmap=True)
+    result = smtp.send(smtp_sink_host, "recipient@example.test", message=message)
+    expected = "Subject: Test\r\n\r\n" + ".\r\n" * body.BODY_CHUNK_SIZE * 2
+    assert smtp_sink.messages[0].endswith(expected)
+    assert len(smtp_sink.messages[0]) == result.message_bytes
+    assert "bdat" in [p.name for p in result.phases]
+    assert {p.name for p in result.phases} <= set(smtp.SMTP_PHASES)
+    assert result.round_trips_saved == saved
+
+
+def test_send_message_bytes(smtp_sink, smtp_sink_host):
+    result = smtp.send(smtp_sink_host, "recipient@example.test", message=".\n.")
+    assert len(smtp_sink.messages[0]) + 3 == result.message_bytes
+
+
+def test_pool_reuses_connections(smtp_sink, smtp_sink_host):
+    with smtp.SMTPPool(tls="no") as pool:
+        for _ in range(3):
+            pool.send(smtp_sink_host, "recipient@example.test")
+    assert len(smtp_sink.messages) == 3
+    assert smtp_sink.connections == 1
+
+
+@pytest.mark.parametrize("smtp_sink", [{"max_messages": 1}], indirect=True)
+def test_pool_reconnects(smtp_sink, smtp_sink_host):
+    with smtp.SMTPPool(tls="no") as pool:
+        for _ in range(3):
+            pool.send(smtp_sink_host, "recipient@example.test")
+    assert len(smtp_sink.messages) == 3
+    assert smtp_sink.connections == 3
+
+
+def test_pool_max_idle(smtp_sink, smtp_sink_host):
+    async def send_concurrently(pool):
+        await asyncio.gather(
+            *(
+                pool.send_async(smtp_sink_host, "recipient@example.test")
+                for _ in range(3)
+            )
+        )
+        return sum(len(clients) for clients in pool.idle.values())
+
+    pool = smtp.SMTPPool(tls="no", max_idle=1)
+    assert util.run_sync(send_concurrently(pool)) == 1
+    pool.close()
+    assert smtp_sink.connections == 3
+
+
+def test_send_result(smtp_sink_host):
+    result = smtp.send(smtp_sink_host, "recipient@example.test", tls="no")
+    assert [p.name for p in result.phases] == [
+        "connect",
+        "banner",
+        "ehlo",
+        "mail",
+        "rcpt",
+        "data",
+        "quit",
+    ]
+    assert result.codes == [220, 250, 250, 250, 250, 221]
+    assert all(p.started <= p.finished for p in result.phases)
+    assert result.bytes_sent > 0 and result.bytes_received > 0
+    assert result.tls_version == ""
+
+
+def test_send_error_result(smtp_sink_host):
+    with pytest.raises(smtp.SMTPPermanentError) as e:
+        smtp.send(smtp_sink_host, "reject@example.test")
+    assert e.value.code == 550
+    assert e.value.result.phases[-1].name == "rcpt"
+
+
+def test_race(smtp_sink, smtp_sink_host, smtp_blackhole_host):
+    hosts = [smtp_blackhole_host, smtp_sink_host._replace(preference=10)]
+    started = time.monotonic()
+    result = smtp.race(hosts, "recipient@example.test", timeout=3, stagger=0.1)
+    assert time.monotonic() - started < 2
+    assert result.host == hosts[1]
+    assert len(smtp_sink.messages) == 1
+
+
+def test_send_adaptive_timeouts(smtp_sink_host, smtp_blackhole_host):
+    timeouts = rto.AdaptiveTimeouts(minimum=0.2)
+    result = smtp.send(smtp_sink_host, "recipient@example.test", timeouts=timeouts)
+    assert result.phases[0].timeout == smtp.SMTP_DEFAULT_TIMEOUT
+    key = f"smtp 127.0.0.1:{smtp_sink_host.port} rcpt"
+    assert timeouts.estimates[key].samples == 1
+
+    # Once the banner has been measured, a host that stops answering fails
+    # after the adaptive timeout rather than the configured one.
+    key = f"smtp 127.0.0.1:{smtp_blackhole_host.port} banner"
+    timeouts.sample(key, 0.01)
+    started = time.monotonic()
+    with pytest.raises(smtp.SMTPTemporaryError) as e:
+        smtp.send(smtp_blackhole_host, "recipient@example.test", timeouts=timeouts)
+    assert time.monotonic() - started < 2
+    assert "Timeout=0.2s" in str(e.value)
+    assert timeouts.estimates[key].backoff == 1
+
+
+def test_race_refused_host(smtp_sink_host):
+    hosts = [smtp.SMTPHost(name="", address="127.0.0.1", port=0), smtp_sink_host]
+    result = smtp.race(hosts, "recipient@example.test", stagger=10)
+    assert result.host == smtp_sink_host
+
+
+@pytest.mark.parametrize(
+    "recipient, exception",
+    [
+        ("reject@example.test", smtp.SMTPPermanentError),
+        ("defer@example.test", smtp.SMTPTemporaryError),
+    ],
+)
+def test_race_errors(smtp_sink_host, recipient, exception):
+    with pytest.raises(exception):
+        smtp.race([smtp_sink_host, smtp_sink_host], recipient, stagger=0.1)
+
+
+@pytest.mark.parametrize("smtp_sink", [{"tls": True}], indirect=True)
+def test_send_tls_resumed(smtp_sink_host, tls_cert):
+    context = smtp.make_tls_context(ca_file=tls_cert)
+    first = smtp.send(
+        smtp_sink_host, "recipient@example.test", tls="yes", tls_context=context
+    )
+    second = smtp.send(
+        smtp_sink_host, "recipient@example.test", tls="yes", tls_context=context
+    )
+    assert [p.name for p in first.phases][:3] == ["connect", "tls", "banner"]
+    assert first.tls_version and first.tls_handshake > 0
+    assert not first.tls_resumed
+    assert second.tls_resumed
+
+
+@pytest.mark.parametrize("smtp_sink", [{"tls": True}], indirect=True)
+def test_send_tls_hostname_mismatch(smtp_sink_host, tls_cert):
+    context = smtp.make_tls_context(ca_file=tls_cert)
+    host = smtp_sink_host._replace(name="other.test")
+    with pytest.raises(smtp.SMTPTemporaryError):
+        smtp.send(host, "recipient@example.test", tls="yes", tls_context=context)
+
+
+def test_make_tls_context():
+    context = smtp.make_tls_context(min_version="TLSv1.2")
+    assert context is smtp.make_tls_context(min_version="TLSv1.2")
+    assert context is not smtp.make_tls_context()
+    assert context.minimum_version == ssl.TLSVersion.TLSv1_2
+    assert context.verify_mode == ssl.CERT_NONE
+
+
+@pytest.mark.parametrize("smtp_sink", [{"extensions": ["PIPELINING"]}], indirect=True)
+def test_send_pipelining(smtp_sink, smtp_sink_host):
+    result = smtp.send(smtp_sink_host, "recipient@example.test", tls="no")
+    assert [p.name for p in result.phases][3:6] == ["mail", "rcpt", "data"]
+    assert result.codes == [220, 250, 250, 250, 250, 221]
+    assert result.round_trips_saved == 2
+    assert len(smtp_sink.messages) == 1
+
+
+@pytest.mark.parametrize("smtp_sink", [{"extensions": ["PIPELINING"]}], indirect=True)
+def test_send_pipelining_disabled(smtp_sink_host):
+    result = smtp.send(
+        smtp_sink_host, "recipient@example.test", tls="no", pipelining=False
+    )
+    assert result.round_trips_saved == 0
+
+
+@pytest.mark.parametrize("smtp_sink", [{"extensions": ["PIPELINING"]}], indirect=True)
+def test_send_pipelining_refused(smtp_sink, smtp_sink_host):
+    with pytest.raises(smtp.SMTPPermanentError) as e:
+        smtp.send(smtp_sink_host, "reject@example.test", tls="no")
+    assert e.value.code == 550
+    assert e.value.result.codes[-2:] == [550, 554]
+    assert smtp_sink.messages == []
+
+
+@pytest.mark.parametrize(
+    "smtp_sink", [{"extensions": []}, {"extensions": ["PIPELINING"]}], indirect=True
+)
+def test_send_multiple_recipients(smtp_sink, smtp_sink_host):
+    recipients = ["a@example.test", "reject@example.test", "defer@example.test"]
+    result = smtp.send(smtp_sink_host, recipients, tls="no")
+    assert {r: reply.code for r, reply in result.recipients.items()} == {
+        "a@example.test": 250,
+        "reject@example.test": 550,
+        "defer@example.test": 450,
+    }
+    assert len(smtp_sink.messages) == 1
+
+
+@pytest.mark.parametrize(
+    "smtp_sink", [{"extensions": []}, {"extensions": ["PIPELINING"]}], indirect=True
+)
+def test_send_all_recipients_refused(smtp_sink, smtp_sink_host):
+    recipients = ["reject@example.test", "defer@example.test"]
+    with pytest.raises(smtp.SMTPTemporaryError) as e:
+        smtp.send(smtp_sink_host, recipients, tls="no")
+    assert e.value.code == 450
+    assert smtp_sink.messages == []
@@ -23,3 +23,34 @@ def test_is_ip_address(addr, expected):
 )
 def test_parse_email_address(addr, expected):
     assert util.parse_email_address(addr) == expected
+
+
+def test_run_sync():
+    async def coro():
+        return 42
+
+    assert util.run_sync(coro()) == 42
+
+
+def test_cancel_token():
+    calls = []
+    cancel = util.CancelToken()
+    cancel.add_callback(lambda: calls.append(1))
+    cancel.cancel()
+    cancel.add_callback(lambda: calls.append(2))
+    assert cancel.cancelled
+    assert calls == [1, 2]
+
+
+def test_cancel_token_remove_callback():
+    calls = []
+    cancel = util.CancelToken()
+
+    def callback():
+        calls.append(1)
+
+    cancel.add_callback(callback)
+    cancel.remove_callback(callback)
+    cancel.remove_callback(callback)
+    cancel.cancel()
+    assert calls == []
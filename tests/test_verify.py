@@ -0,0 +1,84 @@
+import threading
+
+import pytest
+
+import smtptester
+import smtptester.dns as dns
+import smtptester.fake as fake
+import smtptester.util as util
+import smtptester.verify as verify
+
+
+@pytest.fixture
+def dns_server():
+    server = fake.FakeDNSServer(
+        {
+            ("example.test", "mx"): ["10 mx.example.test."],
+            ("mx.example.test", "a"): ["127.0.0.1"],
+        }
+    )
+    util.run_sync(server.start())
+    yield server
+    util.run_sync(server.stop())
+
+
+@pytest.fixture
+def resolver(dns_server):
+    return dns.DNSResolver(host=dns_server.address, port=dns_server.port)
+
+
+def outcomes(results):
+    return {r.recipient: r.outcome for r in results}
+
+
+@pytest.mark.parametrize(
+    "smtp_sink",
+    [{"mailboxes": ["a@example.test", "b@example.test"]}],
+    indirect=True,
+)
+def test_run(smtp_sink, resolver):
+    recipients = ["a@example.test", "b@example.test", "c@example.test"]
+    results = verify.run(
+        recipients, resolver, smtp_port=smtp_sink.port, connections_per_host=1
+    )
+    assert outcomes(results) == {
+        "a@example.test": smtptester.RESULT_ACCEPTED,
+        "b@example.test": smtptester.RESULT_ACCEPTED,
+        "c@example.test": smtptester.RESULT_PERMANENT,
+    }
+    assert smtp_sink.connections == 1
+    assert smtp_sink.messages == []
+    assert len(smtp_sink.recipients) == len(recipients) + 1
+
+
+def test_run_catch_all(smtp_sink, resolver):
+    recipients = ["a@example.test", "reject@example.test", "defer@example.test"]
+    results = verify.run(recipients, resolver, smtp_port=smtp_sink.port)
+    assert outcomes(results) == {
+        "a@example.test": smtptester.RESULT_CATCH_ALL,
+        "reject@example.test": smtptester.RESULT_PERMANENT,
+        "defer@example.test": smtptester.RESULT_TEMPORARY,
+    }
+    probes = [r for r in smtp_sink.recipients if r.startswith("smtptester-probe")]
+    assert len(probes) == 1
+    assert smtp_sink.connections <= verify.VERIFY_DEFAULT_CONNECTIONS_PER_HOST
+
+
+def test_run_dns_error(smtp_sink, resolver):
+    results = list(verify.run(["a@missing.test"], resolver, smtp_port=smtp_sink.port))
+    assert results[0].outcome == smtptester.RESULT_ERROR
+    assert smtp_sink.connections == 0
+
+
+def test_run_reads_recipients_off_loop(smtp_sink, resolver):
+    # A recipients file that blocks mustn't hold up the sessions in progress.
+    threads = []
+
+    def recipients():
+        for recipient in ["a@example.test", "b@example.test"]:
+            threads.append(threading.current_thread().name)
+            yield recipient
+
+    results = verify.run(recipients(), resolver, smtp_port=smtp_sink.port)
+    assert len(list(results)) == 2
+    assert "smtptester-loop" not in threads